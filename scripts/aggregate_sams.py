@@ -0,0 +1,237 @@
+#! /usr/bin/env python3
+
+import argparse
+import gzip
+import multiprocessing
+import os
+import pickle
+import shutil
+import sys
+
+import final_stats
+import sam_summary_index
+import sort_sam_summary
+"""
+Aggregate the per-batch alignments into the final output and compute its statistics.
+
+For every batch, a gzip member with the "==> file <==" header is written,
+followed by the gzipped SAM of the batch copied as is (i.e., the output is the
+same as concatenating the files with headers). The statistics of the batches
+(as in final_stats.py) are computed in parallel and cached next to the batch
+SAMs, so that after re-running some batches, only those are parsed again.
+
+With --index, the SAMs of the batches are instead re-compressed into blocks
+indexed by query name and genome accession (see sam_summary_index.py).
+
+With --query-major, the alignments are written without batch headers in
+query-major order, i.e., all the hits of a read together, ordered like the
+queries (see sort_sam_summary.py).
+"""
+
+CACHE_SUFFIX = ".stats.pkl"
+CACHE_VERSION = 1
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def get_file_signature(fn):
+    st = os.stat(fn)
+    return st.st_size, st.st_mtime_ns
+
+
+def load_cached_batch_stats(sam_fn, queries_signature):
+    """Cached statistics of a batch SAM (None if missing or outdated)."""
+    cache_fn = sam_fn + CACHE_SUFFIX
+    try:
+        with open(cache_fn, "rb") as f:
+            cache = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    if (cache.get("version") != CACHE_VERSION or cache["sam_signature"] != get_file_signature(sam_fn) or
+            cache["queries_signature"] != queries_signature):
+        return None
+    return cache
+
+
+def save_cached_batch_stats(sam_fn, queries_signature, nb_queries, queries_bps, batch_stats):
+    cache = {
+        "version": CACHE_VERSION,
+        "sam_signature": get_file_signature(sam_fn),
+        "queries_signature": queries_signature,
+        "nb_queries": nb_queries,
+        "queries_bps": queries_bps,
+        "stats": vars(batch_stats),
+    }
+    cache_fn = sam_fn + CACHE_SUFFIX
+    with open(cache_fn + ".tmp", "wb") as fo:
+        pickle.dump(cache, fo, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_fn + ".tmp", cache_fn)
+
+
+def _compute_sam_stats(sam_fn):
+    batch = final_stats._get_batch_name(f"==> {sam_fn} <==")
+    return final_stats.compute_batch_stats(sam_fn, batch, [(0, os.path.getsize(sam_fn))])
+
+
+def write_batch_header(fo, sam_fn, i):
+    header = f"==> {sam_fn} <==\n"
+    if i > 0:
+        header = "\n" + header
+    fo.write(gzip.compress(header.encode(), mtime=0))
+
+
+def write_query_major(sam_fns, fo, index_writer, memory_mb, tmp_dir):
+    lines = sort_sam_summary.iterate_query_major_lines(sam_fns, final_stats._QUERY_IDS, memory_mb, tmp_dir)
+    if index_writer is not None:
+        index_writer.write_batch(fo, "*", lines)
+    else:
+        with gzip.GzipFile(fileobj=fo, mode="wb", compresslevel=1, mtime=0) as gz:
+            for line in lines:
+                gz.write(line)
+
+
+def aggregate(sam_fns, queries_fn, output_fn, stats_fn, threads, index_fn, block_size, query_major, memory_mb, tmp_dir):
+    queries_signature = get_file_signature(queries_fn)
+    caches = {fn: load_cached_batch_stats(fn, queries_signature) for fn in sam_fns}
+    outdated_fns = [fn for fn in sam_fns if caches[fn] is None]
+    error(f"Batch statistics: {len(sam_fns) - len(outdated_fns)} cached, {len(outdated_fns)} to compute")
+
+    if outdated_fns or query_major or not sam_fns:
+        # the query IDs are needed only to parse batches or to sort by query
+        final_stats._QUERY_IDS, queries_bps = final_stats.load_query_ids_and_bps(queries_fn)
+        nb_queries = len(final_stats._QUERY_IDS)
+    else:
+        nb_queries, queries_bps = caches[sam_fns[0]]["nb_queries"], caches[sam_fns[0]]["queries_bps"]
+
+    index_writer = None
+    if index_fn is not None:
+        index_writer = sam_summary_index.SamSummaryIndexWriter(index_fn, block_size)
+
+    stats = final_stats.BatchStats()
+    # fork, so that the workers share the query IDs instead of receiving a copy
+    with multiprocessing.get_context("fork").Pool(threads) as pool, open(output_fn, "wb") as fo:
+        computed_stats = pool.imap(_compute_sam_stats, outdated_fns)
+        for i, sam_fn in enumerate(sam_fns):
+            if not query_major:
+                write_batch_header(fo, sam_fn, i)
+                if index_writer is None:
+                    with open(sam_fn, "rb") as f:
+                        shutil.copyfileobj(f, fo, length=2**22)
+                else:
+                    batch = final_stats._get_batch_name(f"==> {sam_fn} <==")
+                    lines = final_stats.iterate_over_segment_lines(sam_fn, 0, os.path.getsize(sam_fn))
+                    index_writer.write_batch(fo, batch, (line + b"\n" for line in lines))
+
+            if caches[sam_fn] is not None:
+                batch_stats = final_stats.BatchStats()
+                vars(batch_stats).update(caches[sam_fn]["stats"])
+            else:
+                batch_stats = next(computed_stats)
+                save_cached_batch_stats(sam_fn, queries_signature, nb_queries, queries_bps, batch_stats)
+            stats.merge(batch_stats)
+            error(sam_fn)
+
+        if query_major:
+            write_query_major(sam_fns, fo, index_writer, memory_mb, tmp_dir)
+
+    if index_writer is not None:
+        index_writer.close()
+
+    with open(stats_fn, "w") as fo:
+        final_stats.print_merged_stats(stats, nb_queries, queries_bps, file=fo)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Aggregate batch alignments and compute their statistics")
+
+    parser.add_argument(
+        'sam_fns',
+        metavar='batch.sam.gz',
+        nargs='+',
+        help='gzipped SAMs of the batches',
+    )
+
+    parser.add_argument(
+        '-q',
+        dest='queries_fn',
+        metavar='queries.fa',
+        required=True,
+        help='merged queries',
+    )
+
+    parser.add_argument(
+        '-o',
+        dest='output_fn',
+        metavar='output.sam_summary.gz',
+        required=True,
+        help='aggregated alignments',
+    )
+
+    parser.add_argument(
+        '-s',
+        dest='stats_fn',
+        metavar='output.sam_summary.stats',
+        required=True,
+        help='statistics of the aggregated alignments',
+    )
+
+    parser.add_argument(
+        '-t',
+        dest='threads',
+        metavar='int',
+        type=int,
+        default=1,
+        help='number of processes computing the statistics of the batches [1]',
+    )
+
+    parser.add_argument(
+        '--index',
+        dest='index_fn',
+        metavar='output.sam_summary.idx',
+        default=None,
+        help='write the alignments as indexed blocks, with this sidecar index',
+    )
+
+    parser.add_argument(
+        '--block-size',
+        metavar='int',
+        type=int,
+        default=sam_summary_index.DEFAULT_BLOCK_SIZE,
+        help=f'uncompressed size of the indexed blocks in bytes [{sam_summary_index.DEFAULT_BLOCK_SIZE}]',
+    )
+
+    parser.add_argument(
+        '--query-major',
+        action='store_true',
+        default=False,
+        help='write the alignments in query-major order (without batch headers)',
+    )
+
+    parser.add_argument(
+        '--sort-memory-mb',
+        dest='memory_mb',
+        metavar='int',
+        type=int,
+        default=sort_sam_summary.DEFAULT_MEMORY_MB,
+        help=f'memory budget for sorting in query-major order in MB [{sort_sam_summary.DEFAULT_MEMORY_MB}]',
+    )
+
+    parser.add_argument(
+        '--sort-tmp-dir',
+        dest='tmp_dir',
+        metavar='dir',
+        default=None,
+        help='directory for the sorted runs spilled to disk [system temporary directory]',
+    )
+
+    args = parser.parse_args()
+
+    aggregate(args.sam_fns, args.queries_fn, args.output_fn, args.stats_fn, args.threads, args.index_fn,
+              args.block_size, args.query_major, args.memory_mb, args.tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
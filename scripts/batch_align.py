@@ -27,6 +27,14 @@ from subprocess import check_output
 #from subprocess import Popen
 from timeit import default_timer as timer
 from xopen import xopen
+
+import compact_sam
+import download
+import exact_match
+import fastx
+import inverted_mapping
+import job_trace
+import result_cache
 try:
     from fcntl import F_SETPIPE_SZ
 except ImportError:
@@ -38,89 +46,55 @@ except ImportError:
 logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(asctime)s] (%(levelname)s) %(message)s')
 
 
-def readfq(fp):
-    """Read FASTA/FASTQ file. Based on https://github.com/lh3/readfq/blob/master/readfq.py
-
-    Args:
-        fp (file): Input file object.
-    """
-
-    last = None  # this is a buffer keeping the last unprocessed line
-    while True:  # mimic closure; is it a bad idea?
-        if not last:  # the first record or a record following a fastq
-            for l in fp:  # search for the start of the next record
-                if l[0] in '>@':  # fasta/q header line
-                    last = l[:-1]  # save this line
-                    break
-        if not last:
-            break
-
-        ####
-        # modified to include comments
-        ####
-        #name, seqs, last = last[1:].partition(" ")[0], [], None
-        name, _, comment = last[1:].partition(" ")
-        seqs = []
-        last = None
-        ####
-        # end of the modified part
-        ####
-
-        for l in fp:  # read the sequence
-            if l[0] in '@+>':
-                last = l[:-1]
-                break
-            seqs.append(l[:-1])
-        if not last or last[0] != '+':  # this is a fasta record
-            yield name, comment, ''.join(seqs), None  # yield a fasta record
-            if not last:
-                break
-        else:  # this is a fastq record
-            seq, leng, seqs = ''.join(seqs), 0, []
-            for l in fp:  # read the quality
-                seqs.append(l[:-1])
-                leng += len(l) - 1
-                if leng >= len(seq):  # have read enough quality
-                    last = None
-                    yield name, comment, seq, ''.join(seqs)
-                    # yield a fastq record
-                    break
-            if last:  # reach EOF before reading enough quality
-                yield name, comment, seq, None  # yield a fasta record instead
-                break
-
-
-def iterate_over_batch(asms_fn, selected_rnames):
+def iterate_over_batch(asms_fn, selected_rnames, asms_stream=None):
     """Iterate over an xz-compressed TAR file corresponding to a batch with individual FASTA files.
 
+    The archive is read in a single pass, so it can also be a non-seekable stream (e.g., downloading).
+
     Args:
-        asms_fn (str): xz-compressed TAR file with FASTA files.
+        asms_fn (str): xz-compressed TAR file with FASTA files (or its URL if asms_stream is given).
         selected_rnames (list): Set of selected FASTA files for which a Minimap instance will be created (note: can contain rnames from other batches).
+        asms_stream (download.SourceStream): Stream of the TAR file, or None to open asms_fn.
     Returns:
         (rname (str), rfa (str))
     """
     logging.info(f"Opening {asms_fn}")
     skipped = 0
+    skipped_bytes = 0
+    nmembers = 0
 
-    with tarfile.open(asms_fn, mode="r:xz") as tar:
-        for member in tar.getmembers():
+    if asms_stream is None:
+        with job_trace.span("archive_open", compressed_bytes=os.path.getsize(asms_fn)):
+            tar = tarfile.open(asms_fn, mode="r:xz")
+    else:
+        with job_trace.span("archive_open", compressed_bytes=asms_stream.size, source=asms_stream.source):
+            tar = tarfile.open(fileobj=asms_stream, mode="r|xz")
+    with tar:
+        for member in tar:
             # extract file headers
+            nmembers += 1
             name = member.name
             rname = Path(name).stem
             if rname not in selected_rnames:
                 logging.debug(f"Skipping {rname} ({name})")
                 skipped += 1
+                skipped_bytes += member.size
                 continue
             # extract file content
             if skipped > 0:
                 logging.info(f"Skipping {skipped} references in {asms_fn} (no hits for them)")
+                job_trace.event("member_skip", members=skipped, bytes=skipped_bytes)
                 skipped = 0
+                skipped_bytes = 0
             logging.info(f"Extracting {rname} ({name})")
-            f = tar.extractfile(member)
-            rfa = f.read()
+            with job_trace.span("member_extract", ref=rname, bytes=member.size):
+                f = tar.extractfile(member)
+                rfa = f.read()
             yield rname, rfa
     if skipped > 0:
         logging.info(f"Skipping {skipped} references in {asms_fn}")
+        job_trace.event("member_skip", members=skipped, bytes=skipped_bytes)
+    job_trace.event("archive_end", members=nmembers)
 
 
 def load_qdicts(query_fn, accession_fn):
@@ -151,18 +125,18 @@ def load_qdicts(query_fn, accession_fn):
 
     # STEP 2: Fill up the query dictionaries
     logging.info(f"Loading query dictionaries (query name -> fasta string, ref_name -> list of cobs-matching queries)")
-    with xopen(query_fn) as fo:
-        for qname, qcom, qseq, _ in readfq(fo):
-            qname_to_qfa[qname] = f">{qname}\n{qseq}"
-            if not qcom:  # no refs proposed by COBS for local rnames
-                continue
-            rnames = qcom.split(",")
-            for rname in rnames:
-                try:
-                    rname_to_qnames[rname].append(qname)
-                except KeyError:
-                    # batch accession filtering on & not in this batch
-                    pass
+    for qname, qcom, qseq, _ in fastx.iterate_over_records(query_fn):
+        qname = qname.decode()
+        qname_to_qfa[qname] = f">{qname}\n{qseq.decode()}"
+        if not qcom:  # no refs proposed by COBS for local rnames
+            continue
+        rnames = qcom.decode().split(",")
+        for rname in rnames:
+            try:
+                rname_to_qnames[rname].append(qname)
+            except KeyError:
+                # batch accession filtering on & not in this batch
+                pass
 
     # STEP 3: Filter rname_to_qnames to references that have at least one COBS match
     rname_to_qnames = {k: v for k, v in rname_to_qnames.items() if len(v) > 0}
@@ -248,11 +222,21 @@ def _write_to_pipe(pipe_path, data):
 
 def run_minimap2(command, qfa, timeout=None):
     logging.debug(f"Running command: {command}")
-    output = subprocess.check_output(command,
-                                     input=qfa,
-                                     universal_newlines=True,
-                                     stderr=subprocess.DEVNULL,
-                                     timeout=timeout)
+    with job_trace.span("minimap2_spawn"):
+        process = subprocess.Popen(command,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL,
+                                   universal_newlines=True)
+    with job_trace.span("minimap2_run", query_bytes=len(qfa)):
+        try:
+            output, _ = process.communicate(qfa, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output)
     assert output and output[0] == "@", f"Output of Minimap2 is empty or corrupted ('{output}')"
     output_lines = output.splitlines()
     output_lines = list(filter(lambda line: not line.startswith("@"), output_lines))
@@ -264,7 +248,7 @@ def run_minimap2(command, qfa, timeout=None):
 def minimap2_4(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_params):
     logging.debug(f"Running minimap2...")
 
-    with named_pipe() as rfn:
+    with named_pipe() as rfn, job_trace.context(mode="pipe"):
         command = [
             "minimap2", "-a", "-x", minimap_preset, "-t",
             str(minimap_threads), *(shlex.split(minimap_extra_params)), rfn, '-'
@@ -281,7 +265,8 @@ def minimap2_4(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_params):
 
             # and now we write to the pipe
             logging.debug("Going to write to pipe...")
-            _write_to_pipe(rfn, rfa)
+            with job_trace.span("minimap2_feed", bytes=len(rfa)):
+                _write_to_pipe(rfn, rfa)
             logging.debug("All data written to pipe!")
 
             return minimap_2_output.result(timeout=5)
@@ -289,10 +274,12 @@ def minimap2_4(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_params):
 
 def minimap2_using_disk(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_params):
     logging.debug(f"Running minimap2 with disk...")
-    with tempfile.NamedTemporaryFile(mode='wb', suffix=".fa", prefix="mof", delete=True) as ref_fh:
+    with tempfile.NamedTemporaryFile(mode='wb', suffix=".fa", prefix="mof", delete=True) as ref_fh, \
+            job_trace.context(mode="disk"):
         logging.debug(f"Writing data to temp file...")
-        ref_fh.write(rfa)
-        ref_fh.flush()  # ensure data is written to the file before is read by minimap2
+        with job_trace.span("minimap2_feed", bytes=len(rfa)):
+            ref_fh.write(rfa)
+            ref_fh.flush()  # ensure data is written to the file before is read by minimap2
 
         ref_filepath = ref_fh.name
         command = [
@@ -308,6 +295,7 @@ def minimap_wrapper(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_par
             return minimap2_4(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_params)
         except (concurrent.futures.TimeoutError, subprocess.TimeoutExpired):
             logging.warning("Minimap2 timed out, using disk")
+            job_trace.event("pipe_fallback")
             return minimap2_using_disk(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_params)
     else:
         return minimap2_using_disk(rfa, qfa, minimap_preset, minimap_threads, minimap_extra_params)
@@ -413,8 +401,39 @@ def minimap2(rfa, qfa, minimap_preset):
     return output.decode("utf-8")
 
 
-def map_queries_to_batch(asms_fn, query_fn, minimap_preset, minimap_threads, minimap_extra_params, prefer_pipe,
-                         accessions_fn):
+def update_result_cache(cache, rname, qnames, qnames_to_map, qname_to_hash, cached_records, mm_output_lines):
+    """Store the new alignments to a reference in the result cache and add the cached ones.
+
+    Returns:
+        list: Output lines of all the queries (the new ones first).
+    """
+    new_records = {qname: [] for qname in qnames_to_map}
+    for line in mm_output_lines:
+        qname, _, record = line.partition("\t")
+        new_records[qname].append(record)
+    # queries with identical sequences share the same entry
+    cache.put_alignments(rname, {qname_to_hash[qname]: records for qname, records in new_records.items()})
+
+    output_lines = list(mm_output_lines)
+    mapped = set(qnames_to_map)
+    for qname in qnames:
+        if qname not in mapped:
+            output_lines.extend(f"{qname}\t{record}" for record in cached_records[qname_to_hash[qname]])
+    return output_lines
+
+
+def map_queries_to_batch(asms_fn,
+                         query_fn,
+                         minimap_preset,
+                         minimap_threads,
+                         minimap_extra_params,
+                         prefer_pipe,
+                         accessions_fn,
+                         compact,
+                         result_cache_dir,
+                         ref_markers,
+                         exact_fast_path,
+                         asms_stream=None):
     """Map queries to a batch.
 
     Args:
@@ -425,6 +444,13 @@ def map_queries_to_batch(asms_fn, query_fn, minimap_preset, minimap_threads, min
         minimap_extra_params (str): Additional minimap parameters.
         prefer_pipe (bool): Prefer using pipes.
         accessions_fn (str): List of allowed accessions.
+        compact (bool): Replace SEQ by a reference to the query sequence where possible (see compact_sam.py).
+        result_cache_dir (str): Directory of the persistent result cache (see result_cache.py), or None.
+        ref_markers (bool): Precede the alignments to every reference by a "#ref\t{rname}" line
+            (see filter_speculative_alignments.py).
+        exact_fast_path (bool): Write the records of the queries contained exactly once in a reference directly,
+            without minimap2 (see exact_match.py).
+        asms_stream (download.SourceStream): Stream of the batch (asms_fn is then its URL), or None.
     """
     sstart = timer()
     logging.info(f"Mapping queries from '{query_fn}' to '{asms_fn}' using Minimap2 with the '{minimap_preset}' preset")
@@ -434,43 +460,86 @@ def map_queries_to_batch(asms_fn, query_fn, minimap_preset, minimap_threads, min
     #     qname_to_qfa:     query name -> FASTA string
     #     rname_to_qnames:  ref name   -> list of its COBS candidates"
     #   Extract the relevant subset of rnames - rnames_local_subset
-    qname_to_qfa, rname_to_qnames = load_qdicts(query_fn, accessions_fn)
+    with job_trace.span("load_queries") as span:
+        qname_to_qfa, rname_to_qnames = load_qdicts(query_fn, accessions_fn)
+        span.update(queries=len(qname_to_qfa), refs=len(rname_to_qnames))
+    if compact or exact_fast_path:
+        qname_to_qseq = {qname: qfa.partition("\n")[2] for qname, qfa in qname_to_qfa.items()}
+    eqx = "--eqx" in shlex.split(minimap_extra_params or "")
+
+    cache = None
+    if result_cache_dir is not None:
+        cache = result_cache.ResultCache(
+            result_cache.get_cache_fn(result_cache_dir, result_cache.get_batch_name(asms_fn)),
+            result_cache.get_file_version(asms_fn) if asms_stream is None else f"{asms_stream.name}:{asms_stream.size}",
+            result_cache.get_minimap_params(minimap_preset, minimap_extra_params) +
+            (",exact_fast_path" if exact_fast_path else ""),
+        )
+        qname_to_hash = {qname: result_cache.get_seq_hash(qfa.partition("\n")[2]) for qname, qfa in qname_to_qfa.items()}
+        ncached_total = 0
 
     nsr = len(rname_to_qnames)
     logging.debug(f"Identifying filtered rnames in the query file - #{nsr} records: {rname_to_qnames.keys()}")
     naligns_total = 0
+    nexact_total = 0
     nrefs = 0
     refs = set()
     logging.info(f"Starting the alignment loop")
 
     # STEP 2: Iterate over compressed assemblies: (ref name, ref FASTA)
     #   Here it's already restricted only to the references proposed by COBS, i.e, hot candidates
-    for i, (rname, rfa) in enumerate(iterate_over_batch(asms_fn, rname_to_qnames.keys()), 1):
+    for i, (rname, rfa) in enumerate(iterate_over_batch(asms_fn, rname_to_qnames.keys(), asms_stream), 1):
         start = timer()
         refs.add(rname)
 
         # STEP 2a: identify queries that are to be mapped to this reference (i.e., rname, rfa)
-        qfas = []
-        qnames = []
-        for qname in rname_to_qnames[rname]:
-            qnames.append(qname)
-            qfa = qname_to_qfa[qname]
-            qfas.append(qfa)
-
-        # STEP 2b: Create a Minimap instance, pass all the data, and get the output lines
-        logging.info(f"Minimapping to {rname} (#{i}): {', '.join(qnames)}")
-        mm_output_lines = minimap_wrapper(rfa, "\n".join(qfas), minimap_preset, minimap_threads, minimap_extra_params,
-                                          prefer_pipe)
-        logging.debug("minimap2 finished successfully!")
-
-        # STEP 2c: Print Minimap output
+        qnames = rname_to_qnames[rname]
+        job_trace.set_context(ref=rname, ref_bytes=len(rfa), queries=len(qnames))
+        qnames_to_map = qnames
+        if cache is not None:
+            #   the alignments of the queries found in the result cache are not recomputed
+            with job_trace.span("cache_lookup"):
+                cached_records = cache.get_alignments(rname, {qname_to_hash[qname] for qname in qnames})
+            qnames_to_map = [qname for qname in qnames if qname_to_hash[qname] not in cached_records]
+            ncached_total += len(qnames) - len(qnames_to_map)
+        qnames_new = qnames_to_map
+
+        # STEP 2b: Write the records of the exact hits directly (fast path)
+        mm_output_lines = []
+        if exact_fast_path and qnames_to_map:
+            with job_trace.span("exact_match") as span:
+                mm_output_lines, qnames_to_map = exact_match.map_exact_hits(rfa, qnames_to_map, qname_to_qseq, eqx)
+                span["exact_hits"] = len(mm_output_lines)
+            nexact_total += len(mm_output_lines)
+
+        # STEP 2c: Create a Minimap instance, pass all the data, and get the output lines
+        qfas = [qname_to_qfa[qname] for qname in qnames_to_map]
+        if qnames_to_map:
+            logging.info(f"Minimapping to {rname} (#{i}): {', '.join(qnames_to_map)}")
+            with job_trace.context(queries_to_map=len(qnames_to_map)):
+                mm_output_lines += minimap_wrapper(rfa, "\n".join(qfas), minimap_preset, minimap_threads,
+                                                   minimap_extra_params, prefer_pipe)
+            logging.debug("minimap2 finished successfully!")
+        if cache is not None:
+            with job_trace.span("cache_update"):
+                mm_output_lines = update_result_cache(cache, rname, qnames, qnames_new, qname_to_hash, cached_records,
+                                                      mm_output_lines)
+
+        # STEP 2d: Print Minimap output
         naligns = len(mm_output_lines)
         minimap_output_is_empty = naligns == 0
         if not minimap_output_is_empty:
-            mm_output_str = "\n".join(mm_output_lines)
-            print(mm_output_str)
-
-        # STEP 2d: Update & report stats
+            with job_trace.span("output_write", lines=naligns) as span:
+                if compact:
+                    mm_output_lines = [compact_sam.compact_sam_line(line, qname_to_qseq) for line in mm_output_lines]
+                if ref_markers:
+                    print(f"#ref\t{rname}")
+                mm_output_str = "\n".join(mm_output_lines)
+                print(mm_output_str)
+                span["bytes"] = len(mm_output_str)
+        job_trace.set_context()
+
+        # STEP 2e: Update & report stats
         naligns_total += naligns
         end = timer()
         s = round(1000 * (end - start)) / 1000.0
@@ -481,6 +550,63 @@ def map_queries_to_batch(asms_fn, query_fn, minimap_preset, minimap_threads, min
     eend = timer()
     ss = round(1000 * (eend - sstart)) / 1000.0
     nrefs = len(refs)
+    if exact_fast_path:
+        logging.info(f"Computed {nexact_total} alignments of exact hits without minimap2")
+    if cache is not None:
+        cache.close()
+        logging.info(f"Reused {ncached_total} query-reference alignments from the result cache")
+    logging.info(
+        f"Finished mapping queries from '{query_fn}' to '{asms_fn}': computed {naligns_total} alignments to {nrefs} references in {ss} seconds"
+    )
+
+
+def map_queries_to_batch_inverted(asms_fn,
+                                  query_fn,
+                                  minimap_preset,
+                                  minimap_threads,
+                                  minimap_extra_params,
+                                  accessions_fn,
+                                  compact,
+                                  ref_markers,
+                                  asms_stream=None):
+    """Map queries to a batch in the inverted mode: the reads are indexed once and the genomes are streamed.
+
+    Args:
+        See map_queries_to_batch (see inverted_mapping.py for the mode).
+    """
+    sstart = timer()
+    logging.info(f"Mapping queries from '{query_fn}' to '{asms_fn}' in the inverted mode (reads indexed once)")
+
+    with job_trace.span("load_queries") as span:
+        qname_to_qfa, rname_to_qnames = load_qdicts(query_fn, accessions_fn)
+        span.update(queries=len(qname_to_qfa), refs=len(rname_to_qnames))
+    qname_to_qseq = {qname: qfa.partition("\n")[2] for qname, qfa in qname_to_qfa.items()}
+    candidate_qnames = sorted({qname for qnames in rname_to_qnames.values() for qname in qnames})
+    naligns_total = 0
+    nrefs = 0
+
+    if candidate_qnames:
+        with tempfile.NamedTemporaryFile(mode='w', suffix=".fa", prefix="reads", delete=True) as reads_fh:
+            with job_trace.span("reads_write", queries=len(candidate_qnames)):
+                reads_fh.write("\n".join(qname_to_qfa[qname] for qname in candidate_qnames) + "\n")
+                reads_fh.flush()
+            command = inverted_mapping.get_minimap_command(minimap_preset, minimap_threads, minimap_extra_params,
+                                                           reads_fh.name, len(candidate_qnames))
+            logging.info(f"Running command: {command}")
+            genomes = iterate_over_batch(asms_fn, rname_to_qnames.keys(), asms_stream)
+            for rname, records in inverted_mapping.iterate_over_inverted_alignments(command, genomes, rname_to_qnames,
+                                                                                    qname_to_qseq):
+                with job_trace.span("output_write", ref=rname, queries=len(rname_to_qnames[rname]), lines=len(records)):
+                    if compact:
+                        records = [compact_sam.compact_sam_line(record, qname_to_qseq) for record in records]
+                    if ref_markers:
+                        print(f"#ref\t{rname}")
+                    print("\n".join(records))
+                logging.info(f"Computed {len(records)} alignments of {len(rname_to_qnames[rname])} queries to {rname}")
+                naligns_total += len(records)
+                nrefs += 1
+
+    ss = round(1000 * (timer() - sstart)) / 1000.0
     logging.info(
         f"Finished mapping queries from '{query_fn}' to '{asms_fn}': computed {naligns_total} alignments to {nrefs} references in {ss} seconds"
     )
@@ -524,10 +650,83 @@ def main():
         help='Restrict to a list of accesions (e.g., from a single batch)',
     )
 
+    parser.add_argument(
+        '--compact',
+        action="store_true",
+        default=False,
+        help='Compact output: replace SEQ by a reference to the query sequence where possible',
+    )
+
+    parser.add_argument(
+        '--result-cache',
+        metavar='dir',
+        dest='result_cache_dir',
+        default=None,
+        help='Reuse and store the alignments in a persistent result cache (see result_cache.py)',
+    )
+
+    parser.add_argument(
+        '--ref-markers',
+        action="store_true",
+        default=False,
+        help='Precede the alignments to every reference by a "#ref <TAB> rname" line (speculative mapping)',
+    )
+
+    parser.add_argument(
+        '--exact-fast-path',
+        action="store_true",
+        default=False,
+        help='Write the alignments of queries contained exactly once in a reference without running minimap2',
+    )
+
+    parser.add_argument(
+        '--inverted',
+        action="store_true",
+        default=False,
+        help='Inverted mode for small query sets: index the reads once and stream the genomes through minimap2',
+    )
+
+    parser.add_argument(
+        '--trace',
+        metavar='trace.jsonl',
+        default=None,
+        help='Write a JSONL trace of the steps of the job (see job_trace.py)',
+    )
+
+    parser.add_argument(
+        '--mirror',
+        metavar='dir|url',
+        action='append',
+        default=[],
+        help='If batch.tar.xz is a URL, directory, file:// or http(s):// base URL where it is looked up first '
+        '(can be repeated, see download.py)',
+    )
+
+    parser.add_argument(
+        '--local',
+        metavar='batch.tar.xz',
+        default=None,
+        help='If batch.tar.xz is a URL, read this file instead if it exists (downloaded, or kept by a previous run)',
+    )
+
+    parser.add_argument(
+        '--keep-copy',
+        metavar='batch.tar.xz',
+        default=None,
+        help='If batch.tar.xz is a URL, also write the downloaded archive to this file (write-through copy)',
+    )
+
+    parser.add_argument(
+        '--stream-buffer-mb',
+        type=int,
+        default=64,
+        help='If batch.tar.xz is a URL, MB of the archive downloaded ahead of the mapping [64]',
+    )
+
     parser.add_argument(
         'batch_fn',
         metavar='batch.tar.xz',
-        help='',
+        help='Batch file, or its URL (http(s)://, file://) to map the assemblies as they download',
     )
 
     parser.add_argument(
@@ -537,13 +736,49 @@ def main():
     )
 
     args = parser.parse_args()
-    map_queries_to_batch(args.batch_fn,
-                         args.query_fn,
-                         minimap_preset=args.minimap_preset,
-                         minimap_threads=args.threads,
-                         minimap_extra_params=args.extra_params,
-                         prefer_pipe=args.pipe,
-                         accessions_fn=args.accessions)
+    batch_fn = args.batch_fn
+    if "://" in batch_fn and args.local is not None and os.path.exists(args.local):
+        # decided here rather than in the Snakefile, so that the inputs of the job do not depend on it
+        batch_fn = args.local
+    if args.trace is not None:
+        job_trace.setup(args.trace, batch=batch_fn, query_fn=args.query_fn, inverted=args.inverted)
+    asms_stream = None
+    if "://" in batch_fn:
+        # streaming mode: the archive is read as it downloads (from a mirror, or its URL)
+        asms_stream = download.SourceStream(batch_fn,
+                                            mirrors=args.mirror,
+                                            copy_fn=args.keep_copy,
+                                            buffer_size=args.stream_buffer_mb * 2**20)
+        logging.info(f"Streaming {batch_fn} from {asms_stream.source}")
+    if args.inverted:
+        if args.result_cache_dir is not None or args.exact_fast_path:
+            logging.warning("The result cache and the exact fast path are not used in the inverted mode")
+        map_queries_to_batch_inverted(batch_fn,
+                                      args.query_fn,
+                                      minimap_preset=args.minimap_preset,
+                                      minimap_threads=args.threads,
+                                      minimap_extra_params=args.extra_params,
+                                      accessions_fn=args.accessions,
+                                      compact=args.compact,
+                                      ref_markers=args.ref_markers,
+                                      asms_stream=asms_stream)
+    else:
+        map_queries_to_batch(batch_fn,
+                             args.query_fn,
+                             minimap_preset=args.minimap_preset,
+                             minimap_threads=args.threads,
+                             minimap_extra_params=args.extra_params,
+                             prefer_pipe=args.pipe,
+                             accessions_fn=args.accessions,
+                             compact=args.compact,
+                             result_cache_dir=args.result_cache_dir,
+                             ref_markers=args.ref_markers,
+                             exact_fast_path=args.exact_fast_path,
+                             asms_stream=asms_stream)
+    if asms_stream is not None:
+        # completes the write-through copy, if any
+        asms_stream.close()
+    job_trace.close()
 
 
 if __name__ == "__main__":
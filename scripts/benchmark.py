@@ -4,12 +4,25 @@ import argparse
 from pathlib import Path
 import subprocess
 import datetime
+import time
+
+import resource_sampler
 
 
 def get_args():
     parser = argparse.ArgumentParser(description='Benchmark a command.')
     parser.add_argument('command', type=str, help='The command to be benchmarked')
     parser.add_argument('--log', type=str, required=True, help='Path to the log file with benchmark statistics.')
+    parser.add_argument('--mem-mb', type=int, default=None, help='RAM requested for the job (recorded in the log).')
+    parser.add_argument('--sample-interval',
+                        type=float,
+                        default=None,
+                        help='Record the resources used by the job every N seconds into {log}.samples.tsv '
+                        '(see resource_sampler.py). Default: 1 for snakemake commands, not recorded otherwise.')
+    parser.add_argument('--sample-scope',
+                        choices=["tree", "cgroup"],
+                        default="tree",
+                        help='Sample the process tree of the command or its cgroup.')
     args = parser.parse_args()
     return args
 
@@ -30,30 +43,41 @@ def main():
     log_file.parent.mkdir(parents=True, exist_ok=True)
     tmp_log_file = Path(f"{log_file}.tmp")
     is_benchmarking_pipeline = args.command.split()[0] == "snakemake"
+    sample_interval = args.sample_interval
+    if sample_interval is None and is_benchmarking_pipeline:
+        sample_interval = 1.0
+    samples_file = log_file.with_suffix(".samples.tsv")
 
     with open(log_file, "w") as log_fh:
         formatted_command = " ".join(args.command.replace("\\\n", " ").strip().split())
         print(f"# Benchmarking command: {formatted_command}", file=log_fh)
         header = [
             "real(s)", "sys(s)", "user(s)", "percent_CPU", "max_RAM(kb)", "FS_inputs", "FS_outputs",
-            "elapsed_time_alt(s)"
+            "elapsed_time_alt(s)", "start_time", "end_time", "requested_mem_mb"
         ]
         if is_benchmarking_pipeline:
-            header.append("max_delta_system_RAM(kb)")
+            header.append("max_tree_RSS(kb)")
         print("\t".join(header), file=log_fh)
 
     time_command = get_time_command()
     benchmark_command = f'{time_command} -o {tmp_log_file} -f "%e\t%S\t%U\t%P\t%M\t%I\t%O"'
 
     start_time = datetime.datetime.now()
+    start_timestamp = time.time()
     main_process = subprocess.Popen(f'{benchmark_command} {args.command}', shell=True)
-    if is_benchmarking_pipeline:
-        RAM_tmp_log_file = Path(f"{log_file}.RAM.tmp")
-        RAM_benchmarking_process = subprocess.Popen(
-            [sys.executable, "scripts/get_RAM_usage.py",
-             str(RAM_tmp_log_file),
-             str(main_process.pid)])
+    if sample_interval:
+        sampler_process = subprocess.Popen([
+            sys.executable,
+            str(Path(__file__).parent / "resource_sampler.py"), "record", "--interval",
+            str(sample_interval), "--scope", args.sample_scope,
+            str(main_process.pid),
+            str(samples_file)
+        ])
     return_code = main_process.wait()
+    if sample_interval:
+        # the sampler writes the samples taken so far and stops
+        sampler_process.terminate()
+        sampler_process.wait()
     if return_code:
         raise subprocess.CalledProcessError(return_code,
                                             main_process.args,
@@ -61,17 +85,19 @@ def main():
                                             stderr=main_process.stderr)
 
     end_time = datetime.datetime.now()
+    end_timestamp = time.time()
     elapsed_seconds = (end_time - start_time).total_seconds()
     with open(tmp_log_file) as log_fh_tmp, open(log_file, "a") as log_fh:
         log_line = log_fh_tmp.readline().strip()
         log_line += f"\t{elapsed_seconds}"
+        # epoch times, used to reconstruct the timeline of the run (see perf_report.py)
+        log_line += f"\t{start_timestamp:.3f}\t{end_timestamp:.3f}"
+        log_line += f"\t{args.mem_mb if args.mem_mb is not None else 'NA'}"
 
         if is_benchmarking_pipeline:
-            RAM_benchmarking_process.kill()
-            with open(RAM_tmp_log_file) as RAM_tmp_log_fh:
-                RAM_usage = RAM_tmp_log_fh.readline().strip()
-            log_line += f"\t{RAM_usage}"
-            RAM_tmp_log_file.unlink()
+            # /usr/bin/time only reports the peak RSS of the largest process, not of all the jobs together
+            peak_rss_mb = resource_sampler.get_peak_rss_mb(samples_file) if samples_file.exists() else None
+            log_line += f"\t{round(peak_rss_mb * 1024) if peak_rss_mb is not None else 'NA'}"
 
         print(log_line, file=log_fh)
 
@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+
+import argparse
+import collections
+import json
+import lzma
+import re
+import sys
+
+from pathlib import Path
+"""
+Fit per-rule models of the peak RAM usage from the benchmark logs of previous runs.
+
+Every rule is benchmarked by scripts/benchmark.py, which records max_RAM(kb)
+in logs/benchmarks/{rule}/{job}.txt. For each rule, a linear model
+
+    peak_RAM_MB = intercept + sum(coefficient_i * feature_i)
+
+is fitted by least squares, and the largest observed underestimate is stored
+with it, so that the Snakefile can request RAM that would have covered all the
+observed jobs (plus a safety margin). The features are:
+
+    index_mb  - size of the decompressed COBS index of the batch
+    n_refs    - number of references (assemblies) in the batch
+    query_mb  - size of the query files in input/
+"""
+
+# rule -> (benchmark subdirectory, log name regex, features)
+RULES = {
+    "run_cobs": ("run_cobs", r"^(?P<batch>.+__\d\d)____(?P<qfile>.+)\.txt$", ["index_mb", "query_mb"]),
+    "translate_matches": ("translate_matches", r"^translate_matches___(?P<qfile>.+)\.txt$", ["query_mb"]),
+    "batch_align_minimap2":
+        ("batch_align_minimap2", r"^(?P<batch>.+__\d\d)____(?P<qfile>.+)\.txt$", ["n_refs", "query_mb"]),
+    "aggregate_sams": ("aggregate_sams", r"^aggregate_sams___(?P<qfile>.+)\.txt$", ["query_mb"]),
+}
+
+QUERY_EXTENSIONS = ["fa", "fasta", "fq", "fastq"]
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def load_index_sizes_in_MB(decompressed_indexes_sizes_fn):
+    sizes = {}
+    with open(decompressed_indexes_sizes_fn) as f:
+        for line in f:
+            cobs_index, size_in_bytes, _ = line.strip().split()
+            batch = cobs_index.split("/")[-1].replace(".cobs_classic.xz", "")
+            sizes[batch] = int(size_in_bytes) / 2**20
+    return sizes
+
+
+def load_nb_of_refs(accessions_fn):
+    nb_refs = {}
+    with lzma.open(accessions_fn, "rt") as f:
+        for line in f:
+            batch, _, accessions = line.strip().partition("\t")
+            nb_refs[batch] = len(re.split(';|,', accessions))
+    return nb_refs
+
+
+def get_query_size_in_MB(qfile, input_dir):
+    """Size of the query files composing qfile (i.e., query file names joined by ___), None if any is missing."""
+    size = 0
+    for name in qfile.split("___"):
+        fns = [fn for ext in QUERY_EXTENSIONS for fn in Path(input_dir).glob(f"{name}.{ext}")]
+        if not fns:
+            return None
+        size += fns[0].stat().st_size
+    return size / 2**20
+
+
+def read_benchmark_log(fn):
+    """Read a benchmark log produced by benchmark.py as a dict (None if the job did not finish)."""
+    with open(fn) as f:
+        lines = [line.rstrip("\n") for line in f if not line.startswith("#") and line.strip()]
+    if len(lines) < 2:
+        return None
+    return dict(zip(lines[0].split("\t"), lines[1].split("\t")))
+
+
+def collect_samples(benchmarks_dir, index_sizes, nb_refs, input_dir):
+    """Collect (features, peak RAM in MB) samples for every rule."""
+    samples = collections.defaultdict(list)
+    for rule, (subdir, log_re, feature_names) in RULES.items():
+        for fn in sorted(Path(benchmarks_dir, subdir).glob("*.txt")):
+            m = re.match(log_re, fn.name)
+            if m is None:
+                continue
+            record = read_benchmark_log(fn)
+            if record is None:
+                continue
+            try:
+                peak_RAM_MB = int(record["max_RAM(kb)"]) / 1024
+            except (KeyError, ValueError):
+                continue
+            wildcards = m.groupdict()
+            features = {}
+            if "batch" in wildcards:
+                features["index_mb"] = index_sizes.get(wildcards["batch"])
+                features["n_refs"] = nb_refs.get(wildcards["batch"])
+            features["query_mb"] = get_query_size_in_MB(wildcards["qfile"], input_dir)
+            x = [features.get(name) for name in feature_names]
+            if None in x:
+                error(f"Skipping {fn}: features could not be computed")
+                continue
+            samples[rule].append((x, peak_RAM_MB))
+    return samples
+
+
+def _solve(a, b):
+    """Solve a linear system by Gaussian elimination with partial pivoting (None if singular)."""
+    n = len(b)
+    m = [row[:] + [v] for row, v in zip(a, b)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-9:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col:
+                factor = m[r][col] / m[col][col]
+                for c in range(col, n + 1):
+                    m[r][c] -= factor * m[col][c]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+
+def fit_linear_model(samples):
+    """Least-squares fit of y = b0 + b1*x1 + ... (normal equations).
+
+    Features that do not vary across the samples are dropped (coefficient 0), and if the system is still
+    singular, a constant model is used.
+
+    Returns:
+        (intercept, coefficients)
+    """
+    nb_features = len(samples[0][0])
+    varying = [i for i in range(nb_features) if len({x[i] for x, _ in samples}) > 1]
+    rows = [[1.0] + [x[i] for i in varying] for x, _ in samples]
+    ys = [y for _, y in samples]
+    k = len(rows[0])
+    xtx = [[sum(r[i] * r[j] for r in rows) for j in range(k)] for i in range(k)]
+    xty = [sum(r[i] * y for r, y in zip(rows, ys)) for i in range(k)]
+    beta = _solve(xtx, xty) if len(samples) > k else None
+    coefficients = [0.0] * nb_features
+    if beta is None:
+        return max(ys), coefficients
+    for i, b in zip(varying, beta[1:]):
+        coefficients[i] = b
+    return beta[0], coefficients
+
+
+def predict(model, x):
+    return model["intercept"] + sum(c * v for c, v in zip(model["coefficients"], x))
+
+
+def calibrate(benchmarks_dir, decompressed_indexes_sizes_fn, accessions_fn, input_dir, min_samples):
+    samples = collect_samples(benchmarks_dir, load_index_sizes_in_MB(decompressed_indexes_sizes_fn),
+                              load_nb_of_refs(accessions_fn), input_dir)
+    models = {}
+    for rule, (_, _, feature_names) in RULES.items():
+        rule_samples = samples.get(rule, [])
+        if len(rule_samples) < min_samples:
+            error(f"Rule {rule}: {len(rule_samples)} samples, at least {min_samples} needed, no model fitted")
+            continue
+        intercept, coefficients = fit_linear_model(rule_samples)
+        model = {
+            "features": feature_names,
+            "intercept": intercept,
+            "coefficients": coefficients,
+            "n_samples": len(rule_samples),
+        }
+        residuals = [y - predict(model, x) for x, y in rule_samples]
+        model["max_underestimate_mb"] = max(0.0, max(residuals))
+        model["max_observed_mb"] = max(y for _, y in rule_samples)
+        models[rule] = model
+        error(f"Rule {rule}: {len(rule_samples)} samples, intercept {intercept:.1f} MB, "
+              f"coefficients {dict(zip(feature_names, coefficients))}, "
+              f"max underestimate {model['max_underestimate_mb']:.1f} MB")
+    return models
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Fit per-rule peak RAM models from benchmark logs")
+
+    parser.add_argument(
+        '--benchmarks-dir',
+        default="logs/benchmarks",
+        help='directory with the benchmark logs [logs/benchmarks]',
+    )
+
+    parser.add_argument(
+        '--indexes-sizes',
+        default="data/decompressed_indexes_sizes.txt",
+        help='decompressed COBS index sizes [data/decompressed_indexes_sizes.txt]',
+    )
+
+    parser.add_argument(
+        '--accessions',
+        default="data/661k_batches.txt.xz",
+        help='accessions of the batches [data/661k_batches.txt.xz]',
+    )
+
+    parser.add_argument(
+        '--input-dir',
+        default="input",
+        help='directory with the query files [input]',
+    )
+
+    parser.add_argument(
+        '--min-samples',
+        type=int,
+        default=3,
+        help='minimum number of samples to fit a model for a rule [3]',
+    )
+
+    parser.add_argument(
+        '-o',
+        dest='output',
+        required=True,
+        help='output JSON file with the models',
+    )
+
+    args = parser.parse_args()
+
+    models = calibrate(args.benchmarks_dir, args.indexes_sizes, args.accessions, args.input_dir, args.min_samples)
+    with open(args.output, "w") as fo:
+        json.dump(models, fo, indent=4, sort_keys=True)
+        fo.write("\n")
+
+
+if __name__ == "__main__":
+    main()
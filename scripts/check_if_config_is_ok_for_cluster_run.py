@@ -9,12 +9,30 @@ with open("config.yaml", "r") as stream:
         print(exc, file=sys.stderr)
         sys.exit(1)
 
-# check if cobs_threads is an int
-try:
-    int(config["cobs_threads"])
-except ValueError:
-    print(
-        "ERROR: to run Phylign in cluster mode, the parameter cobs_threads in config.yaml MUST BE SET to a fixed "
-        "int value. Aborting.",
-        file=sys.stderr)
-    sys.exit(1)
+
+def is_positive_number(x):
+    try:
+        return float(x) > 0
+    except (TypeError, ValueError):
+        return False
+
+
+# check if cobs_threads is an int, or auto/auto(N) together with a valid node profile
+cobs_threads = str(config["cobs_threads"])
+if cobs_threads.startswith("auto"):
+    if not (is_positive_number(config.get("cluster_node_cores")) and
+            is_positive_number(config.get("cluster_node_ram_gb"))):
+        print(
+            "ERROR: to run Phylign in cluster mode with cobs_threads set to auto, the parameters cluster_node_cores "
+            "and cluster_node_ram_gb in config.yaml MUST BE SET to positive values. Aborting.",
+            file=sys.stderr)
+        sys.exit(1)
+else:
+    try:
+        int(cobs_threads)
+    except ValueError:
+        print(
+            "ERROR: to run Phylign in cluster mode, the parameter cobs_threads in config.yaml MUST BE SET to a fixed "
+            "int value, auto, or auto(N). Aborting.",
+            file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,327 @@
+#! /usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import ctypes
+import ctypes.util
+import mmap
+import os
+import sys
+import time
+
+from pathlib import Path
+"""
+Page-cache management for decompressed COBS indexes (index_load_mode: mmap-disk).
+
+With mmap-disk, COBS faults in random pages of the index on demand, which is
+very slow on network filesystems. This script reads indexes sequentially into
+the page cache before they are queried, and drops them from the cache once
+they are not needed anymore.
+
+Subcommands:
+    residency - log the fraction of the index that is already in the page cache
+    prefetch  - read the index sequentially into the page cache (RAM headroom permitting)
+    release   - drop the pages of the index from the page cache (posix_fadvise DONTNEED)
+    watch     - companion daemon prefetching upcoming indexes while the pipeline is running
+    summary   - page-cache hit rates computed from the logs
+"""
+
+CHUNK_SIZE = 2**24  # 16 MB
+DEFAULT_HEADROOM_MB = 2048
+
+LOG_HEADER = [
+    "action", "index", "size_bytes", "resident_before", "resident_after", "prefetched_bytes", "seconds",
+    "stopped_by_headroom"
+]
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def _get_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    return libc
+
+
+# translation table mapping every byte of the mincore vector to its lowest bit (= page is resident)
+_RESIDENT_BIT = bytes(i & 1 for i in range(256))
+
+
+def get_resident_fraction(fn):
+    """Fraction of the file pages that are currently in the page cache (via mincore).
+
+    Args:
+        fn (str): File name.
+
+    Returns:
+        fraction (float): Value between 0.0 and 1.0, or None if it cannot be determined on this platform.
+    """
+    size = os.path.getsize(fn)
+    if size == 0:
+        return 1.0
+    try:
+        libc = _get_libc()
+    except (OSError, AttributeError):
+        return None
+
+    npages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    vec = ctypes.create_string_buffer(npages)
+    fd = os.open(fn, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            return None
+        try:
+            if libc.mincore(addr, size, vec) != 0:
+                return None
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    resident = vec.raw.translate(_RESIDENT_BIT).count(1)
+    return resident / npages
+
+
+def get_available_RAM_in_MB():
+    """Available RAM as reported by the kernel (None if unknown).
+
+    MemAvailable counts the reclaimable page cache, including the pages of the indexes
+    prefetched so far, so the callers subtract them (see prefetch and watch).
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except FileNotFoundError:
+        pass
+    try:
+        import psutil
+        return psutil.virtual_memory().available // 2**20
+    except ImportError:
+        return None
+
+
+def _fadvise(fd, offset, length, advice_name):
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice_name))
+        return True
+    except (AttributeError, OSError):
+        # posix_fadvise is not available on all platforms (e.g., macOS)
+        return False
+
+
+def prefetch(fn, headroom_MB, resident_fraction=None, reserved_bytes=0):
+    """Read a file sequentially into the page cache while keeping `headroom_MB` of RAM available.
+
+    The pages of the file already resident or prefetched, and `reserved_bytes` (pages of other
+    files prefetched concurrently), are not counted as available RAM.
+
+    Returns:
+        (prefetched_bytes, stopped_by_headroom)
+    """
+    resident_fraction = resident_fraction or 0.0
+    resident_bytes = os.path.getsize(fn) * resident_fraction
+    prefetched = 0
+    stopped_by_headroom = False
+    with open(fn, "rb", buffering=0) as f:
+        fd = f.fileno()
+        _fadvise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+        buffer = bytearray(CHUNK_SIZE)
+        while True:
+            available_MB = get_available_RAM_in_MB()
+            # the chunks read so far were already resident in the same proportion as the whole file
+            cached_bytes = resident_bytes + prefetched * (1.0 - resident_fraction) + reserved_bytes
+            if available_MB is not None and available_MB - (cached_bytes + CHUNK_SIZE) // 2**20 < headroom_MB:
+                stopped_by_headroom = True
+                break
+            _fadvise(fd, prefetched, CHUNK_SIZE, "POSIX_FADV_WILLNEED")
+            n = f.readinto(buffer)
+            if not n:
+                break
+            prefetched += n
+        # COBS then accesses the index randomly
+        _fadvise(fd, 0, 0, "POSIX_FADV_RANDOM")
+    return prefetched, stopped_by_headroom
+
+
+def release(fn):
+    """Drop the pages of a file from the page cache."""
+    with open(fn, "rb") as f:
+        return _fadvise(f.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+
+
+def _format_fraction(x):
+    return "NA" if x is None else f"{x:.4f}"
+
+
+def log_action(log_fn, action, fn, resident_before, resident_after, prefetched_bytes, seconds, stopped_by_headroom):
+    values = [
+        action, fn,
+        os.path.getsize(fn),
+        _format_fraction(resident_before),
+        _format_fraction(resident_after), prefetched_bytes, f"{seconds:.3f}",
+        int(stopped_by_headroom)
+    ]
+    line = "\t".join(map(str, values))
+    if log_fn is None:
+        print(line)
+        return
+    log_fn = Path(log_fn)
+    log_fn.parent.mkdir(parents=True, exist_ok=True)
+    write_header = not log_fn.exists()
+    with open(log_fn, "a") as fo:
+        if write_header:
+            print("\t".join(LOG_HEADER), file=fo)
+        print(line, file=fo)
+
+
+def run_action(action, fn, headroom_MB, log_fn, reserved_bytes=0):
+    start = time.time()
+    resident_before = get_resident_fraction(fn)
+    prefetched_bytes = 0
+    stopped_by_headroom = False
+    if action == "prefetch":
+        prefetched_bytes, stopped_by_headroom = prefetch(fn, headroom_MB, resident_before, reserved_bytes)
+    elif action == "release":
+        if not release(fn):
+            error(f"Warning: posix_fadvise is not supported, pages of {fn} were not released")
+    resident_after = get_resident_fraction(fn)
+    seconds = time.time() - start
+    log_action(log_fn, action, fn, resident_before, resident_after, prefetched_bytes, seconds, stopped_by_headroom)
+
+
+def _is_benchmark_log_complete(fn):
+    # benchmark.py writes the header when the job starts and the statistics when it ends
+    with open(fn) as f:
+        return len([line for line in f if line.strip()]) >= 3
+
+
+def watch(index_dir, batches_fn, benchmarks_dir, threads, headroom_MB, interval, log_fn):
+    """Prefetch upcoming decompressed indexes and release the finished ones.
+
+    An index is upcoming if it is present in `index_dir` and its COBS job has not finished yet, and it is
+    finished once the COBS benchmark log in `benchmarks_dir` is complete. Indexes are prefetched in the order
+    of the batches.
+    """
+    with open(batches_fn) as fin:
+        batches = sorted(filter(len, map(str.strip, fin)))
+    index_dir = Path(index_dir)
+    benchmarks_dir = Path(benchmarks_dir)
+
+    prefetched = set()
+    released = set()
+    index_sizes = {}  # batch -> size of the indexes prefetched or being prefetched
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            finished = {
+                b for b in batches if any(map(_is_benchmark_log_complete, benchmarks_dir.glob(f"{b}____*.txt")))
+            }
+
+            for batch in sorted(finished - released - set(running)):
+                index_fn = index_dir / f"{batch}.cobs_classic"
+                if index_fn.exists():
+                    run_action("release", str(index_fn), headroom_MB, log_fn)
+                released.add(batch)
+
+            for batch, future in list(running.items()):
+                if future.done():
+                    future.result()
+                    prefetched.add(batch)
+                    del running[batch]
+
+            for batch in batches:
+                if len(running) >= threads:
+                    break
+                if batch in finished or batch in prefetched or batch in running:
+                    continue
+                index_fn = index_dir / f"{batch}.cobs_classic"
+                if not index_fn.exists():
+                    continue
+                # the prefetched indexes stay in the page cache until they are released
+                reserved_bytes = sum(size for b, size in index_sizes.items() if b not in released)
+                index_size = index_fn.stat().st_size
+                available_MB = get_available_RAM_in_MB()
+                if available_MB is not None and available_MB - (reserved_bytes + index_size) // 2**20 < headroom_MB:
+                    break
+                index_sizes[batch] = index_size
+                running[batch] = executor.submit(run_action, "prefetch", str(index_fn), headroom_MB, log_fn,
+                                                 reserved_bytes)
+
+            if len(finished) == len(batches) and not running:
+                break
+            time.sleep(interval)
+
+
+def summary(log_fns):
+    """Print size-weighted page-cache hit rates at the moment COBS started querying each index."""
+    stats = {}
+    for fn in log_fns:
+        with open(fn) as f:
+            header = f.readline().strip().split("\t")
+            for line in f:
+                r = dict(zip(header, line.strip().split("\t")))
+                if r["action"] == "release" or r["resident_after"] == "NA":
+                    continue
+                size = int(r["size_bytes"])
+                s = stats.setdefault(r["action"], [0, 0, 0.0, 0.0, 0])
+                s[0] += 1
+                s[1] += size
+                s[2] += size * float(r["resident_before"])
+                s[3] += size * float(r["resident_after"])
+                s[4] += int(r["prefetched_bytes"])
+    print("action", "indexes", "index_bytes", "hit_rate_before", "hit_rate_at_query", "prefetched_bytes", sep="\t")
+    for action, (n, size, before, after, prefetched_bytes) in sorted(stats.items()):
+        print(action, n, size, f"{before / size:.4f}", f"{after / size:.4f}", prefetched_bytes, sep="\t")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Page-cache management for decompressed COBS indexes")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    for action in ["residency", "prefetch", "release"]:
+        p = subparsers.add_parser(action)
+        p.add_argument('index', metavar='index.cobs_classic', help='decompressed COBS index')
+        p.add_argument('--headroom-mb',
+                       type=int,
+                       default=DEFAULT_HEADROOM_MB,
+                       help=f'available RAM (MB) to keep when prefetching [{DEFAULT_HEADROOM_MB}]')
+        p.add_argument('--log', default=None, help='TSV log to append to [stdout]')
+
+    p = subparsers.add_parser("watch")
+    p.add_argument('--index-dir', required=True, help='directory with decompressed COBS indexes')
+    p.add_argument('--batches', required=True, help='file with the list of batches')
+    p.add_argument('--benchmarks-dir',
+                   default="logs/benchmarks/run_cobs",
+                   help='directory with benchmark logs of COBS jobs [logs/benchmarks/run_cobs]')
+    p.add_argument('--threads', type=int, default=1, help='max. number of simultaneous prefetches [1]')
+    p.add_argument('--headroom-mb',
+                   type=int,
+                   default=DEFAULT_HEADROOM_MB,
+                   help=f'available RAM (MB) to keep [{DEFAULT_HEADROOM_MB}]')
+    p.add_argument('--interval', type=float, default=5.0, help='polling interval in seconds [5]')
+    p.add_argument('--log', default=None, help='TSV log to append to [stdout]')
+
+    p = subparsers.add_parser("summary")
+    p.add_argument('logs', nargs='+', help='TSV logs')
+
+    args = parser.parse_args()
+
+    if args.subcommand == "watch":
+        watch(args.index_dir, args.batches, args.benchmarks_dir, args.threads, args.headroom_mb, args.interval,
+              args.log)
+    elif args.subcommand == "summary":
+        summary(args.logs)
+    else:
+        run_action(args.subcommand, args.index, args.headroom_mb, args.log)
+
+
+if __name__ == "__main__":
+    main()
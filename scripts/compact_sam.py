@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+
+from xopen import xopen
+
+import fastx
+"""
+Compact SAM records: the query sequence (SEQ) is stored only once, in the query table (FASTA).
+
+In the compact format, the SEQ field of an alignment record is replaced by
+COMPACT_SEQ if it is the full query sequence (reverse-complemented for
+alignments to the reverse strand), i.e., if it can be reconstructed from the
+query table. Other records (e.g., hard-clipped supplementary alignments) are
+kept as is. All other fields are unchanged, so the aggregation and the
+statistics read the compact format natively.
+
+Subcommands:
+    expand  - convert compact records back to standard SAM-like lines
+"""
+
+COMPACT_SEQ = "~"
+
+COMPLEMENT = str.maketrans("ACGTacgtNn", "TGCAtgcaNn")
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def _get_expected_seq(flag, qseq):
+    return reverse_complement(qseq) if int(flag) & 16 else qseq
+
+
+def compact_sam_line(line, qname_to_qseq):
+    """Replace SEQ by COMPACT_SEQ if it can be reconstructed from the query sequence."""
+    p = line.split("\t")
+    if len(p) < 11 or p[9] == "*":
+        return line
+    qseq = qname_to_qseq.get(p[0])
+    if qseq is None or p[9] != _get_expected_seq(p[1], qseq):
+        return line
+    p[9] = COMPACT_SEQ
+    return "\t".join(p)
+
+
+def expand_sam_line(line, qname_to_qseq):
+    """Restore SEQ of a compact record."""
+    p = line.split("\t")
+    if len(p) < 11 or p[9] != COMPACT_SEQ:
+        return line
+    p[9] = _get_expected_seq(p[1], qname_to_qseq[p[0]])
+    return "\t".join(p)
+
+
+def load_query_seqs(query_fn):
+    """Load the query table (query name -> sequence) from a FASTA file."""
+    return {qname.decode(): seq.decode() for qname, _, seq, _ in fastx.iterate_over_records(query_fn)}
+
+
+def expand(query_fn, compact_fn):
+    qname_to_qseq = load_query_seqs(query_fn)
+    with xopen(compact_fn) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            # batch headers and empty lines are kept
+            if line and not line.startswith("==>"):
+                line = expand_sam_line(line, qname_to_qseq)
+            print(line)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compact SAM records (SEQ stored once in the query table)")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    p = subparsers.add_parser("expand", help="convert compact records to standard SAM-like lines")
+    p.add_argument('-q', dest='query_fn', metavar='queries.fa.gz', required=True, help='query table')
+    p.add_argument('compact_fn', metavar='output.sam_summary.gz', help='compact alignments (possibly gzipped)')
+
+    args = parser.parse_args()
+
+    expand(args.query_fn, args.compact_fn)
+
+
+if __name__ == "__main__":
+    main()
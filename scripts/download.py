@@ -0,0 +1,748 @@
+#! /usr/bin/env python3
+
+import argparse
+import hashlib
+import http.client
+import io
+import json
+import lzma
+import os
+import queue
+import random
+import shutil
+import signal
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from pathlib import Path
+"""
+Download a file with parallel ranged requests, resume after interruption, and verify it while it downloads.
+
+The file is downloaded into {output}.part, split into pieces of --piece-mb MB
+fetched by --connections parallel HTTP range requests (in order, so that the
+beginning of the file is complete first). The bytes received of every piece
+are recorded in {output}.part.json, so an interrupted download (killed job,
+dropped connection, retries exhausted) resumes where it stopped as long as the
+remote file did not change (same size and ETag/Last-Modified). Failed requests
+are retried with an exponential backoff (honoring Retry-After, e.g. when
+Zenodo throttles the requests). Servers that do not support ranges are
+downloaded with a single stream.
+
+The completed prefix of the file is verified while the download goes on: xz
+files are fully decompressed (all the streams, the integrity checks of xz
+included; the decompressed data is discarded) and the optional --checksum is
+computed. The file is moved to its final name only if it passes; a corrupted
+file is deleted (it would be resumed otherwise).
+
+Before the origin, the file (same name) is looked up in the --mirror
+locations, in order: local directories or file:// URLs (the file is copied,
+and verified), or http(s):// base URLs (downloaded as above, the origin is
+used if the mirror does not have the file or serves a corrupted one).
+
+SourceStream reads a file from the same sources (mirrors first) as a
+sequential stream, without storing it, or with a write-through copy (used by
+batch_align.py to map the assemblies as they download).
+
+Subcommands:
+    get     - download a file
+    verify  - verify local files (xz decompression, checksum)
+
+scripts/fake_tools/http_server is a local stand-in for the file server (ranges,
+dropped connections, throttling) to test the downloads.
+"""
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_PIECE_MB = 8
+DEFAULT_RETRIES = 5
+DEFAULT_RETRY_WAIT = 2.0
+DEFAULT_TIMEOUT = 60.0
+
+BLOCK_SIZE = 2**20
+STATE_SAVE_INTERVAL = 2.0
+MAX_RETRY_WAIT = 300.0
+
+USER_AGENT = "mof-search-downloader"
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class VerificationError(Exception):
+    pass
+
+
+##################################
+## Verification
+##################################
+
+
+class XzVerifier:
+    """Streaming check of an xz file (concatenated streams and stream padding included)."""
+
+    def __init__(self):
+        self.decompressor = None
+        self.in_stream = False
+        self.streams = 0
+        self.uncompressed_bytes = 0
+
+    def update(self, data):
+        try:
+            while data:
+                if not self.in_stream:
+                    # stream padding (null bytes) between and after the streams
+                    data = data.lstrip(b"\0")
+                    if not data:
+                        return
+                    self.decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+                    self.in_stream = True
+                self.uncompressed_bytes += len(self.decompressor.decompress(data, BLOCK_SIZE))
+                while not self.decompressor.eof and not self.decompressor.needs_input:
+                    self.uncompressed_bytes += len(self.decompressor.decompress(b"", BLOCK_SIZE))
+                data = b""
+                if self.decompressor.eof:
+                    self.streams += 1
+                    self.in_stream = False
+                    data = self.decompressor.unused_data
+        except lzma.LZMAError as e:
+            raise VerificationError(f"not a valid xz file ({e})")
+
+    def finish(self):
+        if self.in_stream or not self.streams:
+            raise VerificationError("truncated xz file")
+
+
+class Verifier:
+    """Verifies a file from its bytes, in order: xz decompression and/or checksum ("algorithm:hex")."""
+
+    def __init__(self, xz, checksum):
+        self.xz = XzVerifier() if xz else None
+        self.checksum = None
+        self.hasher = None
+        if checksum:
+            algorithm, _, self.checksum = checksum.partition(":")
+            self.hasher = hashlib.new(algorithm)
+        self.bytes = 0
+
+    def update(self, data):
+        self.bytes += len(data)
+        if self.xz is not None:
+            self.xz.update(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+    def finish(self):
+        if self.xz is not None:
+            self.xz.finish()
+        if self.hasher is not None and self.hasher.hexdigest() != self.checksum.lower():
+            raise VerificationError(f"{self.hasher.name} checksum mismatch (expected {self.checksum}, "
+                                    f"got {self.hasher.hexdigest()})")
+
+
+def verify_file(fn, verifier):
+    with open(fn, "rb") as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            verifier.update(data)
+    verifier.finish()
+
+
+##################################
+## HTTP
+##################################
+
+
+def open_url(url, timeout, start=None, end=None):
+    """Open a URL, optionally a range of bytes ([start, end), end=None for the rest of the file)."""
+    headers = {"User-Agent": USER_AGENT}
+    if start is not None:
+        headers["Range"] = f"bytes={start}-{end - 1 if end is not None else ''}"
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+
+
+def get_retry_wait(attempt, retry_wait, e=None):
+    """Exponential backoff with jitter, or the Retry-After of the server."""
+    if isinstance(e, urllib.error.HTTPError) and e.headers.get("Retry-After", "").isdigit():
+        return min(float(e.headers["Retry-After"]), MAX_RETRY_WAIT)
+    return min(retry_wait * 2**attempt, MAX_RETRY_WAIT) * random.uniform(0.5, 1.0)
+
+
+def is_retryable(e):
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code in (408, 425, 429) or e.code >= 500
+    return isinstance(e, (OSError, http.client.HTTPException, DownloadError))
+
+
+def call_with_retries(function, description, retries, retry_wait):
+    """Call function(), retried on network errors with an exponential backoff."""
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            if not is_retryable(e) or attempt >= retries:
+                raise
+            wait = get_retry_wait(attempt, retry_wait, e)
+            error(f"{description} failed ({e}), retrying in {wait:.0f} s")
+            time.sleep(wait)
+            attempt += 1
+
+
+def probe(url, timeout):
+    """Size, validator (ETag or Last-Modified) and range support of a remote file.
+
+    Returns:
+        (size or None, validator, response) - the response is the full file if the server does not support
+        ranges (to be used as a single stream), else None
+    """
+    response = open_url(url, timeout, 0, 1)
+    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    if response.status == 206:
+        content_range = response.headers.get("Content-Range", "")
+        response.close()
+        total = content_range.rpartition("/")[2]
+        if total.isdigit():
+            return int(total), validator, None
+        # unknown size, download with a single stream
+        return None, validator, open_url(url, timeout)
+    length = response.headers.get("Content-Length")
+    return int(length) if length is not None else None, validator, response
+
+
+##################################
+## Download
+##################################
+
+
+class Download:
+    """Download of a URL into {output}.part, with its state in {output}.part.json."""
+
+    def __init__(self, url, output_fn, verifier, connections, piece_size, retries, retry_wait, timeout):
+        self.url = url
+        self.output_fn = Path(output_fn)
+        self.part_fn = Path(f"{output_fn}.part")
+        self.state_fn = Path(f"{output_fn}.part.json")
+        self.verifier = verifier
+        self.connections = connections
+        self.piece_size = piece_size
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        self.failure = None
+        self.done = []
+        self.pieces = []
+
+    def _load_state(self, size, validator):
+        """Bytes received of every piece from a previous attempt (all zeros if it cannot be resumed)."""
+        nb_pieces = (size + self.piece_size - 1) // self.piece_size
+        fresh = [0] * nb_pieces
+        if not self.state_fn.exists() or not self.part_fn.exists():
+            return fresh
+        try:
+            with open(self.state_fn) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return fresh
+        if (state.get("url"), state.get("size"), state.get("validator"),
+                state.get("piece_size")) != (self.url, size, validator, self.piece_size):
+            error(f"The remote file changed since the previous attempt, restarting the download of {self.url}")
+            return fresh
+        if len(state.get("done", [])) != nb_pieces or self.part_fn.stat().st_size != size:
+            return fresh
+        return state["done"]
+
+    def _save_state(self, size, validator):
+        with self.lock:
+            state = {
+                "url": self.url,
+                "size": size,
+                "validator": validator,
+                "piece_size": self.piece_size,
+                "done": list(self.done),
+            }
+        tmp_fn = f"{self.state_fn}.tmp"
+        with open(tmp_fn, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_fn, self.state_fn)
+
+    def _remove_partial(self):
+        for fn in [self.part_fn, self.state_fn]:
+            if fn.exists():
+                fn.unlink()
+
+    def _fetch_piece(self, fd, i):
+        start, end = self.pieces[i]
+        attempt = 0
+        while True:
+            offset = start + self.done[i]
+            if offset >= end:
+                return
+            request_offset = offset
+            try:
+                with open_url(self.url, self.timeout, offset, end) as response:
+                    if response.status != 206:
+                        raise DownloadError(f"range request answered with HTTP {response.status}")
+                    while offset < end:
+                        if self.failure is not None:
+                            # another piece failed, or the download was interrupted
+                            return
+                        data = response.read(min(BLOCK_SIZE, end - offset))
+                        if not data:
+                            raise DownloadError(f"connection closed at byte {offset} of [{start}, {end})")
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                        with self.lock:
+                            # recorded after the write: the state never claims bytes that are not in the file
+                            self.done[i] = offset - start
+                            self.lock.notify_all()
+                return
+            except Exception as e:
+                if offset > request_offset:
+                    # the connection dropped after some progress, only consecutive failures count
+                    attempt = 0
+                if not is_retryable(e) or attempt >= self.retries:
+                    raise
+                wait = get_retry_wait(attempt, self.retry_wait, e)
+                error(f"Request of bytes [{offset}, {end}) of {self.url} failed ({e}), retrying in {wait:.0f} s")
+                with self.lock:
+                    if self.lock.wait_for(lambda: self.failure is not None, wait):
+                        return
+                attempt += 1
+
+    def _worker(self, fd, pieces_queue):
+        while self.failure is None:
+            try:
+                i = pieces_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._fetch_piece(fd, i)
+            except Exception as e:
+                with self.lock:
+                    self.failure = e
+                    self.lock.notify_all()
+                return
+
+    def _contiguous_end(self):
+        """End of the completed prefix of the file (called with the lock)."""
+        for (start, end), done in zip(self.pieces, self.done):
+            if start + done < end:
+                return start + done
+        return self.pieces[-1][1] if self.pieces else 0
+
+    def _run_ranged(self, size, validator):
+        self.pieces = [(start, min(start + self.piece_size, size)) for start in range(0, size, self.piece_size)]
+        self.done = self._load_state(size, validator)
+        resumed = sum(self.done)
+        if resumed:
+            error(f"Resuming the download of {self.url} at {resumed / 2**20:.1f} of {size / 2**20:.1f} MB")
+        with open(self.part_fn, "r+b" if resumed else "wb") as f:
+            f.truncate(size)
+        self._save_state(size, validator)
+
+        pieces_queue = queue.Queue()
+        for i, (start, end) in enumerate(self.pieces):
+            if start + self.done[i] < end:
+                pieces_queue.put(i)
+        fd = os.open(self.part_fn, os.O_RDWR)
+        workers = [
+            threading.Thread(target=self._worker, args=(fd, pieces_queue), daemon=True)
+            for _ in range(min(self.connections, max(pieces_queue.qsize(), 1)))
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            # verify the completed prefix of the file while the pieces are downloaded
+            verified = 0
+            last_save = time.monotonic()
+            while verified < size:
+                with self.lock:
+                    while self._contiguous_end() == verified and self.failure is None:
+                        self.lock.wait(STATE_SAVE_INTERVAL)
+                        if time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+                            break
+                    failure = self.failure
+                    available = self._contiguous_end()
+                if failure is not None:
+                    raise failure
+                while verified < available:
+                    data = os.pread(fd, min(BLOCK_SIZE, available - verified), verified)
+                    self.verifier.update(data)
+                    verified += len(data)
+                if time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+                    self._save_state(size, validator)
+                    last_save = time.monotonic()
+        except BaseException as e:
+            # stop the workers, and keep what was received for the next attempt (unless it is corrupted)
+            with self.lock:
+                self.failure = self.failure or e
+                self.lock.notify_all()
+            for worker in workers:
+                worker.join()
+            if not isinstance(e, VerificationError):
+                self._save_state(size, validator)
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            os.close(fd)
+        self.verifier.finish()
+
+    def _run_stream(self, response, size):
+        with response, open(self.part_fn, "wb") as f:
+            while True:
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                self.verifier.update(data)
+        if size is not None and self.verifier.bytes != size:
+            raise DownloadError(f"truncated download ({self.verifier.bytes} of {size} bytes)")
+        self.verifier.finish()
+
+    def run(self):
+        size, validator, response = call_with_retries(lambda: probe(self.url, self.timeout), f"Request of {self.url}",
+                                                      self.retries, self.retry_wait)
+        try:
+            if response is None:
+                self._run_ranged(size, validator)
+            else:
+                error(f"The server does not support ranges, downloading {self.url} with a single stream")
+                self._run_stream(response, size)
+        except VerificationError:
+            self._remove_partial()
+            raise
+        except DownloadError:
+            if response is not None:
+                self._remove_partial()
+            raise
+        os.replace(self.part_fn, self.output_fn)
+        if self.state_fn.exists():
+            self.state_fn.unlink()
+
+
+def get_local_mirror_path(mirror, name):
+    """Path of the file in a local mirror (directory or file:// URL), None for remote mirrors."""
+    if mirror.startswith("file://"):
+        return Path(urllib.parse.unquote(urllib.parse.urlparse(mirror).path), name)
+    if "://" in mirror:
+        return None
+    return Path(mirror, name)
+
+
+def copy_from_mirror(mirror_fn, output_fn, verifier):
+    part_fn = Path(f"{output_fn}.part")
+    try:
+        with open(mirror_fn, "rb") as fin, open(part_fn, "wb") as fout:
+            while True:
+                data = fin.read(BLOCK_SIZE)
+                if not data:
+                    break
+                fout.write(data)
+                verifier.update(data)
+        verifier.finish()
+    except BaseException:
+        part_fn.unlink()
+        raise
+    shutil.copystat(mirror_fn, part_fn)
+    os.replace(part_fn, output_fn)
+
+
+def download(url, output_fn, mirrors, xz, checksum, connections, piece_mb, retries, retry_wait, timeout):
+    name = Path(urllib.parse.unquote(urllib.parse.urlparse(url).path)).name
+    Path(output_fn).parent.mkdir(parents=True, exist_ok=True)
+
+    for mirror in mirrors:
+        mirror_fn = get_local_mirror_path(mirror, name)
+        try:
+            if mirror_fn is not None:
+                if not mirror_fn.is_file():
+                    continue
+                error(f"Copying {mirror_fn} to {output_fn}")
+                copy_from_mirror(mirror_fn, output_fn, Verifier(xz, checksum))
+            else:
+                mirror_url = f"{mirror.rstrip('/')}/{urllib.parse.quote(name)}"
+                error(f"Downloading {mirror_url} to {output_fn}")
+                Download(mirror_url, output_fn, Verifier(xz, checksum), connections, piece_mb * 2**20, retries,
+                         retry_wait, timeout).run()
+            return
+        except VerificationError as e:
+            error(f"Corrupted file in the mirror {mirror} ({e}), trying the next source")
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                error(f"Download from the mirror {mirror} failed ({e}), trying the next source")
+        except (DownloadError, OSError, http.client.HTTPException) as e:
+            error(f"Download from the mirror {mirror} failed ({e}), trying the next source")
+
+    error(f"Downloading {url} to {output_fn}")
+    Download(url, output_fn, Verifier(xz, checksum), connections, piece_mb * 2**20, retries, retry_wait, timeout).run()
+
+
+##################################
+## Streaming
+##################################
+
+
+class SourceStream(io.RawIOBase):
+    """Sequential stream of a file from its mirrors or its URL, e.g. for tarfile.open(fileobj=..., mode="r|xz").
+
+    The first mirror having the file is used, else the URL. The data is read by a
+    background thread up to buffer_size bytes ahead of the consumer, so that the
+    download overlaps with the processing of the data; a dropped connection is
+    resumed with a range request. With copy_fn, the file is also written to
+    copy_fn as it is read (write-through copy), and moved into place only if it
+    is complete and verified; the rest of the file is read when the stream is
+    closed.
+    """
+
+    def __init__(self,
+                 url,
+                 mirrors=(),
+                 copy_fn=None,
+                 buffer_size=64 * 2**20,
+                 retries=DEFAULT_RETRIES,
+                 retry_wait=DEFAULT_RETRY_WAIT,
+                 timeout=DEFAULT_TIMEOUT):
+        super().__init__()
+        self.url = url
+        self.name = Path(urllib.parse.unquote(urllib.parse.urlparse(url).path)).name
+        self.copy_fn = copy_fn
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.timeout = timeout
+        self.source, self.size, self.fh = self._open_source(mirrors)
+        if copy_fn is not None:
+            Path(copy_fn).parent.mkdir(parents=True, exist_ok=True)
+        self.queue = queue.Queue(maxsize=max(buffer_size // BLOCK_SIZE, 1))
+        self.stopped = threading.Event()
+        self.thread = None
+        self.failure = None
+        self.buffer = memoryview(b"")
+        self.eof = False
+
+    def _open_url(self, url, offset=0):
+        response = call_with_retries(lambda: open_url(url, self.timeout, offset if offset else None),
+                                     f"Request of {url}", self.retries, self.retry_wait)
+        if offset and response.status != 206:
+            response.close()
+            raise DownloadError(f"cannot resume {url} at byte {offset}, the server does not support ranges")
+        return response
+
+    def _open_source(self, mirrors):
+        """(source, size or None, open file or HTTP response)"""
+        for mirror in mirrors:
+            mirror_fn = get_local_mirror_path(mirror, self.name)
+            if mirror_fn is not None:
+                if mirror_fn.is_file():
+                    return str(mirror_fn), mirror_fn.stat().st_size, open(mirror_fn, "rb")
+                continue
+            mirror_url = f"{mirror.rstrip('/')}/{urllib.parse.quote(self.name)}"
+            try:
+                response = self._open_url(mirror_url)
+            except urllib.error.HTTPError as e:
+                if e.code != 404:
+                    error(f"Download from the mirror {mirror} failed ({e}), trying the next source")
+                continue
+            except (DownloadError, OSError, http.client.HTTPException) as e:
+                error(f"Download from the mirror {mirror} failed ({e}), trying the next source")
+                continue
+            length = response.headers.get("Content-Length")
+            return mirror_url, int(length) if length is not None else None, response
+        response = self._open_url(self.url)
+        length = response.headers.get("Content-Length")
+        return self.url, int(length) if length is not None else None, response
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def _read_source(self):
+        """Read the source into the queue (and the copy), b"" marks the end of the file and None a failure."""
+        copy_part_fn = Path(f"{self.copy_fn}.{os.getpid()}.part") if self.copy_fn is not None else None
+        verifier = Verifier(self.name.endswith(".xz"), None)
+        offset = 0
+        attempt = 0
+        try:
+            with open(copy_part_fn, "wb") if copy_part_fn is not None else open(os.devnull, "wb") as copy:
+                while not self.stopped.is_set():
+                    try:
+                        data = self.fh.read(BLOCK_SIZE)
+                        if not data and self.size is not None and offset < self.size:
+                            raise DownloadError(f"connection closed at byte {offset} of {self.size}")
+                    except (DownloadError, OSError, http.client.HTTPException) as e:
+                        if not isinstance(self.fh, http.client.HTTPResponse) or attempt >= self.retries:
+                            raise
+                        wait = get_retry_wait(attempt, self.retry_wait, e)
+                        error(f"Download of {self.source} failed ({e}), resuming in {wait:.0f} s")
+                        time.sleep(wait)
+                        attempt += 1
+                        self.fh.close()
+                        self.fh = self._open_url(self.source, offset)
+                        continue
+                    attempt = 0
+                    if not data:
+                        break
+                    offset += len(data)
+                    if copy_part_fn is not None:
+                        copy.write(data)
+                        verifier.update(data)
+                    self._put(data)
+            if copy_part_fn is not None and not self.stopped.is_set():
+                verifier.finish()
+                os.replace(copy_part_fn, self.copy_fn)
+                copy_part_fn = None
+            self._put(b"")
+        except BaseException as e:
+            self.failure = e
+            self._put(None)
+        finally:
+            self.fh.close()
+            if copy_part_fn is not None and copy_part_fn.exists():
+                copy_part_fn.unlink()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            if self.eof:
+                return 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._read_source, daemon=True)
+                self.thread.start()
+            data = self.queue.get()
+            if data is None:
+                raise DownloadError(f"download of {self.source} failed ({self.failure})")
+            if not data:
+                self.eof = True
+                return 0
+            self.buffer = memoryview(data)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.copy_fn is not None and self.failure is None:
+                # complete the copy
+                while self.read(BLOCK_SIZE):
+                    pass
+        except DownloadError as e:
+            error(f"The copy of {self.source} to {self.copy_fn} is incomplete ({e}), not kept")
+        finally:
+            self.stopped.set()
+            if self.thread is not None:
+                self.thread.join(timeout=self.timeout)
+            else:
+                self.fh.close()
+            super().close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Parallel, resumable and verified downloads")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    p = subparsers.add_parser("get")
+    p.add_argument('url', help='URL of the file')
+    p.add_argument('output', help='output file')
+    p.add_argument('--mirror',
+                   metavar='dir|url',
+                   action='append',
+                   default=[],
+                   help='directory, file:// or http(s):// base URL where the file (same name) is looked up first '
+                   '(can be repeated)')
+    p.add_argument('--checksum', metavar='algorithm:hex', default=None, help='expected checksum, e.g. md5:9e10...')
+    p.add_argument('--no-xz-check',
+                   dest='xz',
+                   action='store_false',
+                   help='do not verify the decompression of .xz files')
+    p.add_argument('--connections',
+                   metavar='int',
+                   type=int,
+                   default=DEFAULT_CONNECTIONS,
+                   help=f'parallel range requests [{DEFAULT_CONNECTIONS}]')
+    p.add_argument('--piece-mb',
+                   metavar='int',
+                   type=int,
+                   default=DEFAULT_PIECE_MB,
+                   help=f'size of the pieces requested [{DEFAULT_PIECE_MB}]')
+    p.add_argument('--retries',
+                   metavar='int',
+                   type=int,
+                   default=DEFAULT_RETRIES,
+                   help=f'retries of a failed request [{DEFAULT_RETRIES}]')
+    p.add_argument('--retry-wait',
+                   metavar='float',
+                   type=float,
+                   default=DEFAULT_RETRY_WAIT,
+                   help=f'seconds before the first retry, doubled at every retry [{DEFAULT_RETRY_WAIT}]')
+    p.add_argument('--timeout',
+                   metavar='float',
+                   type=float,
+                   default=DEFAULT_TIMEOUT,
+                   help=f'seconds without data before a request fails [{DEFAULT_TIMEOUT}]')
+    p.add_argument('--sleep',
+                   metavar='int',
+                   type=int,
+                   default=0,
+                   help='seconds to wait before starting (previous attempts of the job failed) [0]')
+
+    p = subparsers.add_parser("verify")
+    p.add_argument('files', metavar='file', nargs='+', help='files to verify')
+    p.add_argument('--checksum', metavar='algorithm:hex', default=None, help='expected checksum')
+
+    args = parser.parse_args()
+
+    if args.subcommand == "verify":
+        code = 0
+        for fn in args.files:
+            try:
+                verify_file(fn, Verifier(fn.endswith(".xz"), args.checksum))
+                error(f"{fn}: OK")
+            except VerificationError as e:
+                error(f"{fn}: {e}")
+                code = 1
+        sys.exit(code)
+
+    # an interrupted download saves its state (to be resumed) before exiting
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    if args.sleep:
+        error("Detected previous failed downloads, probably Zenodo blocking downloads.")
+        error(f"Now sleeping for {args.sleep} seconds before retrying...")
+        time.sleep(args.sleep)
+    try:
+        download(args.url, args.output, args.mirror, args.xz and args.url.endswith(".xz"), args.checksum,
+                 args.connections, args.piece_mb, args.retries, args.retry_wait, args.timeout)
+    except VerificationError as e:
+        error(f"Download of {args.url} is corrupted ({e}), deleted")
+        sys.exit(2)
+    except (DownloadError, OSError, http.client.HTTPException) as e:
+        error(f"Download of {args.url} failed ({e})")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        error(f"Download of {args.url} interrupted")
+        sys.exit(1)
+    error(f"Verified that {args.output} is complete and consistent")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+import argparse
+import re
+import sys
+
+import compact_sam
+import fastx
+"""
+Exact-containment fast path of the mapping (exact_fast_path).
+
+Queries whose COBS k-mer count equals all their k-mers (e.g., gene panels or
+high-quality reads) are typically contained exactly in the reference. For
+such queries, a minimap2 run is not needed: all the candidate queries of a
+reference (and their reverse complements) are searched at once. All their
+seeds (substrings of length seed_len) are put in a table, and the reference is
+sampled every w = min_len - seed_len + 1 positions, so that every exact
+occurrence of a query contains at least one sampled seed. Every seed hit is
+then verified by comparing the whole query.
+
+Only a query contained exactly once in the reference (on either strand) gets
+a record here. Other queries (no exact occurrence, several occurrences,
+shorter than MIN_QUERY_LEN, with non-ACGT bases, which minimap2 counts as
+mismatches even against the same base) are left to minimap2.
+
+The record has the same QNAME, FLAG, RNAME, POS, CIGAR ("=" or "M") and SEQ
+as the primary alignment of minimap2, but it is not identical to it:
+
+    - MAPQ is always 60: a single exact occurrence does not rule out
+      near-identical copies elsewhere, for which minimap2 lowers the MAPQ
+      (down to 0) and reports secondary alignments, which are missing here;
+    - the only tags are NM:i:0 and tp:A:P (no AS, ms, nn, cm, s1, de, rl).
+
+Downstream, the queries of repeats can therefore have different MAPQs and
+fewer alignments depending on the path they took; exact_fast_path is off by
+default for this reason.
+"""
+
+MAX_SEED_LEN = 32
+
+# shorter queries are not searched (too short seeds give too many spurious hits)
+MIN_QUERY_LEN = 32
+
+EXACT_HIT_MAPQ = 60
+
+NON_ACGT = re.compile("[^ACGT]")
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def iterate_over_contigs(rfa):
+    """Iterate over (contig name, upper-case sequence) of a FASTA file given as bytes."""
+    for name, _, seq, _ in fastx.parse_fasta(rfa):
+        yield name.decode(), seq.upper()
+
+
+def find_exact_occurrences(rfa, qname_to_qseq):
+    """Find the exact occurrences of queries in a reference.
+
+    Args:
+        rfa (bytes): Reference FASTA.
+        qname_to_qseq (dict): qname -> query sequence (upper case) of the candidate queries.
+
+    Returns:
+        dict: qname -> set of (contig name, 0-based position, is_reverse).
+    """
+    patterns = []
+    for qname, qseq in qname_to_qseq.items():
+        if len(qseq) < MIN_QUERY_LEN or NON_ACGT.search(qseq):
+            continue
+        patterns.append((qname, qseq.encode(), False))
+        patterns.append((qname, compact_sam.reverse_complement(qseq).encode(), True))
+    occurrences = {qname: set() for qname, _, _ in patterns}
+    if not patterns:
+        return occurrences
+
+    min_len = min(len(pattern) for _, pattern, _ in patterns)
+    seed_len = min(MAX_SEED_LEN, min_len // 2)
+    step = min_len - seed_len + 1
+    seed_to_hits = {}
+    for pattern_id, (_, pattern, _) in enumerate(patterns):
+        for offset in range(len(pattern) - seed_len + 1):
+            seed_to_hits.setdefault(pattern[offset:offset + seed_len], []).append((pattern_id, offset))
+
+    for contig, seq in iterate_over_contigs(rfa):
+        for sampled_pos in range(0, len(seq) - seed_len + 1, step):
+            for pattern_id, offset in seed_to_hits.get(seq[sampled_pos:sampled_pos + seed_len], ()):
+                qname, pattern, is_reverse = patterns[pattern_id]
+                pos = sampled_pos - offset
+                if pos >= 0 and seq.startswith(pattern, pos):
+                    # an occurrence may contain several sampled seeds
+                    occurrences[qname].add((contig, pos, is_reverse))
+    return occurrences
+
+
+def exact_hit_record(qname, qseq, contig, pos, is_reverse, eqx):
+    """SAM record of a full-length exact hit (the primary alignment of minimap2, with MAPQ 60 and only NM and tp)."""
+    cigar = f"{len(qseq)}{'=' if eqx else 'M'}"
+    seq = compact_sam.reverse_complement(qseq) if is_reverse else qseq
+    return "\t".join([
+        qname,
+        "16" if is_reverse else "0",
+        contig,
+        str(pos + 1),
+        str(EXACT_HIT_MAPQ),
+        cigar,
+        "*",
+        "0",
+        "0",
+        seq,
+        "*",
+        "NM:i:0",
+        "tp:A:P",
+    ])
+
+
+def map_exact_hits(rfa, qnames, qname_to_qseq, eqx):
+    """Compute the records of the queries contained exactly once in a reference.
+
+    Returns:
+        (list, list): SAM records of the exact hits, and the queries left to minimap2.
+    """
+    occurrences = find_exact_occurrences(rfa, {qname: qname_to_qseq[qname] for qname in qnames})
+    records = []
+    remaining_qnames = []
+    for qname in qnames:
+        hits = occurrences.get(qname, ())
+        if len(hits) == 1:
+            records.append(exact_hit_record(qname, qname_to_qseq[qname], *next(iter(hits)), eqx))
+        else:
+            remaining_qnames.append(qname)
+    return records, remaining_qnames
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Records of the queries contained exactly once in a reference")
+
+    parser.add_argument(
+        'ref_fn',
+        metavar='reference.fa',
+        help='reference FASTA',
+    )
+
+    parser.add_argument(
+        'query_fn',
+        metavar='queries.fa',
+        help='queries (FASTA)',
+    )
+
+    parser.add_argument(
+        '--eqx',
+        action='store_true',
+        default=False,
+        help='use "=" instead of "M" in the CIGAR (as minimap2 --eqx)',
+    )
+
+    args = parser.parse_args()
+
+    with open(args.ref_fn, "rb") as f:
+        rfa = f.read()
+    qname_to_qseq = {qname: qseq.upper() for qname, qseq in compact_sam.load_query_seqs(args.query_fn).items()}
+    records, remaining_qnames = map_exact_hits(rfa, list(qname_to_qseq), qname_to_qseq, args.eqx)
+    for record in records:
+        print(record)
+    error(f"{len(records)} exact hits, {len(remaining_qnames)} queries left to minimap2")
+
+
+if __name__ == "__main__":
+    main()
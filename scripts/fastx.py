@@ -0,0 +1,145 @@
+from itertools import repeat
+
+from xopen import xopen
+"""
+FASTA/FASTQ parser shared by the scripts.
+
+Files are read in large chunks of bytes (decompressed by xopen, in a separate
+thread/process for gz and xz files) and every chunk is split into records at
+once, instead of reading and decoding line by line. A record is a tuple of
+bytes (name, comment, seq, qual), where the name and the comment are the parts
+of the header before and after the first space, and qual is None for FASTA.
+Sequences of FASTA records can span several lines; FASTQ records must have
+the sequence and the qualities on single lines (as written by all current
+tools).
+
+    for name, comment, seq, qual in fastx.iterate_over_records("reads.fq.gz"):
+        ...
+
+    for records in fastx.iterate_over_batches("reads.fq.gz"):  # a list of records per chunk
+        ...
+"""
+
+CHUNK_SIZE = 2**22
+
+
+def _parse_single_line_fasta(buf):
+    """Parse FASTA records with single-line sequences (e.g., the intermediate files), or return None."""
+    lines = buf.split(b"\n")
+    if not lines[-1]:
+        lines.pop()
+    headers, seqs = lines[0::2], lines[1::2]
+    if len(headers) != len(seqs) or not all(map(bytes.startswith, headers, repeat(b">"))) \
+            or any(map(bytes.startswith, seqs, repeat(b">"))):
+        return None
+    return [(name[1:], comment, seq, None)
+            for (name, _, comment), seq in zip(map(bytes.partition, headers, repeat(b" ")), seqs)]
+
+
+def parse_fasta(buf):
+    """Parse complete FASTA records from bytes.
+
+    Returns:
+        list: (name, comment, seq, None) of every record.
+    """
+    start = buf.find(b">")
+    if start == -1:
+        return []
+    if b"\r" in buf:
+        buf = buf.replace(b"\r", b"")
+    if start == 0:
+        records = _parse_single_line_fasta(buf)
+        if records is not None:
+            return records
+    records = []
+    for record in buf[start + 1:].split(b"\n>"):
+        header, _, seq = record.partition(b"\n")
+        name, _, comment = header.partition(b" ")
+        if b"\n" in seq:
+            seq = seq.replace(b"\n", b"")
+        records.append((name, comment, seq, None))
+    return records
+
+
+def parse_fastq(lines):
+    """Parse FASTQ records from a list of lines (bytes) whose length is a multiple of 4.
+
+    Returns:
+        list: (name, comment, seq, qual) of every record.
+    """
+    headers, seqs, pluses, quals = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    if not all(header[:1] == b"@" for header in headers) or not all(plus[:1] == b"+" for plus in pluses) \
+            or list(map(len, seqs)) != list(map(len, quals)):
+        raise ValueError(f"Invalid or multi-line FASTQ record near {headers[0][:100]!r}")
+    return [(name[1:], comment, seq, qual)
+            for (name, _, comment), seq, qual in zip((header.partition(b" ") for header in headers), seqs, quals)]
+
+
+def _iterate_over_fasta_batches(f, buf, chunk_size):
+    # chunks are joined only once they contain a record boundary (a long record can span several chunks)
+    pending = [buf]
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        has_boundary = chunk.rfind(b"\n>") != -1 or (pending[-1][-1:] == b"\n" and chunk[:1] == b">")
+        pending.append(chunk)
+        if not has_boundary:
+            continue
+        buf = b"".join(pending)
+        # the last record may be incomplete
+        end = buf.rfind(b"\n>")
+        yield parse_fasta(buf[:end + 1])
+        pending = [buf[end + 1:]]
+    buf = b"".join(pending)
+    if buf.strip():
+        yield parse_fasta(buf)
+
+
+def _iterate_over_fastq_batches(f, buf, chunk_size):
+    buf = buf.replace(b"\r", b"")
+    while True:
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf += chunk.replace(b"\r", b"") if b"\r" in chunk else chunk
+        lines = buf.split(b"\n")
+        if eof:
+            while lines and not lines[-1].strip():
+                lines.pop()
+            if len(lines) % 4:
+                raise ValueError("Truncated or multi-line FASTQ file")
+            if lines:
+                yield parse_fastq(lines)
+            break
+        # the last line may be incomplete
+        nb_complete = (len(lines) - 1) // 4 * 4
+        if nb_complete:
+            yield parse_fastq(lines[:nb_complete])
+            buf = b"\n".join(lines[nb_complete:])
+
+
+def read_batches(f, chunk_size=CHUNK_SIZE):
+    """Iterate over lists of records of a FASTA or FASTQ binary file object (one list per chunk of the file)."""
+    buf = b""
+    while not buf.strip():
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+    buf = buf.lstrip()
+    if buf[:1] == b"@":
+        yield from _iterate_over_fastq_batches(f, buf, chunk_size)
+    else:
+        yield from _iterate_over_fasta_batches(f, buf, chunk_size)
+
+
+def iterate_over_batches(fn, chunk_size=CHUNK_SIZE, threads=None):
+    """Iterate over lists of records of a FASTA or FASTQ file, possibly compressed (one list per chunk of the file)."""
+    with xopen(fn, "rb", threads=threads) as f:
+        yield from read_batches(f, chunk_size)
+
+
+def iterate_over_records(fn, chunk_size=CHUNK_SIZE, threads=None):
+    """Iterate over the records (name, comment, seq, qual) of a FASTA or FASTQ file, possibly compressed."""
+    for records in iterate_over_batches(fn, chunk_size, threads):
+        yield from records
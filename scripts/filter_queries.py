@@ -13,6 +13,8 @@ from pathlib import Path
 from xopen import xopen
 from pprint import pprint
 
+import fastx
+
 DEFAULT_KEEP = 100
 """
 For every read we want to know top 100 matches
@@ -63,43 +65,9 @@ def cobs_iterator(cobs_matches_fn):
                 tmp_name, kmers = x.split()
                 rid, ref = tmp_name.split("_")
                 matches_buffer.append((ref, kmers))
-    yield qname, batch, matches_buffer
-
-
-def readfq(fp):  # this is a generator function
-    # From https://github.com/lh3/readfq/blob/master/readfq.py
-    last = None  # this is a buffer keeping the last unprocessed line
-    while True:  # mimic closure; is it a bad idea?
-        if not last:  # the first record or a record following a fastq
-            for l in fp:  # search for the start of the next record
-                if l[0] in '>@':  # fasta/q header line
-                    last = l[:-1]  # save this line
-                    break
-        if not last:
-            break
-        name, seqs, last = last[1:].partition(" ")[0], [], None
-        for l in fp:  # read the sequence
-            if l[0] in '@+>':
-                last = l[:-1]
-                break
-            seqs.append(l[:-1])
-        if not last or last[0] != '+':  # this is a fasta record
-            yield name, ''.join(seqs), None  # yield a fasta record
-            if not last:
-                break
-        else:  # this is a fastq record
-            seq, leng, seqs = ''.join(seqs), 0, []
-            for l in fp:  # read the quality
-                seqs.append(l[:-1])
-                leng += len(l) - 1
-                if leng >= len(seq):  # have read enough quality
-                    last = None
-                    yield name, seq, ''.join(seqs)
-                    # yield a fastq record
-                    break
-            if last:  # reach EOF before reading enough quality
-                yield name, seq, None  # yield a fasta record instead
-                break
+    # an empty output (e.g., all the queries were found in the result cache) has no query
+    if qname is not None:
+        yield qname, batch, matches_buffer
 
 
 class SingleQuery:
@@ -169,9 +137,9 @@ class Sift:
     @staticmethod
     def _create_query_dict(fx_fn, keep_matches):
         d = collections.OrderedDict()
-        with xopen(fx_fn) as fo:
-            for qname, seq, _ in readfq(fo):
-                d[qname] = SingleQuery(qname=qname, keep_matches=keep_matches, seq=seq)
+        for qname, _, seq, _ in fastx.iterate_over_records(fx_fn):
+            qname = qname.decode()
+            d[qname] = SingleQuery(qname=qname, keep_matches=keep_matches, seq=seq.decode())
         #pprint(d)
         return d
 
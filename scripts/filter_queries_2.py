@@ -13,6 +13,8 @@ from pathlib import Path
 from xopen import xopen
 from pprint import pprint
 
+import fastx
+
 DEFAULT_KEEP = 100
 """
 For every read we want to know top 100 matches
@@ -23,28 +25,7 @@ Approach:
     - keep just top k scores
 """
 
-BUFFER_SIZE = 1000
-
-
-def bufferize(func):
-
-    def wrapper(*args, **kwargs):
-        it = func(*args, **kwargs)
-        buffer = []
-        for i, x in enumerate(it, start=1):
-            buffer.append(x)
-            if i % BUFFER_SIZE == 0:
-                for y in buffer:
-                    yield y
-                buffer = []
-
-        for y in buffer:
-            yield y
 
-    return wrapper
-
-
-@bufferize
 def cobs_iterator(cobs_matches_fn):
     """Iterator for cobs matches.
 
@@ -87,42 +68,9 @@ def cobs_iterator(cobs_matches_fn):
     yield qname, batch, matches_buffer
 
 
-@bufferize
-def fa_iterator(fn):  # this is a generator function
-    with open(fn) as fp:
-        # From https://github.com/lh3/readfq/blob/master/readfq.py
-        last = None  # this is a buffer keeping the last unprocessed line
-        while True:  # mimic closure; is it a bad idea?
-            if not last:  # the first record or a record following a fastq
-                for l in fp:  # search for the start of the next record
-                    if l[0] in '>@':  # fasta/q header line
-                        last = l[:-1]  # save this line
-                        break
-            if not last:
-                break
-            name, seqs, last = last[1:].partition(" ")[0], [], None
-            for l in fp:  # read the sequence
-                if l[0] in '@+>':
-                    last = l[:-1]
-                    break
-                seqs.append(l[:-1])
-            if not last or last[0] != '+':  # this is a fasta record
-                yield name, ''.join(seqs), None  # yield a fasta record
-                if not last:
-                    break
-            else:  # this is a fastq record
-                seq, leng, seqs = ''.join(seqs), 0, []
-                for l in fp:  # read the quality
-                    seqs.append(l[:-1])
-                    leng += len(l) - 1
-                    if leng >= len(seq):  # have read enough quality
-                        last = None
-                        yield name, seq, ''.join(seqs)
-                        # yield a fastq record
-                        break
-                if last:  # reach EOF before reading enough quality
-                    yield name, seq, None  # yield a fasta record instead
-                    break
+def fa_iterator(fn):
+    for qname, _, seq, _ in fastx.iterate_over_records(fn):
+        yield qname.decode(), seq.decode(), None
 
 
 class SingleQuery:
@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+
+import argparse
+import gzip
+import sys
+
+from xopen import xopen
+"""
+Apply the global COBS candidate filter to the alignments of a speculatively mapped batch (speculative_mapping).
+
+In the speculative mode, a batch is mapped as soon as its own COBS matches are
+available, using its local top candidates, and batch_align.py (--ref-markers)
+precedes the alignments to every reference by a marker line "#ref\t{rname}".
+Once the global candidates of all batches are known (translate_matches), only
+the alignments of (query, reference) pairs among the global candidates are kept,
+so the output is the same as without speculation. The markers are removed and the
+numbers of kept and discarded alignments of the batch are reported.
+"""
+
+REF_MARKER = "#ref"
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def iterate_over_candidates(filter_fn):
+    """Iterate over (query name, list of candidate references) of a filtered query file (04_filter)."""
+    with xopen(filter_fn) as f:
+        for line in f:
+            if line[:1] != ">":
+                continue
+            qname, _, refs = line[1:].rstrip("\n").partition(" ")
+            yield qname, refs.split(",") if refs else []
+
+
+def load_global_candidates(global_filter_fn, local_filter_fn):
+    """Load the global candidates restricted to the references of the batch (query name -> set of references)."""
+    batch_refs = set()
+    for _, refs in iterate_over_candidates(local_filter_fn):
+        batch_refs.update(refs)
+
+    qname_to_refs = {}
+    for qname, refs in iterate_over_candidates(global_filter_fn):
+        refs = batch_refs.intersection(refs)
+        if refs:
+            qname_to_refs[qname] = refs
+    return qname_to_refs
+
+
+def filter_alignments(sam_fn, global_filter_fn, local_filter_fn, output_fn, report_fn, batch):
+    qname_to_refs = load_global_candidates(global_filter_fn, local_filter_fn)
+    nb_kept = 0
+    nb_discarded = 0
+    rname = None
+    with xopen(sam_fn) as f, gzip.open(output_fn, "wt", compresslevel=1) as fo:
+        for line in f:
+            if line.startswith(REF_MARKER):
+                rname = line.rstrip("\n").split("\t")[1]
+                continue
+            if not line.strip():
+                continue
+            qname = line.split("\t", 1)[0]
+            if rname in qname_to_refs.get(qname, ()):
+                fo.write(line)
+                nb_kept += 1
+            else:
+                nb_discarded += 1
+
+    error(f"Kept {nb_kept} alignments, discarded {nb_discarded} speculative alignments")
+    with open(report_fn, "w") as fo:
+        print(batch, nb_kept, nb_discarded, sep="\t", file=fo)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Keep only the speculative alignments of the global candidates")
+
+    parser.add_argument(
+        'sam_fn',
+        metavar='speculative.sam.gz',
+        help='speculative alignments of a batch, with reference markers',
+    )
+
+    parser.add_argument(
+        '-g',
+        dest='global_filter_fn',
+        metavar='filter.fa',
+        required=True,
+        help='queries with their global candidates (translate_matches)',
+    )
+
+    parser.add_argument(
+        '-l',
+        dest='local_filter_fn',
+        metavar='batch_filter.fa',
+        required=True,
+        help='queries with their local candidates in the batch (used for the mapping)',
+    )
+
+    parser.add_argument(
+        '-o',
+        dest='output_fn',
+        metavar='batch.sam.gz',
+        required=True,
+        help='filtered alignments',
+    )
+
+    parser.add_argument(
+        '-r',
+        dest='report_fn',
+        metavar='report.tsv',
+        required=True,
+        help='report with the numbers of kept and discarded alignments',
+    )
+
+    parser.add_argument(
+        '-b',
+        dest='batch',
+        metavar='str',
+        required=True,
+        help='batch name (for the report)',
+    )
+
+    args = parser.parse_args()
+
+    filter_alignments(args.sam_fn, args.global_filter_fn, args.local_filter_fn, args.output_fn, args.report_fn,
+                      args.batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,37 @@
 #! /usr/bin/env python3
 
 import argparse
+import array
+import mmap
+import multiprocessing
 import os
+import re
 import sys
+import zlib
 
 from xopen import xopen
 
+import fastx
+"""
+Compute statistics of the aggregated alignments (output of aggregate_sams.py).
 
-def readfq(fp):
-    """From https://github.com/lh3/readfq/blob/master/readfq.py
-    """
-    last = None
-    while True:
-        if not last:
-            for l in fp:
-                if l[0] in '>@':
-                    last = l[:-1]
-                    break
-        if not last:
-            break
-        name, seqs, last = last[1:].partition(" ")[0], [], None
-        for l in fp:
-            if l[0] in '@+>':
-                last = l[:-1]
-                break
-            seqs.append(l[:-1])
-        if not last or last[0] != '+':
-            yield name, ''.join(seqs), None
-            if not last:
-                break
-        else:
-            seq, leng, seqs = ''.join(seqs), 0, []
-            for l in fp:
-                seqs.append(l[:-1])
-                leng += len(l) - 1
-                if leng >= len(seq):
-                    last = None
-                    yield name, seq, ''.join(seqs)
-                    break
-            if last:
-                yield name, seq, None
-                break
+The aggregated file is a concatenation of gzip members: for every batch, a
+small member with the "==> file <==" header followed by the member(s) of the
+batch SAM. If the file is gzipped, the member boundaries are located by
+searching the gzip magic bytes and validating the candidates as header
+members, and the batches are then parsed in parallel. Queries are identified
+by integer IDs (their order in the query file) and the distinct genome-query
+pairs are counted per genome as compact arrays of query IDs. Only QNAME and
+RNAME are parsed, so compact records (see compact_sam.py) are read as is.
+"""
+
+GZIP_MAGIC = b"\x1f\x8b\x08"
+HEADER_MEMBER_RE = re.compile(rb"\n?==> (.*) <==\n")
+MAX_HEADER_MEMBER_SIZE = 2**16
+READ_CHUNK_SIZE = 2**22
+
+# qname (bytes) -> query ID, inherited by the worker processes
+_QUERY_IDS = {}
 
 
 def _get_batch_name(st):
@@ -63,17 +54,239 @@ def get_match(st):
         return qname, accession, contig
 
 
+def load_query_ids_and_bps(queries_fn):
+    query_ids = {}
+    bps = 0
+    for qname, _, seq, _ in fastx.iterate_over_records(queries_fn):
+        query_ids.setdefault(qname, len(query_ids))
+        bps += len(seq)
+    return query_ids, bps
+
+
+def _parse_header_member(buf, offset):
+    """Decompress a gzip member starting at offset if it is a batch header member.
+
+    Returns:
+        (fn, end): Name of the file in the header and offset of the end of the member, or None.
+    """
+    d = zlib.decompressobj(wbits=31)
+    try:
+        content = d.decompress(buf[offset:offset + MAX_HEADER_MEMBER_SIZE], MAX_HEADER_MEMBER_SIZE)
+    except zlib.error:
+        return None
+    if not d.eof:
+        return None
+    m = HEADER_MEMBER_RE.fullmatch(content)
+    if m is None:
+        return None
+    end = min(offset + MAX_HEADER_MEMBER_SIZE, len(buf)) - len(d.unused_data)
+    return m.group(1).decode(), end
+
+
+def find_batch_segments(results_fn):
+    """Locate the gzipped SAM of every batch in the aggregated file.
+
+    Returns:
+        segments (list): List of (batch, start, end) byte ranges of the gzip member(s) following each header
+            member, or None if the file does not start with a header member (e.g., it was not produced by
+            aggregate_sams.py).
+    """
+    if os.path.getsize(results_fn) == 0:
+        return []
+    headers = []
+    with open(results_fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        offset = buf.find(GZIP_MAGIC)
+        while offset != -1:
+            header = _parse_header_member(buf, offset)
+            if header is not None:
+                fn, end = header
+                headers.append((offset, end, fn))
+                offset = buf.find(GZIP_MAGIC, end)
+            else:
+                offset = buf.find(GZIP_MAGIC, offset + 1)
+        size = len(buf)
+    if not headers or headers[0][0] != 0:
+        return None
+    segments = []
+    for i, (_, end, fn) in enumerate(headers):
+        next_start = headers[i + 1][0] if i + 1 < len(headers) else size
+        segments.append((_get_batch_name(f"==> {fn} <=="), end, next_start))
+    return segments
+
+
+def iterate_over_segment_lines(results_fn, start, end):
+    """Iterate over the lines (bytes) of a byte range made of one or more gzip members."""
+    rest = b""
+    d = zlib.decompressobj(wbits=31)
+    with open(results_fn, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(READ_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            while data:
+                rest += d.decompress(data)
+                if d.eof:
+                    data = d.unused_data
+                    d = zlib.decompressobj(wbits=31)
+                else:
+                    data = b""
+                lines = rest.split(b"\n")
+                rest = lines.pop()
+                yield from lines
+    if rest:
+        yield rest
+
+
+class BatchStats:
+    """Partial statistics of a set of batches, mergeable with the ones of other batches."""
+
+    def __init__(self):
+        self.matched_qids = set()
+        self.aligned_qids = set()
+        self.unknown_queries = 0
+        self.batches = set()
+        # accession -> array of distinct query IDs
+        self.pairs = {}
+        self.nb_alignments = 0
+        self.nb_nonalignments = 0
+
+    def compact(self):
+        """Convert the query ID sets into arrays before sending them to the main process."""
+        self.matched_qids = _compact_query_ids(self.matched_qids)
+        self.aligned_qids = _compact_query_ids(self.aligned_qids)
+        return self
+
+    def merge(self, other):
+        self.matched_qids.update(other.matched_qids)
+        self.aligned_qids.update(other.aligned_qids)
+        self.unknown_queries += other.unknown_queries
+        self.batches |= other.batches
+        for accession, qids in other.pairs.items():
+            if accession in self.pairs:
+                self.pairs[accession] = _compact_query_ids(set(self.pairs[accession]) | set(qids))
+            else:
+                self.pairs[accession] = qids
+        self.nb_alignments += other.nb_alignments
+        self.nb_nonalignments += other.nb_nonalignments
+
+
+def _compact_query_ids(qids):
+    return array.array("I", sorted(qids))
+
+
+def compute_batch_stats(results_fn, batch, segments):
+    """Statistics of the byte ranges of a batch (run in a worker process)."""
+    stats = BatchStats()
+    pairs = stats.pairs
+    # minimap2 is run per genome, so the alignments of a genome are contiguous and their query IDs can be kept
+    # in a set only until the next genome starts
+    current_accession = None
+    current_qids = set()
+    for start, end in segments:
+        for x in iterate_over_segment_lines(results_fn, start, end):
+            x = x.strip()
+            if not x:
+                continue
+            p = x.split(b"\t", 3)
+            qid = _QUERY_IDS.get(p[0])
+            if qid is None:
+                stats.unknown_queries += 1
+                continue
+            stats.matched_qids.add(qid)
+            rname = p[2]
+            if rname == b"*":
+                stats.nb_nonalignments += 1
+                continue
+            stats.aligned_qids.add(qid)
+            stats.nb_alignments += 1
+            stats.batches.add(batch)
+            accession = rname.partition(b".")[0]
+            if accession != current_accession:
+                if current_accession is not None:
+                    pairs[current_accession.decode()] = _compact_query_ids(current_qids)
+                current_accession = accession
+                current_qids = set(pairs.pop(accession.decode(), ()))
+            current_qids.add(qid)
+    if current_accession is not None:
+        pairs[current_accession.decode()] = _compact_query_ids(current_qids)
+    return stats.compact()
+
+
+def _compute_batch_stats_star(args):
+    return compute_batch_stats(*args)
+
+
+def print_stats(nb_queries,
+                queries_bps,
+                nb_matched,
+                nb_aligned,
+                nb_alignments,
+                nb_pairs,
+                nb_refs,
+                nb_batches,
+                nb_nonalignments,
+                file=sys.stdout):
+    if nb_queries is not None:
+        print("queries", nb_queries, sep="\t", file=file)
+        print("cumul_length_bps", queries_bps, sep="\t", file=file)
+    print("matched_queries", nb_matched, sep="\t", file=file)
+    print("aligned_queries", nb_aligned, sep="\t", file=file)
+    print("aligned_segments", nb_alignments, sep="\t", file=file)
+    print("distinct_genome_query_pairs", nb_pairs, sep="\t", file=file)
+    print("target_genomes", nb_refs, sep="\t", file=file)
+    print("target_batches", nb_batches, sep="\t", file=file)
+    print("nonalignments", nb_nonalignments, sep="\t", file=file)
+
+
+def print_merged_stats(stats, nb_queries, queries_bps, file=sys.stdout):
+    assert stats.unknown_queries == 0, f"queries_matched not a subset of queries"
+    print_stats(
+        nb_queries=nb_queries,
+        queries_bps=queries_bps,
+        nb_matched=len(stats.matched_qids),
+        nb_aligned=len(stats.aligned_qids),
+        nb_alignments=stats.nb_alignments,
+        nb_pairs=sum(map(len, stats.pairs.values())),
+        nb_refs=len(stats.pairs),
+        nb_batches=len(stats.batches),
+        nb_nonalignments=stats.nb_nonalignments,
+        file=file,
+    )
+
+
+def compute_stats_parallel(results_fn, queries_fn, segments, threads):
+    global _QUERY_IDS
+    _QUERY_IDS, queries_bps = load_query_ids_and_bps(queries_fn)
+
+    segments_per_batch = {}
+    for batch, start, end in segments:
+        segments_per_batch.setdefault(batch, []).append((start, end))
+
+    stats = BatchStats()
+    # fork, so that the workers share the query IDs instead of receiving a copy
+    with multiprocessing.get_context("fork").Pool(threads) as pool:
+        tasks = ((results_fn, batch, batch_segments) for batch, batch_segments in segments_per_batch.items())
+        for batch, batch_stats in zip(segments_per_batch, pool.imap(_compute_batch_stats_star, tasks)):
+            print(batch, "", file=sys.stderr)
+            stats.merge(batch_stats)
+    print(file=sys.stderr)
+
+    print_merged_stats(stats, len(_QUERY_IDS), queries_bps)
+
+
 def load_query_names_and_bps(queries_fn):
     qnames = set()
     bps = 0
-    with open(queries_fn) as f:
-        for qname, seq, qual in readfq(f):
-            qnames.add(qname)
-            bps += len(seq)
+    for qname, _, seq, _ in fastx.iterate_over_records(queries_fn):
+        qnames.add(qname.decode())
+        bps += len(seq)
     return qnames, bps
 
 
-def compute_stats(results_fn, queries_fn):
+def compute_stats_sequential(results_fn, queries_fn):
     batches = set()
     refs = set()
     queries_matched = set()
@@ -115,17 +328,29 @@ def compute_stats(results_fn, queries_fn):
     print(file=sys.stderr)
     #
     if queries is not None:
-        print("queries", len(queries), sep="\t")
-        print("cumul_length_bps", queries_bps, sep="\t")
         assert queries_matched.issubset(queries), f"queries_matched not a subset of queries"
         assert queries_aligned.issubset(queries), f"queries_aligned not a subset of queries"
-    print("matched_queries", len(queries_matched), sep="\t")
-    print("aligned_queries", len(queries_aligned), sep="\t")
-    print("aligned_segments", nb_alignments, sep="\t")
-    print("distinct_genome_query_pairs", len(query_ref_pairs), sep="\t")
-    print("target_genomes", len(refs), sep="\t")
-    print("target_batches", len(batches), sep="\t")
-    print("nonalignments", nb_nonalignments, sep="\t")
+    print_stats(
+        nb_queries=len(queries) if queries is not None else None,
+        queries_bps=queries_bps if queries is not None else None,
+        nb_matched=len(queries_matched),
+        nb_aligned=len(queries_aligned),
+        nb_alignments=nb_alignments,
+        nb_pairs=len(query_ref_pairs),
+        nb_refs=len(refs),
+        nb_batches=len(batches),
+        nb_nonalignments=nb_nonalignments,
+    )
+
+
+def compute_stats(results_fn, queries_fn, threads):
+    segments = None
+    if results_fn.endswith(".gz") and queries_fn is not None:
+        segments = find_batch_segments(results_fn)
+    if segments is None:
+        compute_stats_sequential(results_fn, queries_fn)
+    else:
+        compute_stats_parallel(results_fn, queries_fn, segments, threads)
 
 
 def main():
@@ -144,9 +369,18 @@ def main():
         help='',
     )
 
+    parser.add_argument(
+        '-t',
+        dest='threads',
+        metavar='int',
+        type=int,
+        default=1,
+        help='number of worker processes (gzipped results only) [1]',
+    )
+
     args = parser.parse_args()
 
-    compute_stats(args.results_fn, args.queries_fn)
+    compute_stats(args.results_fn, args.queries_fn, args.threads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+
+import argparse
+import statistics
+import sys
+
+from pathlib import Path
+"""
+Pack small batches into groups submitted as single cluster jobs.
+
+On a cluster, every COBS and mapping job of a small batch is a separate
+submission, and the queueing and scheduling overhead can exceed its compute
+time. Batches are therefore packed (first-fit decreasing) into groups whose
+estimated runtime (or index size) does not exceed a target; large batches
+(above a fraction of the target) stay separate.
+
+The groups are written into a TSV file read by the Snakefile (group directive),
+and the matching --group-components arguments for Snakemake are printed to
+stdout.
+"""
+
+DEFAULT_TARGET_RUNTIME_S = 600
+DEFAULT_LARGE_FRACTION = 0.5
+DEFAULT_COBS_S_PER_MB = 0.05
+DEFAULT_MAP_S_PER_MB = 0.1
+DEFAULT_JOB_OVERHEAD_S = 60
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def load_batches(batches_fn):
+    with open(batches_fn) as fin:
+        return sorted(filter(len, map(str.strip, fin)))
+
+
+def load_index_sizes_in_MB(decompressed_indexes_sizes_fn):
+    sizes = {}
+    with open(decompressed_indexes_sizes_fn) as f:
+        for line in f:
+            cobs_index, size_in_bytes, _ = line.strip().split()
+            batch = cobs_index.split("/")[-1].replace(".cobs_classic.xz", "")
+            sizes[batch] = int(size_in_bytes) / 2**20
+    return sizes
+
+
+def get_asm_sizes_in_MB(batches, asms_dir, index_sizes):
+    """Sizes of the assembly archives; the index size is used as a proxy if an archive has not been downloaded."""
+    sizes = {}
+    for batch in batches:
+        fn = Path(asms_dir, f"{batch}.tar.xz")
+        sizes[batch] = fn.stat().st_size / 2**20 if fn.exists() else index_sizes[batch]
+    return sizes
+
+
+def _read_real_time(fn):
+    with open(fn) as f:
+        lines = [line.rstrip("\n") for line in f if not line.startswith("#") and line.strip()]
+    if len(lines) < 2:
+        return None
+    record = dict(zip(lines[0].split("\t"), lines[1].split("\t")))
+    try:
+        return float(record["real(s)"])
+    except (KeyError, ValueError):
+        return None
+
+
+def estimate_seconds_per_MB(benchmarks_dir, sizes, default):
+    """Median runtime per MB measured in previous runs (the default if there are no benchmark logs)."""
+    rates = []
+    for fn in Path(benchmarks_dir).glob("*.txt"):
+        batch = fn.name.split("____")[0]
+        if batch not in sizes or not sizes[batch]:
+            continue
+        real = _read_real_time(fn)
+        if real is not None:
+            rates.append(real / sizes[batch])
+    if not rates:
+        return default
+    return statistics.median(rates)
+
+
+def pack(batches, costs, capacity, large_fraction):
+    """Pack batches into groups with total cost <= capacity (first-fit decreasing).
+
+    Returns:
+        groups (list): List of lists of batches; batches with cost > large_fraction * capacity form singleton groups.
+    """
+    groups = []
+    loads = []
+    for batch in sorted(batches, key=lambda b: (-costs[b], b)):
+        if costs[batch] > large_fraction * capacity:
+            groups.append([batch])
+            loads.append(capacity)
+            continue
+        for i, load in enumerate(loads):
+            if load + costs[batch] <= capacity:
+                groups[i].append(batch)
+                loads[i] += costs[batch]
+                break
+        else:
+            groups.append([batch])
+            loads.append(costs[batch])
+    return [sorted(group) for group in groups]
+
+
+def name_groups(groups, prefix):
+    """Batch -> group name ('-' for batches that stay separate)."""
+    batch_to_group = {batch: "-" for group in groups for batch in group}
+    for i, group in enumerate(sorted(g for g in groups if len(g) > 1)):
+        for batch in group:
+            batch_to_group[batch] = f"{prefix}_{i:03}"
+    return batch_to_group
+
+
+def report(stage, groups, seconds, job_overhead_s):
+    grouped = [g for g in groups if len(g) > 1]
+    nb_batches = sum(map(len, groups))
+    print(f"## {stage}", file=sys.stderr)
+    print(f"jobs without grouping:\t{nb_batches}", file=sys.stderr)
+    print(f"jobs with grouping:\t{len(groups)} ({len(grouped)} groups, {len(groups) - len(grouped)} separate batches)",
+          file=sys.stderr)
+    print(f"estimated scheduling overhead saved:\t{(nb_batches - len(groups)) * job_overhead_s:.0f} s", file=sys.stderr)
+    for i, group in enumerate(sorted(grouped)):
+        runtime = sum(seconds[b] for b in group)
+        print(f"{stage}_{i:03}\t{len(group)} batches\t{runtime:.0f} s\t{','.join(group)}", file=sys.stderr)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Pack small batches into grouped cluster jobs")
+
+    parser.add_argument('--batches', required=True, help='file with the list of batches')
+    parser.add_argument('--indexes-sizes',
+                        default="data/decompressed_indexes_sizes.txt",
+                        help='decompressed COBS index sizes [data/decompressed_indexes_sizes.txt]')
+    parser.add_argument('--asms-dir', default="asms", help='directory with the assembly archives [asms]')
+    parser.add_argument('--benchmarks-dir',
+                        default="logs/benchmarks",
+                        help='benchmark logs used to estimate runtimes [logs/benchmarks]')
+    parser.add_argument('--target-runtime',
+                        type=float,
+                        default=DEFAULT_TARGET_RUNTIME_S,
+                        help=f'target estimated runtime of a group in seconds [{DEFAULT_TARGET_RUNTIME_S}]')
+    parser.add_argument('--target-mb',
+                        type=float,
+                        default=None,
+                        help='pack by the total decompressed index size (MB) instead of the estimated runtime')
+    parser.add_argument('--large-fraction',
+                        type=float,
+                        default=DEFAULT_LARGE_FRACTION,
+                        help=f'batches above this fraction of the target stay separate [{DEFAULT_LARGE_FRACTION}]')
+    parser.add_argument('--job-overhead',
+                        type=float,
+                        default=DEFAULT_JOB_OVERHEAD_S,
+                        help=f'estimated queueing/scheduling overhead per cluster job in seconds '
+                        f'[{DEFAULT_JOB_OVERHEAD_S}]')
+    parser.add_argument('-o', dest='output', required=True, help='output TSV with batch groups')
+
+    args = parser.parse_args()
+
+    batches = load_batches(args.batches)
+    index_sizes = load_index_sizes_in_MB(args.indexes_sizes)
+    asm_sizes = get_asm_sizes_in_MB(batches, args.asms_dir, index_sizes)
+
+    cobs_s_per_MB = estimate_seconds_per_MB(Path(args.benchmarks_dir, "run_cobs"), index_sizes, DEFAULT_COBS_S_PER_MB)
+    map_s_per_MB = estimate_seconds_per_MB(Path(args.benchmarks_dir, "batch_align_minimap2"), asm_sizes,
+                                           DEFAULT_MAP_S_PER_MB)
+    cobs_seconds = {b: index_sizes[b] * cobs_s_per_MB for b in batches}
+    map_seconds = {b: asm_sizes[b] * map_s_per_MB for b in batches}
+
+    if args.target_mb is not None:
+        cobs_groups = pack(batches, index_sizes, args.target_mb, args.large_fraction)
+        map_groups = pack(batches, asm_sizes, args.target_mb, args.large_fraction)
+    else:
+        cobs_groups = pack(batches, cobs_seconds, args.target_runtime, args.large_fraction)
+        map_groups = pack(batches, map_seconds, args.target_runtime, args.large_fraction)
+
+    report("cobs_group", cobs_groups, cobs_seconds, args.job_overhead)
+    report("map_group", map_groups, map_seconds, args.job_overhead)
+
+    batch_to_cobs_group = name_groups(cobs_groups, "cobs_group")
+    batch_to_map_group = name_groups(map_groups, "map_group")
+    with open(args.output, "w") as fo:
+        print("batch", "cobs_group", "map_group", sep="\t", file=fo)
+        for batch in batches:
+            print(batch, batch_to_cobs_group[batch], batch_to_map_group[batch], sep="\t", file=fo)
+
+    # every group is made of unconnected jobs, which Snakemake submits together only with --group-components
+    group_components = [
+        f"{stage}_{i:03}={len(group)}" for stage, groups in [("cobs_group", cobs_groups), ("map_group", map_groups)]
+        for i, group in enumerate(sorted(g for g in groups if len(g) > 1))
+    ]
+    if group_components:
+        print("--group-components", *group_components)
+
+
+if __name__ == "__main__":
+    main()
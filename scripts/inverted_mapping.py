@@ -0,0 +1,164 @@
+import re
+import shlex
+import subprocess
+import threading
+
+import compact_sam
+"""
+Inverted mapping mode of batch_align.py (inverted_mapping), for small query sets.
+
+Instead of building a minimap2 index of every genome and mapping the reads to
+it, a single minimap2 process indexes the candidate reads of the batch once,
+and the contigs of the genomes with candidates are streamed through it as
+queries (PAF output with CIGARs). The alignments are then converted back to
+read-centric SAM records (the read as the query, the contig as the reference)
+and restricted to the COBS candidate pairs (read, genome), so that the output
+has the same form as in the normal mode: for every genome, the records of its
+candidate reads in the order of the reads, an unmapped record for a candidate
+read without any alignment, and the best alignment of a read to a genome as
+the primary one.
+"""
+
+CIGAR_OP_RE = re.compile(r"(\d+)([MIDNX=])")
+
+# the roles of the query and the reference are swapped
+SWAPPED_CIGAR_OPS = {"I": "D", "D": "I"}
+
+
+def _parse_paf_tags(fields):
+    return {field[:2]: field for field in fields}
+
+
+def _get_alignment_score(p):
+    tags = _parse_paf_tags(p[12:])
+    if "AS" in tags:
+        return int(tags["AS"][5:])
+    return int(p[9])
+
+
+def unmapped_record(qname, qseq):
+    return "\t".join([qname, "4", "*", "0", "0", "*", "*", "0", "0", qseq, "*"])
+
+
+def paf_to_sam_record(p, qseq, secondary):
+    """Convert a PAF alignment of a contig (query) to a read (target) into a SAM record of the read."""
+    contig, _, qstart, _, strand, qname, tlen, tstart, tend, _, _, mapq = p[:12]
+    tags = _parse_paf_tags(p[12:])
+    ops = [(n, SWAPPED_CIGAR_OPS.get(op, op)) for n, op in CIGAR_OP_RE.findall(tags["cg"][5:])]
+    left_clip, right_clip = int(tstart), int(tlen) - int(tend)
+    flag = 0
+    seq = qseq
+    if strand == "-":
+        # the contig is aligned to the reverse complement of the read
+        ops.reverse()
+        left_clip, right_clip = right_clip, left_clip
+        flag |= 16
+        seq = compact_sam.reverse_complement(qseq)
+    if secondary:
+        flag |= 256
+        seq = "*"
+    cigar = "".join(f"{n}{op}" for n, op in ops)
+    if left_clip:
+        cigar = f"{left_clip}S{cigar}"
+    if right_clip:
+        cigar = f"{cigar}{right_clip}S"
+    sam_tags = [tags[tag] for tag in ["NM", "AS"] if tag in tags]
+    sam_tags.append("tp:A:S" if secondary else "tp:A:P")
+    return "\t".join([qname, str(flag), contig, str(int(qstart) + 1), mapq, cigar, "*", "0", "0", seq, "*", *sam_tags])
+
+
+def paf_to_sam_records(paf_lines, candidate_qnames, qname_to_qseq):
+    """Convert the PAF alignments of the contigs of a genome into SAM records of its candidate reads."""
+    candidates = set(candidate_qnames)
+    qname_to_alignments = {}
+    for line in paf_lines:
+        p = line.split("\t")
+        if p[5] in candidates:
+            qname_to_alignments.setdefault(p[5], []).append(p)
+
+    records = []
+    for qname in candidate_qnames:
+        alignments = qname_to_alignments.get(qname)
+        if not alignments:
+            records.append(unmapped_record(qname, qname_to_qseq[qname]))
+            continue
+        alignments.sort(key=lambda p: -_get_alignment_score(p))
+        for i, p in enumerate(alignments):
+            records.append(paf_to_sam_record(p, qname_to_qseq[qname], secondary=i > 0))
+    return records
+
+
+def get_minimap_command(minimap_preset, minimap_threads, minimap_extra_params, reads_fn, nb_reads):
+    """minimap2 command indexing the reads and reading the contigs from stdin (PAF output with CIGARs).
+
+    As a contig is the query, the limits on secondary alignments (-N, -p) would apply to all the reads aligned to
+    the same region of it, and all but a few of these reads would be dropped. All the secondary alignments are
+    therefore kept (up to one per read), and the primary alignment of every read is chosen afterwards.
+    """
+    return [
+        "minimap2", "-c", "-x", minimap_preset, "-t",
+        str(minimap_threads), *(shlex.split(minimap_extra_params or "")), "--secondary=yes", "-N",
+        str(nb_reads), "-p", "0", reads_fn, "-"
+    ]
+
+
+def get_contig_names(rfa):
+    return [name.decode() for name in re.findall(rb"^>(\S+)", rfa, re.M)]
+
+
+def iterate_over_inverted_alignments(command, genomes, rname_to_qnames, qname_to_qseq):
+    """Stream genomes through a single minimap2 process indexing the reads.
+
+    Args:
+        command (list): minimap2 command (see get_minimap_command).
+        genomes (iterable): (rname, rfa) of the genomes with candidates.
+        rname_to_qnames (dict): rname -> list of its candidate reads.
+        qname_to_qseq (dict): qname -> read sequence.
+
+    Returns:
+        (rname, list of SAM records), for every genome in the input order.
+    """
+    contig_to_rname = {}
+    rnames = []
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+    def write_genomes():
+        try:
+            for rname, rfa in genomes:
+                for contig in get_contig_names(rfa):
+                    contig_to_rname[contig] = rname
+                rnames.append(rname)
+                process.stdin.write(rfa.decode())
+                if not rfa.endswith(b"\n"):
+                    process.stdin.write("\n")
+        finally:
+            process.stdin.close()
+
+    writer = threading.Thread(target=write_genomes)
+    writer.start()
+
+    # minimap2 outputs the alignments in the order of the contigs, so the alignments of a genome are contiguous
+    nb_flushed = 0
+    current_rname = None
+    paf_lines = []
+    for line in process.stdout:
+        rname = contig_to_rname[line.split("\t", 1)[0]]
+        if rname != current_rname:
+            if current_rname is not None:
+                yield current_rname, paf_to_sam_records(paf_lines, rname_to_qnames[current_rname], qname_to_qseq)
+                nb_flushed += 1
+            # genomes without any alignment
+            while rnames[nb_flushed] != rname:
+                yield rnames[nb_flushed], paf_to_sam_records([], rname_to_qnames[rnames[nb_flushed]], qname_to_qseq)
+                nb_flushed += 1
+            current_rname = rname
+            paf_lines = []
+        paf_lines.append(line.rstrip("\n"))
+
+    writer.join()
+    assert process.wait() == 0, f"minimap2 failed ({command})"
+    if current_rname is not None:
+        yield current_rname, paf_to_sam_records(paf_lines, rname_to_qnames[current_rname], qname_to_qseq)
+        nb_flushed += 1
+    for rname in rnames[nb_flushed:]:
+        yield rname, paf_to_sam_records([], rname_to_qnames[rname], qname_to_qseq)
@@ -0,0 +1,257 @@
+#! /usr/bin/env python3
+
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+"""
+Structured trace of the steps of a job (JSONL), and a report across jobs.
+
+A script enables the trace with `setup(trace_fn)` and wraps its steps in
+`span(name, **attributes)`; every span is written as one JSON line when it
+ends, with its start (seconds since the start of the job), its duration and
+its attributes. Attributes common to several steps (e.g., the reference being
+mapped) are set once with `set_context(**attributes)` or, for a block,
+`context(**attributes)`. When the trace is not enabled, spans cost a function
+call.
+
+    {"event": "start", "time": 1700000000.0, "pid": 123, "argv": [...]}
+    {"span": "member_extract", "start": 1.52, "dur": 0.31, "ref": "SAMN...", "bytes": 5123456}
+    ...
+    {"event": "end", "dur": 42.0}
+
+Subcommands:
+    report  - hotspot tables (by step and by reference) and a critical-path summary of the traces of many jobs
+              (by default, the traces of batch_align.py in logs/05_map/)
+"""
+
+DEFAULT_TRACES = "logs/05_map/*.trace.jsonl"
+
+_trace_fh = None
+_trace_lock = threading.Lock()
+_trace_start = None
+_context = {}
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def _write(record):
+    line = json.dumps(record, separators=(",", ":")) + "\n"
+    with _trace_lock:
+        _trace_fh.write(line)
+
+
+def setup(trace_fn, **attributes):
+    """Start tracing into a JSONL file (attributes are written in the start event)."""
+    global _trace_fh, _trace_start
+    _trace_fh = open(trace_fn, "w", buffering=1)
+    _trace_start = time.perf_counter()
+    _write({"event": "start", "time": time.time(), "pid": os.getpid(), "argv": sys.argv, **attributes})
+
+
+def close(**attributes):
+    """Write the end event (with the duration of the job) and stop tracing."""
+    global _trace_fh
+    if _trace_fh is None:
+        return
+    _write({"event": "end", "dur": round(time.perf_counter() - _trace_start, 6), **attributes})
+    _trace_fh.close()
+    _trace_fh = None
+
+
+def set_context(**attributes):
+    """Set the attributes of all the following spans (e.g., the reference processed by an iteration of a loop)."""
+    global _context
+    _context = attributes
+
+
+@contextmanager
+def context(**attributes):
+    """Add attributes to all the spans started in this block (from any thread)."""
+    global _context
+    previous = _context
+    _context = {**previous, **attributes}
+    try:
+        yield
+    finally:
+        _context = previous
+
+
+@contextmanager
+def span(name, **attributes):
+    """Trace a step. Yields the dict of attributes of the span, to which results (e.g., bytes) can be added."""
+    if _trace_fh is None:
+        yield {}
+        return
+    record = {**_context, **attributes}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        end = time.perf_counter()
+        _write({
+            "span": name,
+            "start": round(start - _trace_start, 6),
+            "dur": round(end - start, 6),
+            **record,
+        })
+
+
+def event(name, **attributes):
+    """Trace an instantaneous event (e.g., a fallback)."""
+    if _trace_fh is None:
+        return
+    _write({"span": name, "start": round(time.perf_counter() - _trace_start, 6), "dur": 0.0, **_context, **attributes})
+
+
+##################################
+## Report
+##################################
+
+
+def load_trace(fn):
+    """Load a trace.
+
+    Returns:
+        (start time (epoch), duration of the job, list of spans)
+    """
+    start_time = None
+    wall = None
+    spans = []
+    with open(fn) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("event") == "start":
+                start_time = record["time"]
+            elif record.get("event") == "end":
+                wall = record["dur"]
+            elif "span" in record:
+                spans.append(record)
+    if wall is None:
+        # the job did not finish
+        wall = max((s["start"] + s["dur"] for s in spans), default=0.0)
+    return start_time, wall, spans
+
+
+def get_covered_time(spans):
+    """Time covered by at least one span (overlapping spans, e.g. in the pipe mode, are counted once)."""
+    covered = 0.0
+    current_start, current_end = None, None
+    for start, end in sorted((s["start"], s["start"] + s["dur"]) for s in spans):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                covered += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        covered += current_end - current_start
+    return covered
+
+
+def get_job_name(fn):
+    name = Path(fn).name
+    return name[:-len(".trace.jsonl")] if name.endswith(".trace.jsonl") else name
+
+
+def report(trace_fns, top):
+    jobs = []
+    for fn in trace_fns:
+        start_time, wall, spans = load_trace(fn)
+        jobs.append((get_job_name(fn), start_time, wall, spans))
+    if not jobs:
+        error("No traces found")
+        return
+    total_wall = sum(wall for _, _, wall, _ in jobs)
+
+    print(f"# Hotspots by step ({len(jobs)} jobs, {total_wall:.1f} s in total)")
+    by_step = {}
+    for _, _, _, spans in jobs:
+        for s in spans:
+            stats = by_step.setdefault(s["span"], [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += s["dur"]
+            stats[2] = max(stats[2], s["dur"])
+            stats[3] += s.get("bytes", 0)
+    print("step", "count", "total_s", "share", "mean_ms", "max_ms", "MB", "MB_per_s", sep="\t")
+    for step, (count, total, maximum, nbytes) in sorted(by_step.items(), key=lambda item: -item[1][1]):
+        print(step,
+              count,
+              f"{total:.3f}",
+              f"{total / total_wall:.4f}" if total_wall else "NA",
+              f"{1000 * total / count:.1f}",
+              f"{1000 * maximum:.1f}",
+              f"{nbytes / 1e6:.1f}",
+              f"{nbytes / 1e6 / total:.1f}" if nbytes and total else "NA",
+              sep="\t")
+
+    print()
+    print(f"# Hotspots by reference (top {top})")
+    by_ref = {}
+    for job, _, _, spans in jobs:
+        for s in spans:
+            if "ref" not in s:
+                continue
+            stats = by_ref.setdefault((job, s["ref"]), {"total": 0.0, "ref_bytes": "NA", "queries": "NA", "steps": {}})
+            stats["total"] += s["dur"]
+            stats["ref_bytes"] = s.get("ref_bytes", stats["ref_bytes"])
+            stats["queries"] = s.get("queries", stats["queries"])
+            stats["steps"][s["span"]] = stats["steps"].get(s["span"], 0.0) + s["dur"]
+    print("job", "ref", "ref_bytes", "queries", "total_s", "slowest_step", sep="\t")
+    for (job, ref), stats in sorted(by_ref.items(), key=lambda item: -item[1]["total"])[:top]:
+        slowest_step, slowest_time = max(stats["steps"].items(), key=lambda item: item[1])
+        print(job,
+              ref,
+              stats["ref_bytes"],
+              stats["queries"],
+              f"{stats['total']:.3f}",
+              f"{slowest_step}:{slowest_time:.3f}",
+              sep="\t")
+
+    print()
+    start_times = [start_time for _, start_time, _, _ in jobs if start_time is not None]
+    if start_times:
+        run_end = max(start_time + wall for _, start_time, wall, _ in jobs if start_time is not None)
+        print(f"# Critical path: the jobs spanned {run_end - min(start_times):.1f} s, "
+              f"the slowest ones are (top {top})")
+    else:
+        print(f"# Critical path: slowest jobs (top {top})")
+    print("job", "wall_s", "untraced_s", "steps", sep="\t")
+    for job, _, wall, spans in sorted(jobs, key=lambda job: -job[2])[:top]:
+        steps = {}
+        for s in spans:
+            steps[s["span"]] = steps.get(s["span"], 0.0) + s["dur"]
+        print(job,
+              f"{wall:.3f}",
+              f"{max(wall - get_covered_time(spans), 0.0):.3f}",
+              ",".join(f"{step}:{t:.3f}" for step, t in sorted(steps.items(), key=lambda item: -item[1])[:4]),
+              sep="\t")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Structured traces of the jobs")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    p = subparsers.add_parser("report")
+    p.add_argument('traces', metavar='trace.jsonl', nargs='*', help=f'traces [{DEFAULT_TRACES}]')
+    p.add_argument('--top', metavar='int', type=int, default=20, help='number of references and jobs listed [20]')
+
+    args = parser.parse_args()
+
+    if args.subcommand == "report":
+        report(args.traces or sorted(glob.glob(DEFAULT_TRACES)), args.top)
+
+
+if __name__ == "__main__":
+    main()
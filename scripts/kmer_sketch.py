@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tarfile
+
+import numpy as np
+
+import download
+import fastx
+"""
+Per-batch k-mer presence sketches used to skip COBS on batches that no query can match.
+
+A sketch is a FracMinHash of the canonical k-mers of all the assemblies of a
+batch: the 64-bit hashes below 2^64 / scale, i.e., about 1 k-mer out of
+`scale`, stored as a sorted array. As sampling depends only on the hash, a
+k-mer of a query is sampled iff it would be sampled in the batch, so a sampled
+query k-mer missing from the sketch is certainly missing from every genome of
+the batch (hash collisions can only make k-mers look present). K-mers are
+2-bit encoded and hashed (murmur3 64-bit finalizer) with vectorised numpy
+operations.
+
+Pre-screening modes:
+    conservative - a query can pass only if its k-mers minus its sampled k-mers absent from the sketch reach
+                   the COBS threshold; this is an upper bound, so no query passing COBS with true k-mer matches is
+                   ever dropped. It can skip batches only if scale < 1 / (1 - threshold), i.e., scale <= 3 for the
+                   default threshold 0.7, so it needs much larger sketches than the estimate mode
+    estimate     - the fraction of sampled query k-mers present in the sketch estimates the COBS score
+
+The assemblies can also be streamed from their URL (stream_assemblies), as in batch_align.py.
+
+In both modes, the matches COBS reports on a skipped batch only because of false positives of its Bloom filters
+disappear, so the matches with pre-screening can be a subset of those without.
+"""
+
+MAGIC = b"PHYLIGN_KMER_SKETCH_V2\n"
+HASH_FUNCTION = "murmur3_fmix64"
+DEFAULT_K = 31
+DEFAULT_SCALE = 1000
+CHUNK_SIZE = 2**22
+
+# 2-bit codes of the nucleotides (4 for other characters)
+CODES = np.full(256, 4, dtype=np.uint8)
+for i, nucl in enumerate(b"ACGTacgt"):
+    CODES[nucl] = i % 4
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def get_max_hash(scale):
+    return np.uint64(2**64 // scale - 1)
+
+
+def hash_kmers(kmers):
+    """Hash 2-bit encoded k-mers with the 64-bit finalizer of MurmurHash3 (in place)."""
+    kmers ^= kmers >> np.uint64(33)
+    kmers *= np.uint64(0xff51afd7ed558ccd)
+    kmers ^= kmers >> np.uint64(33)
+    kmers *= np.uint64(0xc4ceb9fe1a85ec53)
+    kmers ^= kmers >> np.uint64(33)
+    return kmers
+
+
+def get_kmer_hashes(seq, k):
+    """Hashes of the canonical k-mers of a sequence, one per k-mer position, and the mask of the k-mers without
+    non-ACGT bases."""
+    codes = CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid[k:] == invalid[:-k]
+    codes = codes.astype(np.uint64)
+    codes[codes == 4] = 0
+    fwd = np.zeros(n, dtype=np.uint64)
+    rc = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        window = codes[j:j + n]
+        fwd <<= np.uint64(2)
+        fwd |= window
+        rc |= (np.uint64(3) - window) << np.uint64(2 * j)
+    return hash_kmers(np.minimum(fwd, rc)), valid
+
+
+def get_sampled_kmer_hashes(seq, k, max_hash):
+    """Hashes of the sampled canonical k-mers of a sequence, one per k-mer position."""
+    hashes = []
+    # in chunks of overlapping windows to bound the memory of long sequences
+    for start in range(0, max(len(seq) - k + 1, 0), CHUNK_SIZE):
+        chunk_hashes, valid = get_kmer_hashes(seq[start:start + CHUNK_SIZE + k - 1], k)
+        hashes.append(chunk_hashes[valid & (chunk_hashes <= max_hash)])
+    return np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+
+
+def get_sampled_kmer_hashes_of_fasta(fa, k, scale):
+    max_hash = get_max_hash(scale)
+    hashes = [get_sampled_kmer_hashes(seq, k, max_hash) for _, _, seq, _ in fastx.parse_fasta(fa)]
+    return np.unique(np.concatenate(hashes)) if hashes else np.empty(0, dtype=np.uint64)
+
+
+def iterate_over_tar_fastas(asms_fn, asms_stream=None):
+    """Iterate over the FASTA files of a batch, read in a single pass (asms_stream: download.SourceStream or None)."""
+    if asms_stream is None:
+        tar = tarfile.open(asms_fn, mode="r:xz")
+    else:
+        tar = tarfile.open(fileobj=asms_stream, mode="r|xz")
+    with tar:
+        for member in tar:
+            if member.isfile():
+                yield tar.extractfile(member).read()
+
+
+def build_sketch(asms_fn, sketch_fn, k, scale, threads, asms_stream=None):
+    assert k <= 32, "k-mers are 2-bit encoded in 64 bits"
+    hashes = [np.empty(0, dtype=np.uint64)]
+    nb_refs = 0
+    with multiprocessing.Pool(threads) as pool:
+        args = ((fa, k, scale) for fa in iterate_over_tar_fastas(asms_fn, asms_stream))
+        for ref_hashes in pool.imap_unordered(_get_sampled_kmer_hashes_of_fasta_star, args, chunksize=4):
+            nb_refs += 1
+            hashes.append(ref_hashes)
+            if len(hashes) >= 256:
+                hashes = [np.unique(np.concatenate(hashes))]
+    sketch = np.unique(np.concatenate(hashes))
+    header = {"k": k, "scale": scale, "hash": HASH_FUNCTION, "nb_hashes": len(sketch), "nb_refs": nb_refs}
+    with open(sketch_fn, "wb") as fo:
+        fo.write(MAGIC)
+        fo.write(json.dumps(header).encode() + b"\n")
+        fo.write(sketch.astype("<u8").tobytes())
+    error(f"Sketch of {asms_fn}: {nb_refs} references, {len(sketch)} sampled k-mers (k={k}, scale={scale})")
+
+
+def _get_sampled_kmer_hashes_of_fasta_star(args):
+    return get_sampled_kmer_hashes_of_fasta(*args)
+
+
+def load_sketch(sketch_fn):
+    with open(sketch_fn, "rb") as f:
+        magic = f.readline()
+        assert magic == MAGIC, f"{sketch_fn} is not a k-mer sketch of this version, rebuild it (make kmer_sketches)"
+        header = json.loads(f.readline())
+        # kept as a sorted array (8 bytes per hash) rather than a set
+        sketch = np.frombuffer(f.read(), dtype="<u8").astype(np.uint64)
+    return header, sketch
+
+
+def sketch_contains(sketch, hashes):
+    """Vector of the presence of the hashes in the sketch."""
+    i = np.searchsorted(sketch, hashes)
+    i[i == len(sketch)] = 0
+    return sketch[i] == hashes if len(sketch) else np.zeros(len(hashes), dtype=bool)
+
+
+def iterate_over_queries(query_fn):
+    """Iterate over (header, seq) of a FASTA file, as produced by the fix_query rule."""
+    for name, comment, seq, _ in fastx.iterate_over_records(query_fn):
+        header = name + b" " + comment if comment else name
+        yield header.decode(), seq.upper()
+
+
+def query_can_pass(seq, k, scale, sketch, threshold, mode):
+    nb_kmers = len(seq) - k + 1
+    if nb_kmers <= 0:
+        # no k-mers, we cannot tell
+        return True
+    hashes = get_sampled_kmer_hashes(seq, k, get_max_hash(scale))
+    present = int(np.count_nonzero(sketch_contains(sketch, hashes)))
+    absent = len(hashes) - present
+    if mode == "conservative":
+        # k-mers not sampled may be present, sampled ones not in the sketch are certainly absent
+        max_score = nb_kmers - absent
+        return max_score >= math.floor(threshold * nb_kmers)
+    else:
+        if present + absent == 0:
+            return True
+        return present / (present + absent) >= threshold
+
+
+def prescreen(sketch_fn, query_fn, threshold, mode, output_fn):
+    header, sketch = load_sketch(sketch_fn)
+    k, scale = header["k"], header["scale"]
+    if mode == "conservative" and 1 / scale <= 1 - threshold:
+        error(f"Warning: with scale {scale} and threshold {threshold}, the conservative mode never skips a batch")
+    nb_screened = 0
+    decision = "skip"
+    for _, seq in iterate_over_queries(query_fn):
+        nb_screened += 1
+        if query_can_pass(seq, k, scale, sketch, threshold, mode):
+            # a single query is enough for COBS to be needed
+            decision = "run"
+            break
+    with open(output_fn, "w") as fo:
+        print(decision, file=fo)
+        print("mode", mode, sep="\t", file=fo)
+        print("screened_queries", nb_screened, sep="\t", file=fo)
+    error(f"Pre-screening {query_fn} against {sketch_fn}: {decision} (after {nb_screened} queries)")
+
+
+def print_empty_cobs_output(query_fn):
+    """Print the output of COBS if no query matches any reference."""
+    for header, _ in iterate_over_queries(query_fn):
+        print(f"*{header}\t0")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Per-batch k-mer presence sketches for pre-screening COBS")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    p = subparsers.add_parser("build", help="build the sketch of a batch from its assemblies")
+    p.add_argument('asms_fn', metavar='batch.tar.xz', help='batch assemblies, or their URL to stream them')
+    p.add_argument('-k', type=int, default=DEFAULT_K, help=f'k-mer size (as in the COBS indexes) [{DEFAULT_K}]')
+    p.add_argument('--scale',
+                   type=int,
+                   default=DEFAULT_SCALE,
+                   help=f'keep about 1 k-mer out of this number (FracMinHash) [{DEFAULT_SCALE}]')
+    p.add_argument('-t', dest='threads', type=int, default=1, help='number of processes [1]')
+    p.add_argument('-o', dest='output', required=True, help='output sketch')
+    p.add_argument('--mirror',
+                   metavar='dir|url',
+                   action='append',
+                   default=[],
+                   help='if batch.tar.xz is a URL, where it is looked up first (can be repeated, see download.py)')
+    p.add_argument('--local',
+                   metavar='batch.tar.xz',
+                   default=None,
+                   help='if batch.tar.xz is a URL, read this file instead if it exists')
+    p.add_argument('--keep-copy',
+                   metavar='batch.tar.xz',
+                   default=None,
+                   help='if batch.tar.xz is a URL, also write the downloaded archive to this file')
+
+    p = subparsers.add_parser("prescreen", help="decide whether COBS needs to be run on a batch")
+    p.add_argument('sketch_fn', metavar='batch.kmer_sketch', help='sketch of the batch')
+    p.add_argument('query_fn', metavar='queries.fa', help='merged queries')
+    p.add_argument('-t', dest='threshold', type=float, required=True, help='COBS k-mer threshold')
+    p.add_argument('--mode', choices=["conservative", "estimate"], default="conservative", help='[conservative]')
+    p.add_argument('-o', dest='output', required=True, help='output file (first line: run/skip)')
+
+    p = subparsers.add_parser("empty-cobs-output", help="print COBS output with no matches")
+    p.add_argument('query_fn', metavar='queries.fa', help='merged queries')
+
+    args = parser.parse_args()
+
+    if args.subcommand == "build":
+        asms_fn = args.asms_fn
+        if "://" in asms_fn and args.local is not None and os.path.exists(args.local):
+            asms_fn = args.local
+        asms_stream = None
+        if "://" in asms_fn:
+            asms_stream = download.SourceStream(asms_fn, mirrors=args.mirror, copy_fn=args.keep_copy)
+            error(f"Streaming {asms_fn} from {asms_stream.source}")
+        build_sketch(asms_fn, args.output, args.k, args.scale, args.threads, asms_stream)
+        if asms_stream is not None:
+            # completes the write-through copy, if any
+            asms_stream.close()
+    elif args.subcommand == "prescreen":
+        prescreen(args.sketch_fn, args.query_fn, args.threshold, args.mode, args.output)
+    else:
+        print_empty_cobs_output(args.query_fn)
+
+
+if __name__ == "__main__":
+    main()
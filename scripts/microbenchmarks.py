@@ -0,0 +1,429 @@
+#! /usr/bin/env python3
+
+import argparse
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from xopen import xopen
+"""
+Microbenchmarks of the Python hot paths of the pipeline, on synthetic data.
+
+Every benchmark runs one function (FASTA/FASTQ parsing, cobs_iterator,
+SingleQuery housekeeping, process_cobs_output, load_qdicts, get_match) over synthetic data
+generated for every point of a parameter sweep (number of reads, hits per read,
+batches), and reports the best and median times of several repetitions. The
+results are stored as JSON, so that two commits can be compared:
+
+    scripts/microbenchmarks.py -o before.json
+    (change the code)
+    scripts/microbenchmarks.py -o after.json --compare before.json
+"""
+
+READ_LEN = 150
+
+# accessions as in the 661k collection (SAMN/SAMEA/SAMD + digits)
+ACCESSION_PREFIXES = ["SAMN", "SAMEA", "SAMD"]
+
+SWEEPS = {
+    "full": {
+        "nb_reads": [1000, 10000, 50000],
+        "hits_per_read": [1, 10, 100],
+        "nb_batches": [1, 10],
+    },
+    "quick": {
+        "nb_reads": [1000, 5000],
+        "hits_per_read": [10, 100],
+        "nb_batches": [1, 4],
+    },
+}
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+##################################
+## Synthetic data generators
+##################################
+
+
+def random_accession(rng):
+    return f"{rng.choice(ACCESSION_PREFIXES)}{rng.randrange(10**6, 10**8)}"
+
+
+def random_seq(rng, length=READ_LEN):
+    return "".join(rng.choices("ACGT", k=length))
+
+
+def generate_accessions(rng, nb_accessions):
+    return [random_accession(rng) for _ in range(nb_accessions)]
+
+
+def generate_cobs_output(rng, nb_reads, hits_per_read, accessions, postprocessed=False):
+    """COBS output: a "*qname<TAB>nb_hits" header per read, followed by "{rnd}_{accession}<TAB>kmers" lines
+    sorted by decreasing k-mer counts (without the random prefix if postprocessed)."""
+    lines = []
+    nb_kmers = READ_LEN - 31 + 1
+    for i in range(nb_reads):
+        lines.append(f"*read_{i} comment\t{hits_per_read}\n")
+        hits = sorted((rng.randrange(nb_kmers // 2, nb_kmers + 1) for _ in range(hits_per_read)), reverse=True)
+        for kmers in hits:
+            prefix = "" if postprocessed else f"{rng.randrange(10**4):04d}"
+            lines.append(f"{prefix}_{rng.choice(accessions)}\t{kmers}\n")
+    return "".join(lines)
+
+
+def generate_query_fasta(rng, nb_reads, accessions=None, hits_per_read=0, fastq=False):
+    """Query FASTA (or FASTQ); with accessions, annotated with the candidate references (as 04_filter)."""
+    lines = []
+    for i in range(nb_reads):
+        seq = random_seq(rng)
+        if accessions:
+            header = f"read_{i} " + ",".join(rng.choice(accessions) for _ in range(hits_per_read))
+        else:
+            header = f"read_{i}"
+        if fastq:
+            lines.append(f"@{header}\n{seq}\n+\n{'I' * len(seq)}\n")
+        else:
+            lines.append(f">{header}\n{seq}\n")
+    return "".join(lines)
+
+
+def generate_sam_lines(rng, nb_reads, hits_per_read, accessions):
+    """SAM summary lines (one alignment per hit, about 10% unmapped)."""
+    lines = []
+    for i in range(nb_reads):
+        for _ in range(hits_per_read):
+            if rng.random() < 0.1:
+                lines.append(f"read_{i}\t4\t*\t0\t0\t*\t*\t0\t0\t~\t*")
+            else:
+                contig = f"{rng.choice(accessions)}.contig{rng.randrange(1, 200):05d}"
+                pos = rng.randrange(1, 10**6)
+                lines.append(f"read_{i}\t0\t{contig}\t{pos}\t60\t{READ_LEN}=\t*\t0\t0\t~\t*\tNM:i:0\tAS:i:300")
+    return lines
+
+
+##################################
+## Benchmarks
+##################################
+
+
+def _write(tmp_dir, name, content):
+    fn = os.path.join(tmp_dir, name)
+    with open(fn, "w") as fo:
+        fo.write(content)
+    return fn
+
+
+def readfq(fp):
+    """Line-by-line FASTA/FASTQ parser on decoded lines (https://github.com/lh3/readfq/blob/master/readfq.py),
+    as used by the scripts before fastx.py, kept as the baseline of the parsing benchmarks."""
+    last = None
+    while True:
+        if not last:
+            for l in fp:
+                if l[0] in '>@':
+                    last = l[:-1]
+                    break
+        if not last:
+            break
+        name, seqs, last = last[1:].partition(" ")[0], [], None
+        for l in fp:
+            if l[0] in '@+>':
+                last = l[:-1]
+                break
+            seqs.append(l[:-1])
+        if not last or last[0] != '+':
+            yield name, ''.join(seqs), None
+            if not last:
+                break
+        else:
+            seq, leng, seqs = ''.join(seqs), 0, []
+            for l in fp:
+                seqs.append(l[:-1])
+                leng += len(l) - 1
+                if leng >= len(seq):
+                    last = None
+                    yield name, seq, ''.join(seqs)
+                    break
+            if last:
+                yield name, seq, None
+                break
+
+
+def bench_read_queries(rng, tmp_dir, nb_reads, parser, fastq=False, compressed=False):
+    """Load a query table (name -> sequence), as the scripts do."""
+    import fastx
+    content = generate_query_fasta(rng, nb_reads, fastq=fastq)
+    fn = _write(tmp_dir, "queries.fq" if fastq else "queries.fa", content)
+    if compressed:
+        with gzip.open(fn + ".gz", "wt", compresslevel=1) as fo:
+            fo.write(content)
+        fn += ".gz"
+
+    def run():
+        if parser == "readfq":
+            with xopen(fn) as f:
+                {name: seq for name, seq, _ in readfq(f)}
+        elif parser == "fastx":
+            {name: seq for name, _, seq, _ in fastx.iterate_over_records(fn)}
+        else:
+            {name: seq for records in fastx.iterate_over_batches(fn) for name, _, seq, _ in records}
+
+    return run, nb_reads
+
+
+def bench_cobs_iterator(rng, tmp_dir, nb_reads, hits_per_read):
+    import filter_queries
+    accessions = generate_accessions(rng, 1000)
+    fn = _write(tmp_dir, "b__01____q.txt",
+                generate_cobs_output(rng, nb_reads, hits_per_read, accessions, postprocessed=True))
+
+    def run():
+        with contextlib.redirect_stderr(io.StringIO()):
+            for _ in filter_queries.cobs_iterator(fn):
+                pass
+
+    return run, nb_reads * hits_per_read
+
+
+def bench_single_query_housekeeping(rng, tmp_dir, nb_reads, hits_per_read, nb_batches):
+    import filter_queries
+    accessions = generate_accessions(rng, 1000)
+    nb_kmers = READ_LEN - 31 + 1
+    batches = [[[(rng.choice(accessions), str(rng.randrange(nb_kmers // 2, nb_kmers + 1)))
+                 for _ in range(hits_per_read)]
+                for _ in range(nb_reads)]
+               for _ in range(nb_batches)]
+
+    def run():
+        queries = [filter_queries.SingleQuery(f"read_{i}", "", filter_queries.DEFAULT_KEEP) for i in range(nb_reads)]
+        for b, batch in enumerate(batches):
+            for query, matches in zip(queries, batch):
+                query.add_matches(f"batch__{b:02d}", matches)
+
+    return run, nb_reads * hits_per_read * nb_batches
+
+
+def bench_process_cobs_output(rng, tmp_dir, nb_reads, hits_per_read):
+    import filter_queries
+    import postprocess_cobs
+    accessions = generate_accessions(rng, 1000)
+    cobs_output = generate_cobs_output(rng, nb_reads, hits_per_read, accessions)
+
+    def run():
+        stdin = sys.stdin
+        sys.stdin = io.StringIO(cobs_output)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                postprocess_cobs.process_cobs_output(filter_queries.DEFAULT_KEEP)
+        finally:
+            sys.stdin = stdin
+
+    return run, nb_reads * hits_per_read
+
+
+def bench_load_qdicts(rng, tmp_dir, nb_reads, hits_per_read):
+    import batch_align
+    accessions = generate_accessions(rng, 1000)
+    query_fn = _write(tmp_dir, "filtered.fa", generate_query_fasta(rng, nb_reads, accessions, hits_per_read))
+    # the references of the batch are a part of the candidates
+    accessions_fn = _write(tmp_dir, "accessions.txt", "\n".join(accessions[:300]) + "\n")
+
+    def run():
+        batch_align.logging.disable(batch_align.logging.INFO)
+        try:
+            batch_align.load_qdicts(query_fn, accessions_fn)
+        finally:
+            batch_align.logging.disable(batch_align.logging.NOTSET)
+
+    return run, nb_reads * hits_per_read
+
+
+def bench_get_match(rng, tmp_dir, nb_reads, hits_per_read):
+    import final_stats
+    lines = generate_sam_lines(rng, nb_reads, hits_per_read, generate_accessions(rng, 1000))
+
+    def run():
+        for line in lines:
+            final_stats.get_match(line)
+
+    return run, len(lines)
+
+
+def get_benchmarks(sweep):
+    """List of (benchmark name, function, parameters)."""
+    benchmarks = []
+    for nb_reads in sweep["nb_reads"]:
+        for parser in ["readfq", "fastx", "fastx_batches"]:
+            for fastq, compressed in [(False, False), (True, False), (False, True)]:
+                variant = ",".join(["fastq"] * fastq + ["gz"] * compressed)
+                benchmarks.append((f"read_queries[{parser}{',' if variant else ''}{variant}]", bench_read_queries, {
+                    "parser": parser,
+                    "nb_reads": nb_reads,
+                    "fastq": fastq,
+                    "compressed": compressed,
+                }))
+        for hits_per_read in sweep["hits_per_read"]:
+            params = {"nb_reads": nb_reads, "hits_per_read": hits_per_read}
+            benchmarks.append(("cobs_iterator", bench_cobs_iterator, params))
+            benchmarks.append(("process_cobs_output", bench_process_cobs_output, params))
+            benchmarks.append(("load_qdicts", bench_load_qdicts, params))
+            benchmarks.append(("get_match", bench_get_match, params))
+            for nb_batches in sweep["nb_batches"]:
+                benchmarks.append(("SingleQuery._housekeeping", bench_single_query_housekeeping, {
+                    **params, "nb_batches": nb_batches
+                }))
+    return benchmarks
+
+
+def time_benchmark(run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def run_benchmarks(sweep_name, repeat, selected, seed):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="microbenchmarks_") as tmp_dir:
+        for name, bench, params in get_benchmarks(SWEEPS[sweep_name]):
+            if selected and not any(s in name for s in selected):
+                continue
+            # the same data for the same parameters, whatever benchmarks are selected
+            rng = random.Random(f"{seed}/{name}/{sorted(params.items())}")
+            run, nb_items = bench(rng, tmp_dir, **params)
+            times = time_benchmark(run, repeat)
+            result = {
+                "benchmark": name,
+                "params": params,
+                "items": nb_items,
+                "seconds_min": min(times),
+                "seconds_median": statistics.median(times),
+                "items_per_second": nb_items / min(times) if min(times) > 0 else None,
+            }
+            results.append(result)
+            error(f"{name:34} {json.dumps(params):70} {result['seconds_min']:9.4f} s")
+    return {
+        "commit": get_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "sweep": sweep_name,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def _result_key(result):
+    return result["benchmark"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(report, baseline):
+    """Print the speedup of every benchmark relative to a baseline report."""
+    baseline_results = {_result_key(result): result for result in baseline["results"]}
+    print("benchmark", "params", "baseline_s", "current_s", "speedup", sep="\t")
+    for result in report["results"]:
+        old = baseline_results.get(_result_key(result))
+        if old is None:
+            continue
+        speedup = old["seconds_min"] / result["seconds_min"] if result["seconds_min"] > 0 else float("inf")
+        print(result["benchmark"],
+              json.dumps(result["params"], sort_keys=True),
+              f"{old['seconds_min']:.4f}",
+              f"{result['seconds_min']:.4f}",
+              f"{speedup:.2f}",
+              sep="\t")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the Python hot paths on synthetic data")
+
+    parser.add_argument(
+        '-o',
+        dest='output_fn',
+        metavar='results.json',
+        default=None,
+        help='output JSON file [stdout]',
+    )
+
+    parser.add_argument(
+        '--sweep',
+        choices=sorted(SWEEPS),
+        default="quick",
+        help='parameter sweep [quick]',
+    )
+
+    parser.add_argument(
+        '--repeat',
+        metavar='int',
+        type=int,
+        default=3,
+        help='number of repetitions of every benchmark [3]',
+    )
+
+    parser.add_argument(
+        '-b',
+        dest='selected',
+        metavar='str',
+        action='append',
+        default=[],
+        help='run only the benchmarks whose name contains this string (can be used multiple times)',
+    )
+
+    parser.add_argument(
+        '--seed',
+        metavar='int',
+        type=int,
+        default=42,
+        help='seed of the synthetic data [42]',
+    )
+
+    parser.add_argument(
+        '--compare',
+        dest='baseline_fn',
+        metavar='baseline.json',
+        default=None,
+        help='print the speedups relative to the results of a previous run',
+    )
+
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sweep, args.repeat, args.selected, args.seed)
+    if args.output_fn is not None:
+        with open(args.output_fn, "w") as fo:
+            json.dump(report, fo, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline_fn is not None:
+        with open(args.baseline_fn) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,465 @@
+#! /usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import os
+import re
+import statistics
+import sys
+
+from pathlib import Path
+
+from calibrate_ram_models import load_index_sizes_in_MB, read_benchmark_log
+"""
+Run-wide performance report built from the benchmark logs of the jobs.
+
+Every job is benchmarked by scripts/benchmark.py into
+logs/benchmarks/{rule}/{job}.txt (wall time, CPU time, peak RSS, start and end
+times, requested mem_mb). This script reconstructs the timeline of the run and
+reports:
+
+    rules          - number of jobs, total/mean/max wall time, CPU time and throughput of every rule
+                     (GB of decompressed index per second for COBS, query-reference pairs per second for the
+                     mapping, from logs/05_map/)
+    timeline       - makespan, average and peak number of concurrent jobs, parallel efficiency
+                     (CPU time / (makespan x cores))
+    critical path  - chain of dependent jobs ending with the last one, every job being preceded by the last
+                     finished of its upstream jobs (rule upstream in the pipeline, same batch and query file)
+    RAM            - requested mem_mb vs measured peak RSS: under-reservations (the job used more than it
+                     requested) and over-reservations (it requested much more than it used)
+
+The text summary is printed to stdout and the complete report (with all the
+jobs) can be written as JSON (-o), so that runs and configurations can be
+compared. Logs written before start/end times were recorded are placed on the
+timeline using their modification time.
+"""
+
+BATCH_RE = re.compile(r"^(?P<batch>.+__\d\d)(____|$)")
+
+MAPPING_LOG_RE = re.compile(r"Computed (\d+) alignments of (\d+) queries to ")
+
+# rules whose throughput is the decompressed index size per second
+INDEX_RULES = ["decompress_cobs", "run_cobs"]
+MAPPING_RULE = "batch_align_minimap2"
+
+# benchmarked rules -> benchmarked rules whose outputs they use (downloads and query preprocessing are not benchmarked)
+UPSTREAM_RULES = {
+    "prescreen_batch": ["build_kmer_sketch"],
+    "run_cobs": ["decompress_cobs", "prescreen_batch"],
+    "translate_matches": ["run_cobs"],
+    "batch_align_minimap2": ["translate_matches"],
+    "aggregate_sams": ["batch_align_minimap2"],
+}
+
+# a job is preceded on the critical path by a job that finished at most this long after its start
+# (Snakemake schedules jobs asynchronously)
+CRITICAL_PATH_TOLERANCE_S = 1.0
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def _get_float(record, key):
+    try:
+        return float(record[key])
+    except (KeyError, ValueError):
+        return None
+
+
+def _get_qfile(rule, job):
+    """Query file key of a job ({batch}____{qfile} or {rule}___{qfile}), None for per-batch jobs."""
+    if "____" in job:
+        return job.split("____", 1)[1]
+    if job.startswith(f"{rule}___"):
+        return job[len(rule) + 3:]
+    return None
+
+
+def load_jobs(benchmarks_dir, since):
+    """Load the jobs from the benchmark logs of the rules (logs of whole-pipeline benchmarks are ignored)."""
+    jobs = []
+    for fn in sorted(Path(benchmarks_dir).glob("*/*.txt")):
+        record = read_benchmark_log(fn)
+        if record is None:
+            continue
+        real = _get_float(record, "real(s)")
+        if real is None:
+            continue
+        end = _get_float(record, "end_time")
+        start = _get_float(record, "start_time")
+        if end is None or start is None:
+            end = fn.stat().st_mtime
+            start = end - real
+        if since is not None and start < since:
+            continue
+        max_rss_kb = _get_float(record, "max_RAM(kb)")
+        m = BATCH_RE.match(fn.stem)
+        jobs.append({
+            "rule": fn.parent.name,
+            "job": fn.stem,
+            "batch": m.group("batch") if m else None,
+            "qfile": _get_qfile(fn.parent.name, fn.stem),
+            "start": start,
+            "end": end,
+            "wall_s": real,
+            "cpu_s": (_get_float(record, "user(s)") or 0.0) + (_get_float(record, "sys(s)") or 0.0),
+            "max_rss_mb": round(max_rss_kb / 1024, 1) if max_rss_kb is not None else None,
+            "requested_mem_mb": _get_float(record, "requested_mem_mb"),
+        })
+    return jobs
+
+
+def load_mapping_counts(mapping_log_fn):
+    """(query-reference pairs, alignments) computed by a mapping job, from its log (None if missing)."""
+    if not Path(mapping_log_fn).exists():
+        return None
+    pairs, alignments = 0, 0
+    with open(mapping_log_fn) as f:
+        for line in f:
+            m = MAPPING_LOG_RE.search(line)
+            if m:
+                alignments += int(m.group(1))
+                pairs += int(m.group(2))
+    return pairs, alignments
+
+
+def get_rule_stats(jobs, index_sizes, mapping_logs_dir):
+    rules = {}
+    for job in jobs:
+        if job["rule"] not in rules:
+            rules[job["rule"]] = {
+                "jobs": 0,
+                "total_wall_s": 0.0,
+                "max_wall_s": 0.0,
+                "cpu_s": 0.0,
+                "first_start": job["start"],
+                "last_end": job["end"],
+                "index_gb": 0.0,
+                "index_wall_s": 0.0,
+                "pairs": 0,
+                "alignments": 0,
+                "mapping_wall_s": 0.0,
+            }
+        rule = rules[job["rule"]]
+        rule["jobs"] += 1
+        rule["total_wall_s"] += job["wall_s"]
+        rule["max_wall_s"] = max(rule["max_wall_s"], job["wall_s"])
+        rule["cpu_s"] += job["cpu_s"]
+        rule["first_start"] = min(rule["first_start"], job["start"])
+        rule["last_end"] = max(rule["last_end"], job["end"])
+        if job["rule"] in INDEX_RULES and job["batch"] in index_sizes:
+            rule["index_gb"] += index_sizes[job["batch"]] / 1024
+            rule["index_wall_s"] += job["wall_s"]
+        if job["rule"] == MAPPING_RULE:
+            counts = load_mapping_counts(Path(mapping_logs_dir, f"{job['job']}.log"))
+            if counts is not None:
+                rule["pairs"] += counts[0]
+                rule["alignments"] += counts[1]
+                rule["mapping_wall_s"] += job["wall_s"]
+
+    for rule in rules.values():
+        rule["mean_wall_s"] = rule["total_wall_s"] / rule["jobs"]
+        throughput = {}
+        if rule["index_wall_s"]:
+            throughput["index_gb_per_s"] = rule["index_gb"] / rule["index_wall_s"]
+        if rule["mapping_wall_s"]:
+            throughput["pairs_per_s"] = rule["pairs"] / rule["mapping_wall_s"]
+            throughput["alignments_per_s"] = rule["alignments"] / rule["mapping_wall_s"]
+        rule["throughput"] = throughput
+        for key in ["index_gb", "index_wall_s", "pairs", "alignments", "mapping_wall_s"]:
+            del rule[key]
+    return rules
+
+
+def get_timeline(jobs, cores):
+    first_start = min(job["start"] for job in jobs)
+    last_end = max(job["end"] for job in jobs)
+    makespan = last_end - first_start
+    # sweep over the start and end events to find the peak number of concurrent jobs
+    events = sorted([(job["start"], 1) for job in jobs] + [(job["end"], -1) for job in jobs])
+    concurrent = 0
+    peak_concurrent = 0
+    for _, delta in events:
+        concurrent += delta
+        peak_concurrent = max(peak_concurrent, concurrent)
+    total_wall = sum(job["wall_s"] for job in jobs)
+    total_cpu = sum(job["cpu_s"] for job in jobs)
+    return {
+        "start": datetime.datetime.fromtimestamp(first_start).isoformat(timespec="seconds"),
+        "end": datetime.datetime.fromtimestamp(last_end).isoformat(timespec="seconds"),
+        "makespan_s": makespan,
+        "jobs": len(jobs),
+        "total_wall_s": total_wall,
+        "total_cpu_s": total_cpu,
+        "mean_concurrent_jobs": total_wall / makespan if makespan else None,
+        "peak_concurrent_jobs": peak_concurrent,
+        "cores": cores,
+        "parallel_efficiency": total_cpu / (makespan * cores) if makespan and cores else None,
+    }
+
+
+def _same_key(key_1, key_2):
+    """If two batch or query file keys can refer to the same data (None matches anything; the query file keys of
+    the passes of incremental_queries are joined query files)."""
+    return key_1 is None or key_2 is None or bool(set(key_1.split("___")) & set(key_2.split("___")))
+
+
+def is_upstream(job, current):
+    """If the output of a job is an input of the current job."""
+    return (job["rule"] in UPSTREAM_RULES.get(current["rule"], []) and _same_key(job["batch"], current["batch"]) and
+            _same_key(job["qfile"], current["qfile"]))
+
+
+def get_critical_path(jobs):
+    """Chain of dependent jobs ending with the last one, every job preceded by its last finished upstream job."""
+    by_end = sorted(jobs, key=lambda job: job["end"])
+    path = [by_end[-1]]
+    while True:
+        current = path[-1]
+        predecessors = [
+            job for job in by_end
+            if is_upstream(job, current) and job["end"] <= current["start"] + CRITICAL_PATH_TOLERANCE_S
+        ]
+        if not predecessors:
+            break
+        path.append(predecessors[-1])
+    path.reverse()
+    first_start = min(job["start"] for job in jobs)
+    return [
+        {
+            "rule": job["rule"],
+            "job": job["job"],
+            "start_s": job["start"] - first_start,
+            "wall_s": job["wall_s"],
+            # time between the end of the previous job of the path and the start of this one (scheduling, waiting for
+            # resources)
+            "wait_s": max(job["start"] - (previous["end"] if previous else first_start), 0.0),
+        } for previous, job in zip([None] + path[:-1], path)
+    ]
+
+
+def get_ram_stats(jobs, over_factor, over_min_mb):
+    """Requested vs measured RAM per rule, and the flagged jobs."""
+    rules = {}
+    flagged = []
+    for job in jobs:
+        requested, used = job["requested_mem_mb"], job["max_rss_mb"]
+        if requested is None or used is None:
+            continue
+        rule = rules.setdefault(job["rule"], {
+            "jobs": 0,
+            "max_requested_mb": 0.0,
+            "max_used_mb": 0.0,
+            "ratios": [],
+            "under": 0,
+            "over": 0,
+            "unused_gb_h": 0.0
+        })
+        rule["jobs"] += 1
+        rule["max_requested_mb"] = max(rule["max_requested_mb"], requested)
+        rule["max_used_mb"] = max(rule["max_used_mb"], used)
+        rule["ratios"].append(used / requested if requested else float("inf"))
+        rule["unused_gb_h"] += max(requested - used, 0.0) / 1024 * job["wall_s"] / 3600
+        if used > requested:
+            rule["under"] += 1
+            flagged.append({**job, "flag": "under"})
+        elif requested > over_factor * used and requested - used > over_min_mb:
+            rule["over"] += 1
+            flagged.append({**job, "flag": "over"})
+    for rule in rules.values():
+        rule["median_used_to_requested"] = statistics.median(rule.pop("ratios"))
+    flagged.sort(key=lambda job: -abs(job["requested_mem_mb"] - job["max_rss_mb"]))
+    return rules, flagged
+
+
+def print_summary(report, top):
+    timeline = report["timeline"]
+    print(f"# Timeline: {timeline['jobs']} jobs from {timeline['start']} to {timeline['end']}")
+    print("makespan_s",
+          "total_wall_s",
+          "total_cpu_s",
+          "mean_concurrent_jobs",
+          "peak_concurrent_jobs",
+          "cores",
+          "parallel_efficiency",
+          sep="\t")
+    print(f"{timeline['makespan_s']:.1f}",
+          f"{timeline['total_wall_s']:.1f}",
+          f"{timeline['total_cpu_s']:.1f}",
+          f"{timeline['mean_concurrent_jobs']:.2f}" if timeline["mean_concurrent_jobs"] is not None else "NA",
+          timeline["peak_concurrent_jobs"],
+          timeline["cores"],
+          f"{timeline['parallel_efficiency']:.3f}" if timeline["parallel_efficiency"] is not None else "NA",
+          sep="\t")
+
+    print()
+    print("# Rules")
+    print("rule",
+          "jobs",
+          "total_wall_s",
+          "share",
+          "mean_wall_s",
+          "max_wall_s",
+          "cpu_s",
+          "first_start_s",
+          "last_end_s",
+          "throughput",
+          sep="\t")
+    first_start = min(job["start"] for job in report["jobs"])
+    total_wall = timeline["total_wall_s"]
+    for name, rule in sorted(report["rules"].items(), key=lambda item: -item[1]["total_wall_s"]):
+        print(name,
+              rule["jobs"],
+              f"{rule['total_wall_s']:.1f}",
+              f"{rule['total_wall_s'] / total_wall:.3f}" if total_wall else "NA",
+              f"{rule['mean_wall_s']:.2f}",
+              f"{rule['max_wall_s']:.2f}",
+              f"{rule['cpu_s']:.1f}",
+              f"{rule['first_start'] - first_start:.1f}",
+              f"{rule['last_end'] - first_start:.1f}",
+              ",".join(f"{key}={value:.3g}" for key, value in rule["throughput"].items()) or "NA",
+              sep="\t")
+
+    print()
+    path = report["critical_path"]
+    print(f"# Critical path: {len(path)} jobs, {sum(job['wall_s'] for job in path):.1f} s running, "
+          f"{sum(job['wait_s'] for job in path):.1f} s waiting")
+    print("rule", "job", "start_s", "wait_s", "wall_s", sep="\t")
+    for job in path:
+        print(job["rule"],
+              job["job"],
+              f"{job['start_s']:.1f}",
+              f"{job['wait_s']:.1f}",
+              f"{job['wall_s']:.1f}",
+              sep="\t")
+
+    print()
+    print("# RAM: requested mem_mb vs measured peak RSS")
+    print("rule",
+          "jobs",
+          "max_requested_mb",
+          "max_used_mb",
+          "median_used_to_requested",
+          "under",
+          "over",
+          "unused_GB_h",
+          sep="\t")
+    for name, rule in sorted(report["ram"]["rules"].items()):
+        print(name,
+              rule["jobs"],
+              f"{rule['max_requested_mb']:.0f}",
+              f"{rule['max_used_mb']:.0f}",
+              f"{rule['median_used_to_requested']:.3f}",
+              rule["under"],
+              rule["over"],
+              f"{rule['unused_gb_h']:.3f}",
+              sep="\t")
+    flagged = report["ram"]["flagged"]
+    if flagged:
+        print()
+        print(f"# Flagged jobs ({len(flagged)}, the {top} largest differences)")
+        print("flag", "rule", "job", "requested_mb", "used_mb", sep="\t")
+        for job in flagged[:top]:
+            print(job["flag"],
+                  job["rule"],
+                  job["job"],
+                  f"{job['requested_mem_mb']:.0f}",
+                  f"{job['max_rss_mb']:.0f}",
+                  sep="\t")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run-wide performance report built from the benchmark logs")
+
+    parser.add_argument(
+        '--benchmarks-dir',
+        default="logs/benchmarks",
+        help='directory with the benchmark logs [logs/benchmarks]',
+    )
+
+    parser.add_argument(
+        '--mapping-logs-dir',
+        default="logs/05_map",
+        help='directory with the logs of the mapping jobs [logs/05_map]',
+    )
+
+    parser.add_argument(
+        '--indexes-sizes',
+        default="data/decompressed_indexes_sizes.txt",
+        help='decompressed COBS index sizes [data/decompressed_indexes_sizes.txt]',
+    )
+
+    parser.add_argument(
+        '--since',
+        metavar='datetime',
+        type=lambda s: datetime.datetime.fromisoformat(s).timestamp(),
+        default=None,
+        help='only jobs started since then (e.g., "2024-01-31 12:00"), to select the last run [all the logs]',
+    )
+
+    parser.add_argument(
+        '--cores',
+        type=int,
+        default=os.cpu_count(),
+        help=f'cores available to the run, for the parallel efficiency [{os.cpu_count()}]',
+    )
+
+    parser.add_argument(
+        '--over-factor',
+        type=float,
+        default=2.0,
+        help='flag jobs requesting more than this factor times the RAM they used [2.0]',
+    )
+
+    parser.add_argument(
+        '--over-min-mb',
+        type=float,
+        default=500,
+        help='... and at least this many MB more [500]',
+    )
+
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=20,
+        help='number of flagged jobs printed [20]',
+    )
+
+    parser.add_argument(
+        '-o',
+        dest='output_fn',
+        metavar='report.json',
+        default=None,
+        help='write the complete report as JSON',
+    )
+
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.benchmarks_dir, args.since)
+    if not jobs:
+        error(f"No benchmark logs found in {args.benchmarks_dir}")
+        sys.exit(1)
+    index_sizes = load_index_sizes_in_MB(args.indexes_sizes) if Path(args.indexes_sizes).exists() else {}
+    ram_rules, flagged = get_ram_stats(jobs, args.over_factor, args.over_min_mb)
+    report = {
+        "timeline": get_timeline(jobs, args.cores),
+        "rules": get_rule_stats(jobs, index_sizes, args.mapping_logs_dir),
+        "critical_path": get_critical_path(jobs),
+        "ram": {
+            "rules": ram_rules,
+            "flagged": flagged,
+        },
+        "jobs": jobs,
+    }
+    print_summary(report, args.top)
+    if args.output_fn is not None:
+        with open(args.output_fn, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
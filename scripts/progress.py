@@ -0,0 +1,283 @@
+#! /usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import lzma
+import os
+import re
+import sys
+import time
+
+from pathlib import Path
+
+import fastx
+from calibrate_ram_models import QUERY_EXTENSIONS, load_index_sizes_in_MB, read_benchmark_log
+"""
+Progress and estimated finish time of a run (companion of `make match` / `make map`).
+
+The state of the jobs is read from their benchmark logs (benchmark.py writes
+the header when a job starts and the statistics when it ends) and outputs. The
+jobs are weighted by their expected cost:
+
+    match  - COBS jobs, weighted by the size of the decompressed index of the batch (GB)
+    map    - mapping jobs, weighted by the number of query-reference candidate pairs of the batch (from
+             intermediate/04_filter/{qfile}.fa, or 1 per job before the candidates are known)
+
+Every stage is reported with its completed jobs and weight, the rate over
+the whole run and over the last --window seconds (weight per second, all the
+parallel jobs together, measured from the jobs completed in the current run),
+and the remaining time at the recent rate (the run rate if no job finished
+recently). The stages run one after the other, so the projected finish time
+is the sum of their remaining times (unknown until the rate of every stage
+with pending work can be measured).
+
+The progress is written as JSON (atomically, so it can be read at any time):
+
+    scripts/progress.py watch --batches data/batches.txt -o logs/progress.json
+    scripts/progress.py show logs/progress.json
+
+Subcommands:
+    update  - compute the progress once
+    watch   - update the progress every --interval seconds and print a status line, until the run is finished
+    show    - print a progress file
+"""
+
+DEFAULT_INTERVAL = 60
+DEFAULT_WINDOW = 900
+
+STAGES = ["match", "map"]
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def get_default_qfile(input_dir):
+    """Name of the merged queries of all the files in input/ (as in the Snakefile)."""
+    names = sorted(fn.with_suffix("").name for ext in QUERY_EXTENSIONS for fn in Path(input_dir).glob(f"*.{ext}"))
+    return "___".join(names)
+
+
+def load_accession_to_batch(accessions_fn):
+    accession_to_batch = {}
+    with lzma.open(accessions_fn, "rt") as f:
+        for line in f:
+            batch, _, accessions = line.strip().partition("\t")
+            for accession in re.split(';|,', accessions):
+                accession_to_batch[accession] = batch
+    return accession_to_batch
+
+
+def load_candidate_pairs(candidates_fn, accession_to_batch):
+    """Batch -> number of query-reference candidate pairs."""
+    pairs = {}
+    for _, comment, _, _ in fastx.iterate_over_records(candidates_fn):
+        if not comment:
+            continue
+        for rname in comment.decode().split(","):
+            batch = accession_to_batch.get(rname)
+            if batch is not None:
+                pairs[batch] = pairs.get(batch, 0) + 1
+    return pairs
+
+
+def get_job_state(benchmark_log_fn, output_fn):
+    """("done", start, end), ("running", start, None) or ("pending", None, None)."""
+    if not benchmark_log_fn.exists():
+        # jobs without any query to process write their output without being benchmarked
+        if output_fn is not None and output_fn.exists():
+            return "done", None, None
+        return "pending", None, None
+    record = read_benchmark_log(benchmark_log_fn)
+    if record is None:
+        return "running", benchmark_log_fn.stat().st_mtime, None
+    try:
+        return "done", float(record["start_time"]), float(record["end_time"])
+    except (KeyError, ValueError):
+        end = benchmark_log_fn.stat().st_mtime
+        return "done", end - float(record["real(s)"]), end
+
+
+def get_stage_progress(jobs, since, now, window):
+    """Progress of a stage from its jobs [(weight, state, start, end)]."""
+    total_weight = sum(weight for weight, _, _, _ in jobs)
+    done_weight = sum(weight for weight, state, _, _ in jobs if state == "done")
+    # rates from the jobs that ran in the current run
+    run_jobs = [(weight, start, end)
+                for weight, state, start, end in jobs
+                if state == "done" and start is not None and start >= since]
+    run_start = min((start for _, start, _ in run_jobs), default=None)
+    run_rate = None
+    if run_jobs and now > run_start:
+        run_rate = sum(weight for weight, _, _ in run_jobs) / (now - run_start)
+    recent_start = max(now - window, run_start) if run_start is not None else None
+    recent_rate = None
+    if recent_start is not None and now > recent_start:
+        recent_weight = sum(weight for weight, _, end in run_jobs if end >= recent_start)
+        if recent_weight:
+            recent_rate = recent_weight / (now - recent_start)
+    rate = recent_rate or run_rate
+    remaining = total_weight - done_weight
+    if not remaining:
+        eta = 0.0
+    else:
+        eta = remaining / rate if rate else None
+    return {
+        "jobs": len(jobs),
+        "done": sum(1 for _, state, _, _ in jobs if state == "done"),
+        "running": sum(1 for _, state, _, _ in jobs if state == "running"),
+        "weight": total_weight,
+        "weight_done": done_weight,
+        "fraction_done": done_weight / total_weight if total_weight else 1.0,
+        "run_rate": run_rate,
+        "recent_rate": recent_rate,
+        "eta_s": eta,
+    }
+
+
+class ProgressTracker:
+
+    def __init__(self, batches_fn, qfile, indexes_sizes_fn, accessions_fn, benchmarks_dir, since, window):
+        with open(batches_fn) as fin:
+            self.batches = sorted(filter(len, map(str.strip, fin)))
+        self.qfile = qfile
+        self.index_sizes = load_index_sizes_in_MB(indexes_sizes_fn)
+        self.accessions_fn = accessions_fn
+        self.benchmarks_dir = Path(benchmarks_dir)
+        self.since = since
+        self.window = window
+        self.candidates_fn = Path(f"intermediate/04_filter/{qfile}.fa")
+        self.candidate_pairs = None
+        self.candidates_mtime = None
+
+    def _get_candidate_pairs(self):
+        """Candidate pairs per batch, reloaded only if the candidates changed (None if not known yet)."""
+        if not self.candidates_fn.exists():
+            return None
+        mtime = self.candidates_fn.stat().st_mtime
+        if mtime != self.candidates_mtime:
+            self.candidate_pairs = load_candidate_pairs(str(self.candidates_fn),
+                                                        load_accession_to_batch(self.accessions_fn))
+            self.candidates_mtime = mtime
+        return self.candidate_pairs
+
+    def update(self):
+        now = time.time()
+        match_jobs = []
+        map_jobs = []
+        candidate_pairs = self._get_candidate_pairs()
+        for batch in self.batches:
+            job = f"{batch}____{self.qfile}"
+            state = get_job_state(self.benchmarks_dir / "run_cobs" / f"{job}.txt",
+                                  Path(f"intermediate/03_match/{job}.gz"))
+            match_jobs.append((self.index_sizes.get(batch, 0.0) / 1024, *state))
+            state = get_job_state(self.benchmarks_dir / "batch_align_minimap2" / f"{job}.txt", None)
+            map_jobs.append((candidate_pairs.get(batch, 0) if candidate_pairs is not None else 1, *state))
+
+        stages = {
+            "match": get_stage_progress(match_jobs, self.since, now, self.window),
+            "map": get_stage_progress(map_jobs, self.since, now, self.window),
+        }
+        stages["match"]["unit"] = "index_GB"
+        stages["map"]["unit"] = "candidate_pairs" if candidate_pairs is not None else "jobs"
+        etas = [stage["eta_s"] for stage in stages.values()]
+        eta = None if None in etas else sum(etas)
+        finish = datetime.datetime.fromtimestamp(now + eta).isoformat(timespec="seconds") if eta is not None else None
+        return {
+            "updated": datetime.datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+            "qfile": self.qfile,
+            "stages": stages,
+            "eta_s": eta,
+            "finish": finish,
+        }
+
+
+def write_progress(progress, output_fn):
+    tmp_fn = f"{output_fn}.tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(progress, f, indent=2)
+        f.write("\n")
+    os.replace(tmp_fn, output_fn)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+
+def format_status(progress):
+    parts = [progress["updated"]]
+    for name in STAGES:
+        stage = progress["stages"][name]
+        rate = stage["recent_rate"] or stage["run_rate"]
+        parts.append(f"{name} {stage['done']}/{stage['jobs']} jobs ({stage['running']} running), "
+                     f"{100 * stage['fraction_done']:.1f}% of {stage['weight']:.4g} {stage['unit']}, "
+                     f"{f'{rate:.3g}' if rate else '?'} {stage['unit']}/s, {format_duration(stage['eta_s'])} left")
+    parts.append(f"finish: {progress['finish'] or '?'}")
+    return " | ".join(parts)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Progress and estimated finish time of a run")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    for subcommand in ["update", "watch"]:
+        p = subparsers.add_parser(subcommand)
+        p.add_argument('--batches', required=True, help='file with the list of batches')
+        p.add_argument('--qfile',
+                       default=None,
+                       help='merged query file of the run [the query files in input/, joined by ___]')
+        p.add_argument('--indexes-sizes',
+                       default="data/decompressed_indexes_sizes.txt",
+                       help='decompressed COBS index sizes [data/decompressed_indexes_sizes.txt]')
+        p.add_argument('--accessions',
+                       default="data/661k_batches.txt.xz",
+                       help='accessions of the batches [data/661k_batches.txt.xz]')
+        p.add_argument('--benchmarks-dir',
+                       default="logs/benchmarks",
+                       help='directory with the benchmark logs [logs/benchmarks]')
+        p.add_argument('--since',
+                       metavar='datetime',
+                       type=lambda s: datetime.datetime.fromisoformat(s).timestamp(),
+                       default=None,
+                       help='start of the current run, only the jobs started since then are used for the '
+                       'rates [all]')
+        p.add_argument('--window',
+                       type=float,
+                       default=DEFAULT_WINDOW,
+                       help=f'seconds over which the recent rates are measured [{DEFAULT_WINDOW}]')
+        p.add_argument('-o', dest='output_fn', default="logs/progress.json", help='progress file [logs/progress.json]')
+        if subcommand == "watch":
+            p.add_argument('--interval',
+                           type=float,
+                           default=DEFAULT_INTERVAL,
+                           help=f'seconds between updates [{DEFAULT_INTERVAL}]')
+
+    p = subparsers.add_parser("show")
+    p.add_argument('progress', metavar='progress.json', nargs='?', default="logs/progress.json")
+
+    args = parser.parse_args()
+
+    if args.subcommand == "show":
+        with open(args.progress) as f:
+            print(format_status(json.load(f)))
+        return
+
+    tracker = ProgressTracker(args.batches, args.qfile or get_default_qfile("input"), args.indexes_sizes,
+                              args.accessions, args.benchmarks_dir, args.since or 0.0, args.window)
+    Path(args.output_fn).parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        progress = tracker.update()
+        write_progress(progress, args.output_fn)
+        print(format_status(progress), flush=True)
+        if args.subcommand == "update" or progress["eta_s"] == 0.0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
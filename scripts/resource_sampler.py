@@ -0,0 +1,316 @@
+#! /usr/bin/env python3
+
+import argparse
+import os
+import signal
+import sys
+import time
+
+from pathlib import Path
+"""
+Time series of the resources used by a job (its process tree or its cgroup), sampled from /proc (Linux), or
+with psutil where there is no /proc (e.g., macOS, process tree only).
+
+Started by scripts/benchmark.py next to the benchmarked command, the sampler
+records every --interval seconds one TSV line:
+
+    t_s        - seconds since the start of the sampling
+    rss_mb     - RSS of the process tree (sum over its processes), or memory.current of the cgroup
+    cpu_s      - CPU time (user + sys) used so far
+    read_mb    - bytes read from storage so far
+    write_mb   - bytes written to storage so far
+    threads    - number of threads
+    procs      - number of processes
+
+With --scope tree, the processes are the root process and all its
+descendants, found at every sample; the CPU time and the I/O of processes
+that exit are kept (as of their last sample). With --scope cgroup, the
+counters of the cgroup (v2) of the root process are used instead, which also
+covers processes that are not descendants of the root (e.g., when the job
+runs in its own cgroup on a cluster). The sampler stops when the root process
+exits.
+
+Subcommands:
+    record   - sample a process tree or a cgroup into a TSV file
+    summary  - peak RSS (and when it happened), mean CPU usage and I/O of sample files
+"""
+
+HEADER = ["t_s", "rss_mb", "cpu_s", "read_mb", "write_mb", "threads", "procs"]
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+MB = 2**20
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def read_proc_stat(pid):
+    """(ppid, CPU time in s, number of threads, RSS in bytes) of a process, or None if it is gone (or a zombie)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name (2nd field) can contain spaces and parentheses
+    fields = stat[stat.rfind(")") + 2:].split()
+    if fields[0] == "Z":
+        return None
+    ppid = int(fields[1])
+    cpu_s = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    threads = int(fields[17])
+    rss = int(fields[21]) * PAGE_SIZE
+    return ppid, cpu_s, threads, rss
+
+
+def read_proc_io(pid):
+    """(read bytes, written bytes) of a process from storage (0, 0 if not readable)."""
+    read_bytes, write_bytes = 0, 0
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "read_bytes":
+                    read_bytes = int(value)
+                elif key == "write_bytes":
+                    write_bytes = int(value)
+    except OSError:
+        pass
+    return read_bytes, write_bytes
+
+
+class ProcessTreeSampler:
+    """Samples the root process and all its descendants."""
+
+    def __init__(self, root_pid):
+        self.root_pid = root_pid
+        # pid -> last (CPU time, read bytes, written bytes), kept after the process exits
+        self.counters = {}
+
+    def sample(self):
+        stats = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                stat = read_proc_stat(int(entry))
+                if stat is not None:
+                    stats[int(entry)] = stat
+        if self.root_pid not in stats:
+            return None
+        children = {}
+        for pid, stat in stats.items():
+            children.setdefault(stat[0], []).append(pid)
+        tree = [self.root_pid]
+        for pid in tree:
+            tree.extend(children.get(pid, []))
+
+        rss = threads = 0
+        for pid in tree:
+            _, cpu_s, nb_threads, pid_rss = stats[pid]
+            rss += pid_rss
+            threads += nb_threads
+            self.counters[pid] = (cpu_s, *read_proc_io(pid))
+        cpu_s = sum(c[0] for c in self.counters.values())
+        read_bytes = sum(c[1] for c in self.counters.values())
+        write_bytes = sum(c[2] for c in self.counters.values())
+        return rss, cpu_s, read_bytes, write_bytes, threads, len(tree)
+
+
+class PsutilProcessTreeSampler:
+    """Samples the root process and all its descendants with psutil (platforms without /proc)."""
+
+    def __init__(self, root_pid):
+        import psutil
+        self.psutil = psutil
+        self.root = psutil.Process(root_pid)
+        # pid -> last (CPU time, read bytes, written bytes), kept after the process exits
+        self.counters = {}
+
+    def sample(self):
+        try:
+            if self.root.status() == self.psutil.STATUS_ZOMBIE:
+                return None
+            tree = [self.root, *self.root.children(recursive=True)]
+        except self.psutil.Error:
+            return None
+
+        rss = threads = procs = 0
+        for process in tree:
+            try:
+                with process.oneshot():
+                    pid_rss = process.memory_info().rss
+                    cpu_times = process.cpu_times()
+                    nb_threads = process.num_threads()
+                    try:
+                        io = process.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except (AttributeError, self.psutil.AccessDenied):
+                        # no I/O counters on macOS
+                        read_bytes, write_bytes = 0, 0
+            except self.psutil.Error:
+                continue
+            rss += pid_rss
+            threads += nb_threads
+            procs += 1
+            self.counters[process.pid] = (cpu_times.user + cpu_times.system, read_bytes, write_bytes)
+        cpu_s = sum(c[0] for c in self.counters.values())
+        read_bytes = sum(c[1] for c in self.counters.values())
+        write_bytes = sum(c[2] for c in self.counters.values())
+        return rss, cpu_s, read_bytes, write_bytes, threads, procs
+
+
+class CgroupSampler:
+    """Samples the counters of the cgroup (v2) of the root process."""
+
+    def __init__(self, root_pid):
+        self.root_pid = root_pid
+        with open(f"/proc/{root_pid}/cgroup") as f:
+            lines = f.read().splitlines()
+        paths = [line.split(":", 2)[2] for line in lines if line.startswith("0::")]
+        if not paths:
+            raise OSError("cgroup v2 not available")
+        self.cgroup_dir = Path("/sys/fs/cgroup", paths[0].lstrip("/"))
+
+    def _read(self, name):
+        with open(self.cgroup_dir / name) as f:
+            return f.read()
+
+    def sample(self):
+        if not Path(f"/proc/{self.root_pid}").exists():
+            return None
+        rss = int(self._read("memory.current"))
+        cpu_s = 0.0
+        for line in self._read("cpu.stat").splitlines():
+            key, value = line.split()
+            if key == "usage_usec":
+                cpu_s = int(value) / 1e6
+        read_bytes = write_bytes = 0
+        try:
+            for line in self._read("io.stat").splitlines():
+                for field in line.split()[1:]:
+                    key, _, value = field.partition("=")
+                    if key == "rbytes":
+                        read_bytes += int(value)
+                    elif key == "wbytes":
+                        write_bytes += int(value)
+        except OSError:
+            pass
+        try:
+            threads = int(self._read("pids.current"))
+        except OSError:
+            threads = len(self._read("cgroup.threads").split())
+        procs = len(self._read("cgroup.procs").split())
+        return rss, cpu_s, read_bytes, write_bytes, threads, procs
+
+
+def record(root_pid, output_fn, interval, scope):
+    if Path("/proc/self/stat").exists():
+        sampler = ProcessTreeSampler(root_pid)
+    else:
+        try:
+            sampler = PsutilProcessTreeSampler(root_pid)
+        except ImportError:
+            error("Resource sampling needs /proc (Linux) or psutil, no samples recorded")
+            return
+    if scope == "cgroup":
+        try:
+            sampler = CgroupSampler(root_pid)
+        except OSError as e:
+            error(f"Cannot sample the cgroup of {root_pid} ({e}), sampling its process tree")
+
+    # stop cleanly (the last samples are flushed) when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start = time.monotonic()
+    with open(output_fn, "w") as f:
+        print(*HEADER, sep="\t", file=f)
+        try:
+            while True:
+                t = time.monotonic() - start
+                sample = sampler.sample()
+                if sample is None:
+                    break
+                rss, cpu_s, read_bytes, write_bytes, threads, procs = sample
+                print(f"{t:.2f}",
+                      f"{rss / MB:.1f}",
+                      f"{cpu_s:.2f}",
+                      f"{read_bytes / MB:.1f}",
+                      f"{write_bytes / MB:.1f}",
+                      threads,
+                      procs,
+                      sep="\t",
+                      file=f)
+                time.sleep(max(interval - (time.monotonic() - start - t), 0.0))
+        finally:
+            f.flush()
+
+
+def read_samples(fn):
+    with open(fn) as f:
+        header = f.readline().strip().split("\t")
+        return [dict(zip(header, map(float, line.split("\t")))) for line in f if line.strip()]
+
+
+def get_peak_rss_mb(fn):
+    """Peak RSS in a sample file (None if there is no sample)."""
+    samples = read_samples(fn)
+    return max((s["rss_mb"] for s in samples), default=None)
+
+
+def summary(sample_fns):
+    print("samples_file",
+          "duration_s",
+          "peak_rss_mb",
+          "peak_at_s",
+          "mean_cpus",
+          "read_mb",
+          "write_mb",
+          "max_threads",
+          "max_procs",
+          sep="\t")
+    for fn in sample_fns:
+        samples = read_samples(fn)
+        if not samples:
+            print(fn, *["NA"] * 8, sep="\t")
+            continue
+        peak = max(samples, key=lambda s: s["rss_mb"])
+        last = samples[-1]
+        print(fn,
+              f"{last['t_s']:.1f}",
+              f"{peak['rss_mb']:.1f}",
+              f"{peak['t_s']:.1f}",
+              f"{last['cpu_s'] / last['t_s']:.2f}" if last["t_s"] else "NA",
+              f"{last['read_mb']:.1f}",
+              f"{last['write_mb']:.1f}",
+              int(max(s["threads"] for s in samples)),
+              int(max(s["procs"] for s in samples)),
+              sep="\t")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Resources used by a job over time (process tree or cgroup)")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    p = subparsers.add_parser("record")
+    p.add_argument('pid', type=int, help='root process of the job')
+    p.add_argument('output', metavar='samples.tsv', help='TSV output')
+    p.add_argument('--interval', metavar='float', type=float, default=1.0, help='seconds between samples [1.0]')
+    p.add_argument('--scope',
+                   choices=["tree", "cgroup"],
+                   default="tree",
+                   help='sample the process tree of pid or its cgroup (v2) [tree]')
+
+    p = subparsers.add_parser("summary")
+    p.add_argument('samples', metavar='samples.tsv', nargs='+', help='sample files')
+
+    args = parser.parse_args()
+
+    if args.subcommand == "record":
+        record(args.pid, args.output, args.interval, args.scope)
+    elif args.subcommand == "summary":
+        summary(args.samples)
+
+
+if __name__ == "__main__":
+    main()
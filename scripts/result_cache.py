@@ -0,0 +1,358 @@
+#! /usr/bin/env python3
+
+import argparse
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import fastx
+"""
+Persistent cross-run cache of the per-batch results of the queries (result_cache_dir).
+
+Results are keyed by the hash of the (preprocessed) query sequence, so they are
+reused independently of the query names and input files. Every batch has its
+own SQLite database {cache_dir}/{batch}.sqlite with two tables:
+
+    matches     - (sequence, index version, COBS parameters) -> postprocessed COBS matches in the batch
+    alignments  - (sequence, reference, assemblies version, minimap2 parameters) -> minimap2 records
+                  (without the query name)
+
+The version of an index or of the assemblies is derived from the name and the
+size of the downloaded file, so the results of an updated batch are never
+reused. Every hit updates the last-used time of the entry, and `evict` removes
+the least recently used entries until the cache fits in its size budget.
+
+Subcommands:
+    lookup         - split the queries into the ones with cached matches in all the batches (whose COBS outputs
+                     are written from the cache) and the misses, which still need to be matched by COBS
+    store-matches  - store the COBS matches of the misses
+    evict          - shrink the cache to a size budget (least recently used entries first)
+    stats          - print the number and the size of the cached entries
+
+The alignments are looked up and stored directly by batch_align.py (--result-cache).
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    seq_hash TEXT, version TEXT, params TEXT, nb_matches INTEGER, lines TEXT, last_used INTEGER,
+    PRIMARY KEY (seq_hash, version, params));
+CREATE TABLE IF NOT EXISTS alignments (
+    seq_hash TEXT, rname TEXT, version TEXT, params TEXT, lines TEXT, last_used INTEGER,
+    PRIMARY KEY (seq_hash, rname, version, params));
+CREATE INDEX IF NOT EXISTS matches_last_used ON matches (last_used);
+CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used);
+"""
+
+TABLES = ["matches", "alignments"]
+
+# maximum number of sequence hashes per SQL query (SQLite limits the number of variables)
+SQL_CHUNK_SIZE = 500
+
+# estimated storage overhead of an entry in addition to its lines (key, timestamps, B-tree)
+ENTRY_OVERHEAD_BYTES = 100
+
+# concurrent jobs (e.g., mapping of several query files to the same batch) wait for each other
+SQLITE_TIMEOUT = 600
+
+DEFAULT_MAX_GB = 50
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def get_seq_hash(seq):
+    """Hash of a normalised query sequence."""
+    return hashlib.blake2b(seq.strip().upper().encode(), digest_size=16).hexdigest()
+
+
+def get_file_version(fn):
+    """Version of a downloaded batch file (index or assemblies)."""
+    return f"{os.path.basename(fn)}:{os.path.getsize(fn)}"
+
+
+def get_batch_name(fn):
+    return os.path.basename(fn).split(".")[0]
+
+
+def get_cache_fn(cache_dir, batch):
+    return os.path.join(cache_dir, f"{batch}.sqlite")
+
+
+def get_minimap_params(minimap_preset, minimap_extra_params):
+    return f"preset={minimap_preset},extra={minimap_extra_params or ''}"
+
+
+def _chunks(items, size=SQL_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ResultCache:
+    """Results of one batch, restricted to one version of the batch and one set of parameters."""
+
+    def __init__(self, db_fn, version, params):
+        self.version = version
+        self.params = params
+        Path(db_fn).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(db_fn, timeout=SQLITE_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.now = int(time.time())
+
+    def _select(self, table, columns, seq_hashes, extra_condition="", extra_values=(), touch=True):
+        rows = []
+        for chunk in _chunks(seq_hashes):
+            condition = (f"version = ? AND params = ? {extra_condition} "
+                         f"AND seq_hash IN ({','.join('?' * len(chunk))})")
+            values = (self.version, self.params, *extra_values, *chunk)
+            rows.extend(self.db.execute(f"SELECT seq_hash{columns} FROM {table} WHERE {condition}", values))
+            if touch:
+                self.db.execute(f"UPDATE {table} SET last_used = ? WHERE {condition}", (self.now, *values))
+        self.db.commit()
+        return rows
+
+    def get_cached_seq_hashes(self, seq_hashes):
+        """Sequences with cached matches (their last-used times are not updated)."""
+        return {seq_hash for seq_hash, in self._select("matches", "", seq_hashes, touch=False)}
+
+    def get_matches(self, seq_hashes):
+        """seq_hash -> (nb_matches, match lines) of the cached sequences."""
+        rows = self._select("matches", ", nb_matches, lines", seq_hashes)
+        return {seq_hash: (nb_matches, lines) for seq_hash, nb_matches, lines in rows}
+
+    def put_matches(self, seq_hash_to_matches):
+        self.db.executemany("INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?)",
+                            ((seq_hash, self.version, self.params, nb_matches, lines, self.now)
+                             for seq_hash, (nb_matches, lines) in seq_hash_to_matches.items()))
+        self.db.commit()
+
+    def get_alignments(self, rname, seq_hashes):
+        """seq_hash -> list of records without the query name, for the cached sequences."""
+        rows = self._select("alignments", ", lines", seq_hashes, "AND rname = ?", (rname,))
+        return {seq_hash: lines.split("\n") if lines else [] for seq_hash, lines in rows}
+
+    def put_alignments(self, rname, seq_hash_to_records):
+        self.db.executemany("INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?, ?)",
+                            ((seq_hash, rname, self.version, self.params, "\n".join(records), self.now)
+                             for seq_hash, records in seq_hash_to_records.items()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def iterate_over_fasta(fa_fn):
+    """Iterate over (query name, header line, sequence) of a FASTA file."""
+    for qname, comment, seq, _ in fastx.iterate_over_records(fa_fn):
+        qname = qname.decode()
+        header = f">{qname} {comment.decode()}" if comment else f">{qname}"
+        yield qname, header, seq.decode()
+
+
+def iterate_over_cobs_output(match_fn):
+    """Iterate over (query name, nb of matches, match lines) of a postprocessed COBS output."""
+    qname = None
+    with gzip.open(match_fn, "rt") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if line[0] == "*":
+                if qname is not None:
+                    yield qname, nb_matches, "\n".join(lines)
+                qname, _, nb_matches = line[1:].partition("\t")
+                qname = qname.split(" ")[0]
+                nb_matches = int(nb_matches)
+                lines = []
+            else:
+                lines.append(line)
+    if qname is not None:
+        yield qname, nb_matches, "\n".join(lines)
+
+
+def lookup(cache_dir, params, queries_fn, misses_fn, index_fns, cached_fns):
+    queries = [(qname, header, seq, get_seq_hash(seq)) for qname, header, seq in iterate_over_fasta(queries_fn)]
+
+    # a query is a hit only if its matches are cached for all the batches
+    hits = {seq_hash for _, _, _, seq_hash in queries}
+    for index_fn in index_fns:
+        if not hits:
+            break
+        cache = ResultCache(get_cache_fn(cache_dir, get_batch_name(index_fn)), get_file_version(index_fn), params)
+        hits &= cache.get_cached_seq_hashes(hits)
+        cache.close()
+
+    with open(misses_fn, "w") as fo:
+        for _, header, seq, seq_hash in queries:
+            if seq_hash not in hits:
+                print(header, seq, sep="\n", file=fo)
+
+    for index_fn, cached_fn in zip(index_fns, cached_fns):
+        cache = ResultCache(get_cache_fn(cache_dir, get_batch_name(index_fn)), get_file_version(index_fn), params)
+        matches = cache.get_matches(hits) if hits else {}
+        cache.close()
+        with gzip.open(cached_fn, "wt", compresslevel=1) as fo:
+            for qname, _, _, seq_hash in queries:
+                if seq_hash in hits:
+                    nb_matches, lines = matches[seq_hash]
+                    print(f"*{qname}\t{nb_matches}", file=fo)
+                    if lines:
+                        print(lines, file=fo)
+
+    nb_hits = sum(seq_hash in hits for _, _, _, seq_hash in queries)
+    error(f"Result cache: {nb_hits} queries with cached matches in all the batches, "
+          f"{len(queries) - nb_hits} to match")
+
+
+def store_matches(cache_dir, params, queries_fn, index_fns, match_fns):
+    qname_to_seq_hash = {qname: get_seq_hash(seq) for qname, _, seq in iterate_over_fasta(queries_fn)}
+    for index_fn, match_fn in zip(index_fns, match_fns):
+        batch = get_batch_name(index_fn)
+        assert batch == get_batch_name(match_fn).split("____")[0], f"{match_fn} is not an output of batch {batch}"
+        seq_hash_to_matches = {
+            qname_to_seq_hash[qname]: (nb_matches, lines)
+            for qname, nb_matches, lines in iterate_over_cobs_output(match_fn)
+        }
+        cache = ResultCache(get_cache_fn(cache_dir, batch), get_file_version(index_fn), params)
+        cache.put_matches(seq_hash_to_matches)
+        cache.close()
+    error(f"Result cache: stored the matches of {len(qname_to_seq_hash)} queries in {len(match_fns)} batches")
+
+
+def get_cache_fns(cache_dir):
+    return sorted(map(str, Path(cache_dir).glob("*.sqlite")))
+
+
+def get_cache_size(cache_fns):
+    return sum(
+        os.path.getsize(fn + suffix) for fn in cache_fns for suffix in ["", "-wal"] if os.path.exists(fn + suffix))
+
+
+def evict(cache_dir, max_gb):
+    cache_fns = get_cache_fns(cache_dir)
+    max_bytes = max_gb * 2**30
+    total_bytes = get_cache_size(cache_fns)
+    if total_bytes <= max_bytes:
+        error(f"Result cache: {total_bytes / 2**30:.2f} GB, within the budget of {max_gb} GB")
+        return
+
+    # global LRU over the entries of all the batches
+    entries = []
+    for fn in cache_fns:
+        db = sqlite3.connect(fn, timeout=SQLITE_TIMEOUT)
+        for table in TABLES:
+            entries.extend(db.execute(f"SELECT last_used, length(lines) + {ENTRY_OVERHEAD_BYTES} FROM {table}"))
+        db.close()
+    estimated_bytes = sum(size for _, size in entries)
+    budget = max_bytes * estimated_bytes / total_bytes
+
+    entries.sort(reverse=True)
+    cutoff = None
+    kept = 0
+    for last_used, size in entries:
+        if kept + size > budget:
+            cutoff = last_used
+            break
+        kept += size
+
+    nb_evicted = 0
+    for fn in cache_fns:
+        db = sqlite3.connect(fn, timeout=SQLITE_TIMEOUT)
+        if cutoff is not None:
+            for table in TABLES:
+                nb_evicted += db.execute(f"DELETE FROM {table} WHERE last_used <= ?", (cutoff,)).rowcount
+            db.commit()
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.execute("VACUUM")
+        db.close()
+    error(f"Result cache: evicted {nb_evicted} entries, "
+          f"{total_bytes / 2**30:.2f} GB -> {get_cache_size(cache_fns) / 2**30:.2f} GB")
+
+
+def print_stats(cache_dir):
+    cache_fns = get_cache_fns(cache_dir)
+    print("table", "entries", "bytes", sep="\t")
+    for table in TABLES:
+        nb_entries = 0
+        nb_bytes = 0
+        for fn in cache_fns:
+            db = sqlite3.connect(f"file:{fn}?mode=ro", uri=True)
+            n, b = db.execute(f"SELECT count(*), coalesce(sum(length(lines)), 0) FROM {table}").fetchone()
+            db.close()
+            nb_entries += n
+            nb_bytes += b
+        print(table, nb_entries, nb_bytes, sep="\t")
+    print("total (files)", len(cache_fns), get_cache_size(cache_fns), sep="\t")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Persistent cache of the per-batch results of the queries")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    def add_common_arguments(p):
+        p.add_argument('-d', dest='cache_dir', metavar='dir', required=True, help='cache directory')
+
+    def add_matches_arguments(p):
+        add_common_arguments(p)
+        p.add_argument('-p', dest='params', metavar='str', required=True, help='COBS parameters (part of the key)')
+        p.add_argument('--indexes',
+                       metavar='batch.cobs_classic.xz',
+                       nargs='+',
+                       required=True,
+                       help='compressed COBS indexes of the batches (define the versions)')
+
+    p = subparsers.add_parser("lookup", help="split the queries into cache hits and misses")
+    add_matches_arguments(p)
+    p.add_argument('-q', dest='queries_fn', metavar='queries.fa', required=True, help='merged queries')
+    p.add_argument('-o', dest='misses_fn', metavar='misses.fa', required=True, help='queries to match by COBS')
+    p.add_argument('--cached',
+                   dest='cached_fns',
+                   metavar='batch____queries.gz',
+                   nargs='+',
+                   required=True,
+                   help='COBS outputs of the hits, one per index')
+
+    p = subparsers.add_parser("store-matches", help="store the COBS matches of the misses")
+    add_matches_arguments(p)
+    p.add_argument('-q', dest='queries_fn', metavar='misses.fa', required=True, help='queries matched by COBS')
+    p.add_argument('--matches',
+                   dest='match_fns',
+                   metavar='batch____queries.gz',
+                   nargs='+',
+                   required=True,
+                   help='COBS outputs, one per index')
+
+    p = subparsers.add_parser("evict", help="shrink the cache to a size budget")
+    add_common_arguments(p)
+    p.add_argument('--max-gb',
+                   metavar='float',
+                   type=float,
+                   default=DEFAULT_MAX_GB,
+                   help=f'size budget in GB [{DEFAULT_MAX_GB}]')
+
+    p = subparsers.add_parser("stats", help="print the number and the size of the cached entries")
+    add_common_arguments(p)
+
+    args = parser.parse_args()
+
+    if args.subcommand == "lookup":
+        assert len(args.indexes) == len(args.cached_fns), "the number of indexes and cached outputs must be the same"
+        lookup(args.cache_dir, args.params, args.queries_fn, args.misses_fn, args.indexes, args.cached_fns)
+    elif args.subcommand == "store-matches":
+        assert len(args.indexes) == len(args.match_fns), "the number of indexes and COBS outputs must be the same"
+        store_matches(args.cache_dir, args.params, args.queries_fn, args.indexes, args.match_fns)
+    elif args.subcommand == "evict":
+        evict(args.cache_dir, args.max_gb)
+    elif args.subcommand == "stats":
+        print_stats(args.cache_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#! /usr/bin/env python3
+
+import argparse
+import gzip
+import os
+import sqlite3
+import sys
+"""
+Sidecar index for random access into a sam_summary.gz file by query name or genome accession.
+
+When indexing, aggregate_sams.py writes the alignments of every batch as
+independent gzip members ("blocks") of about BLOCK_SIZE uncompressed bytes,
+never splitting a line. The index (SQLite) records:
+
+    blocks      - block ID -> batch, offset and length of the gzip member in the file
+    queries     - query name -> blocks containing its alignments (and the offset of its first line in the block)
+    accessions  - genome accession -> blocks containing alignments to it
+
+A lookup then decompresses only the blocks of the query/accession.
+"""
+
+DEFAULT_BLOCK_SIZE = 2**20  # 1 MB
+
+SCHEMA = """
+CREATE TABLE blocks (block_id INTEGER PRIMARY KEY, batch TEXT, offset INTEGER, length INTEGER);
+CREATE TABLE queries (qname TEXT, block_id INTEGER, line_offset INTEGER);
+CREATE TABLE accessions (accession TEXT, block_id INTEGER);
+"""
+
+INDEXES = """
+CREATE INDEX queries_qname ON queries (qname);
+CREATE INDEX accessions_accession ON accessions (accession);
+"""
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def get_accession(rname):
+    return rname.partition(b".")[0]
+
+
+class SamSummaryIndexWriter:
+    """Write a sam_summary as indexed blocks."""
+
+    def __init__(self, index_fn, block_size=DEFAULT_BLOCK_SIZE):
+        self.index_fn = index_fn
+        self.block_size = block_size
+        if os.path.exists(index_fn):
+            os.remove(index_fn)
+        self.db = sqlite3.connect(index_fn)
+        self.db.executescript(SCHEMA)
+        self.nb_blocks = 0
+
+    def write_block(self, fo, batch, lines):
+        """Write lines (bytes, with newlines) as one gzip member and index it."""
+        offset = fo.tell()
+        data = b"".join(lines)
+        fo.write(gzip.compress(data, compresslevel=1, mtime=0))
+        block_id = self.nb_blocks
+        self.nb_blocks += 1
+        self.db.execute("INSERT INTO blocks VALUES (?, ?, ?, ?)", (block_id, batch, offset, fo.tell() - offset))
+
+        first_line_offsets = {}
+        accessions = set()
+        line_offset = 0
+        for line in lines:
+            p = line.split(b"\t", 3)
+            first_line_offsets.setdefault(p[0], line_offset)
+            if len(p) > 2 and p[2] != b"*":
+                accessions.add(get_accession(p[2]))
+            line_offset += len(line)
+        self.db.executemany("INSERT INTO queries VALUES (?, ?, ?)",
+                            ((qname.decode(), block_id, o) for qname, o in first_line_offsets.items()))
+        self.db.executemany("INSERT INTO accessions VALUES (?, ?)",
+                            ((accession.decode(), block_id) for accession in accessions))
+
+    def write_batch(self, fo, batch, lines):
+        """Split the lines of a batch into blocks."""
+        block = []
+        block_size = 0
+        for line in lines:
+            block.append(line)
+            block_size += len(line)
+            if block_size >= self.block_size:
+                self.write_block(fo, batch, block)
+                block = []
+                block_size = 0
+        if block:
+            self.write_block(fo, batch, block)
+
+    def close(self):
+        self.db.executescript(INDEXES)
+        self.db.commit()
+        self.db.close()
+
+
+def get_default_index_fn(sam_summary_fn):
+    if sam_summary_fn.endswith(".gz"):
+        sam_summary_fn = sam_summary_fn[:-3]
+    return sam_summary_fn + ".idx"
+
+
+def _read_block(f, offset, length):
+    f.seek(offset)
+    return gzip.decompress(f.read(length))
+
+
+def lookup_query(sam_summary_fn, db, qname):
+    prefix = qname.encode() + b"\t"
+    rows = db.execute(
+        "SELECT b.offset, b.length, q.line_offset FROM queries q JOIN blocks b USING (block_id) "
+        "WHERE q.qname = ? ORDER BY b.offset", (qname,))
+    with open(sam_summary_fn, "rb") as f:
+        for offset, length, line_offset in rows:
+            block = _read_block(f, offset, length)
+            for line in block[line_offset:].splitlines(keepends=True):
+                if line.startswith(prefix):
+                    yield line
+
+
+def lookup_accession(sam_summary_fn, db, accession):
+    rows = db.execute(
+        "SELECT b.offset, b.length FROM accessions a JOIN blocks b USING (block_id) "
+        "WHERE a.accession = ? ORDER BY b.offset", (accession,))
+    accession = accession.encode()
+    with open(sam_summary_fn, "rb") as f:
+        for offset, length in rows:
+            for line in _read_block(f, offset, length).splitlines(keepends=True):
+                p = line.split(b"\t", 3)
+                if len(p) > 2 and get_accession(p[2]) == accession:
+                    yield line
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Look up alignments of queries or genomes in an indexed sam_summary")
+
+    parser.add_argument(
+        'sam_summary_fn',
+        metavar='output.sam_summary.gz',
+        help='aggregated alignments (written by aggregate_sams.py with --index)',
+    )
+
+    parser.add_argument(
+        '-q',
+        dest='qnames',
+        metavar='str',
+        action='append',
+        default=[],
+        help='query name (can be used multiple times)',
+    )
+
+    parser.add_argument(
+        '-a',
+        dest='accessions',
+        metavar='str',
+        action='append',
+        default=[],
+        help='genome accession (can be used multiple times)',
+    )
+
+    parser.add_argument(
+        '-i',
+        dest='index_fn',
+        metavar='output.sam_summary.idx',
+        default=None,
+        help='sidecar index [<sam_summary without .gz>.idx]',
+    )
+
+    args = parser.parse_args()
+
+    index_fn = args.index_fn if args.index_fn is not None else get_default_index_fn(args.sam_summary_fn)
+    if not os.path.exists(index_fn):
+        error(f"Index {index_fn} not found (run the pipeline with sam_summary_index: True)")
+        sys.exit(1)
+
+    db = sqlite3.connect(f"file:{index_fn}?mode=ro", uri=True)
+    out = sys.stdout.buffer
+    for qname in args.qnames:
+        for line in lookup_query(args.sam_summary_fn, db, qname):
+            out.write(line)
+    for accession in args.accessions:
+        for line in lookup_accession(args.sam_summary_fn, db, accession):
+            out.write(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+#! /usr/bin/env python3
+
+import argparse
+import datetime
+import io
+import itertools
+import json
+import lzma
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+from pathlib import Path
+
+from microbenchmarks import get_commit
+"""
+End-to-end scale benchmark of the pipeline with stand-in COBS and minimap2.
+
+For every point of a sweep (number of batches x number of reads), a sandbox is
+created with synthetic data: random genomes packed as `asms/{batch}.tar.xz`,
+fake COBS indexes `cobs/{batch}.cobs_classic.xz` (the accessions of the batch,
+padded to --index-mb MB), the data/ files describing the batches, and reads
+sampled from the genomes (with substitutions) as query files in input/. The
+real Snakefile and scripts are then run in the sandbox with the executables of
+scripts/fake_tools/ first in PATH: `cobs` and `minimap2` produce outputs of
+realistic sizes (see their docstrings) at a configurable speed, so that the
+orchestration and the Python steps can be measured offline, without the tools,
+the downloads or the real indexes. `seqtk` is faked too if it is not installed.
+
+For every point, the wall time and the peak RSS of the whole run are reported,
+together with per-stage statistics (number of jobs, total and maximum wall
+time, peak RSS) collected from the benchmark logs of the rules
+(logs/benchmarks/{rule}/). Snakemake and /usr/bin/time are required.
+
+    scripts/scale_benchmark.py --batches 2,8,32 --reads 1000,10000 -o scale.json
+
+With --dry-run, only the DAG is built (`snakemake --dry-run`), in sandboxes
+with the metadata of the batches and empty assemblies and indexes, which
+measures the time Snakemake spends in the helpers of the Snakefile for large
+grids of batches x query files. To compare two versions of the Snakefile, run
+it on another checkout with --repo:
+
+    git worktree add /tmp/before HEAD~1
+    scripts/scale_benchmark.py --dry-run --batches 305 --query-files 1,10,50 --repo /tmp/before
+    scripts/scale_benchmark.py --dry-run --batches 305 --query-files 1,10,50
+"""
+
+FAKE_TOOLS_DIR = Path(__file__).resolve().parent / "fake_tools"
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# linked into every sandbox (read-only), config.yaml is copied
+LINKED_FILES = ["Snakefile", "scripts", "envs"]
+
+SUBSTITUTION_RATE = 0.01
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+##################################
+## Synthetic data
+##################################
+
+
+def random_seq(rng, length):
+    return "".join(rng.choices("ACGT", k=length))
+
+
+def get_batch_name(i):
+    return f"synthetic_{i:04d}__01"
+
+
+def get_accession(batch_id, genome_id):
+    return f"SAMN{90000000 + batch_id * 10000 + genome_id}"
+
+
+def write_assemblies(asms_fn, batch, genomes):
+    """tar.xz of a batch, with one FASTA file per genome ({batch}/{accession}.fa)."""
+    with tarfile.open(asms_fn, mode="w:xz", preset=1) as tar:
+        for accession, contigs in genomes.items():
+            fa = "".join(f">{accession}.contig{i:05d}\n{contig}\n" for i, contig in enumerate(contigs, 1)).encode()
+            info = tarfile.TarInfo(f"{batch}/{accession}.fa")
+            info.size = len(fa)
+            tar.addfile(info, io.BytesIO(fa))
+
+
+def write_fake_cobs_index(index_fn, accessions, index_mb):
+    """Fake COBS index (see scripts/fake_tools/cobs), padded to index_mb MB. Returns its uncompressed size."""
+    header = ("#fake_cobs_classic\n" + "".join(f"{accession}\n" for accession in accessions) + "\n").encode()
+    padding = max(int(index_mb * 1024 * 1024) - len(header), 0)
+    with lzma.open(index_fn, "wb", preset=0) as fo:
+        fo.write(header)
+        chunk = bytes(1 << 20)
+        for start in range(0, padding, len(chunk)):
+            fo.write(chunk[:min(len(chunk), padding - start)])
+    return len(header) + padding
+
+
+def mutate(rng, seq):
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() < SUBSTITUTION_RATE:
+            seq[i] = rng.choice("ACGT".replace(seq[i], ""))
+    return "".join(seq)
+
+
+def reverse_complement(seq):
+    return seq.translate(str.maketrans("ACGT", "TGCA"))[::-1]
+
+
+def write_reads(input_dir, rng, all_genomes, nb_reads, read_len, nb_query_files):
+    """Reads sampled from the genomes, named r{i}_{accession of the source genome}, split into FASTQ files."""
+    accessions = list(all_genomes)
+    fos = [open(input_dir / f"reads_{i + 1}.fq", "w") for i in range(nb_query_files)]
+    try:
+        for i in range(nb_reads):
+            accession = rng.choice(accessions)
+            contig = rng.choice(all_genomes[accession])
+            pos = rng.randrange(0, max(len(contig) - read_len, 0) + 1)
+            seq = mutate(rng, contig[pos:pos + read_len])
+            if rng.random() < 0.5:
+                seq = reverse_complement(seq)
+            print(f"@r{i}_{accession}\n{seq}\n+\n{'I' * len(seq)}", file=fos[i % nb_query_files])
+    finally:
+        for fo in fos:
+            fo.close()
+
+
+def create_sandbox(sandbox_dir, nb_batches, nb_reads, nb_query_files, args):
+    rng = random.Random(args.seed)
+    sandbox_dir.mkdir(parents=True)
+    for name in LINKED_FILES:
+        (sandbox_dir / name).symlink_to(args.repo / name)
+    shutil.copy(args.repo / "config.yaml", sandbox_dir / "config.yaml")
+    for name in ["data", "asms", "cobs", "input", "logs"]:
+        (sandbox_dir / name).mkdir()
+
+    all_genomes = {}
+    batches = []
+    index_sizes = []
+    batch_accessions = []
+    for batch_id in range(nb_batches):
+        batch = get_batch_name(batch_id)
+        genome_len = args.genome_kb * 1000 // args.contigs
+        if args.dry_run:
+            # the sequences are not needed to build the DAG
+            genome_len = args.read_len
+        genomes = {
+            get_accession(batch_id, genome_id): [random_seq(rng, genome_len) for _ in range(args.contigs)]
+            for genome_id in range(args.genomes_per_batch)
+        }
+        if args.dry_run:
+            (sandbox_dir / "asms" / f"{batch}.tar.xz").touch()
+            (sandbox_dir / "cobs" / f"{batch}.cobs_classic.xz").touch()
+            index_size = int(args.index_mb * 1024 * 1024)
+        else:
+            write_assemblies(sandbox_dir / "asms" / f"{batch}.tar.xz", batch, genomes)
+            index_size = write_fake_cobs_index(sandbox_dir / "cobs" / f"{batch}.cobs_classic.xz", list(genomes),
+                                               args.index_mb)
+        all_genomes.update(genomes)
+        batches.append(batch)
+        index_sizes.append(f"cobs/{batch}.cobs_classic.xz  {index_size}  {index_size}\n")
+        batch_accessions.append(f"{batch}\t{','.join(genomes)}\n")
+
+    with open(sandbox_dir / "data" / "batches.txt", "w") as fo:
+        fo.write("".join(f"{batch}\n" for batch in batches))
+    with open(sandbox_dir / "data" / "decompressed_indexes_sizes.txt", "w") as fo:
+        fo.write("".join(index_sizes))
+    with lzma.open(sandbox_dir / "data" / "661k_batches.txt.xz", "wt") as fo:
+        fo.write("".join(batch_accessions))
+    write_reads(sandbox_dir / "input", rng, all_genomes, nb_reads, args.read_len, nb_query_files)
+
+
+##################################
+## Running the pipeline
+##################################
+
+
+def get_fake_tools_path(sandbox_dir):
+    """Directory with the stand-in executables to put first in PATH."""
+    bin_dir = sandbox_dir / "bin"
+    bin_dir.mkdir()
+    tools = ["cobs", "minimap2"]
+    if shutil.which("seqtk") is None:
+        tools.append("seqtk")
+    for tool in tools:
+        (bin_dir / tool).symlink_to(FAKE_TOOLS_DIR / tool)
+    return bin_dir
+
+
+def run_pipeline(sandbox_dir, args):
+    env = dict(os.environ)
+    env["PATH"] = f"{get_fake_tools_path(sandbox_dir)}:{env['PATH']}"
+    env["FAKE_COBS_HIT_RATE"] = str(args.hit_rate)
+    env["FAKE_COBS_QUERY_MS"] = str(args.cobs_query_ms)
+    env["FAKE_MINIMAP2_INDEX_MS_PER_MB"] = str(args.minimap2_index_ms_per_mb)
+    env["FAKE_MINIMAP2_QUERY_MS"] = str(args.minimap2_query_ms)
+    command = [
+        "/usr/bin/time", "-f", "%M", "-o",
+        str(sandbox_dir / "max_rss_kb.txt"), "snakemake", args.target, "--cores",
+        str(args.cores), "--rerun-incomplete", "--printshellcmds", "--resources", "max_download_threads=1",
+        f"max_io_heavy_threads={args.cores}", f"max_ram_mb={args.max_ram_gb * 1024}", "--config",
+        "batches=data/batches.txt", "download_dir=.", f"max_ram_gb={args.max_ram_gb}", *args.config
+    ]
+    if args.dry_run:
+        command += ["--dry-run", "--quiet"]
+    error(f"Running {' '.join(command[5:])} in {sandbox_dir}")
+    start = time.perf_counter()
+    with open(sandbox_dir / "snakemake.log", "w") as log_fh:
+        return_code = subprocess.call(command, cwd=sandbox_dir, env=env, stdout=log_fh, stderr=subprocess.STDOUT)
+    wall_s = time.perf_counter() - start
+    if return_code:
+        error(f"Snakemake failed, see {sandbox_dir / 'snakemake.log'}")
+    with open(sandbox_dir / "max_rss_kb.txt") as f:
+        # the largest process of the run (snakemake or any job)
+        max_rss_mb = round(int(f.read().split()[-1]) / 1024, 1)
+    return return_code, wall_s, max_rss_mb
+
+
+def collect_stage_stats(sandbox_dir):
+    """Per-rule statistics from the benchmark logs (see scripts/benchmark.py)."""
+    stages = {}
+    for log_fn in sorted((sandbox_dir / "logs" / "benchmarks").glob("*/*.txt")):
+        with open(log_fn) as f:
+            lines = f.read().splitlines()
+        if len(lines) < 3:
+            continue
+        values = dict(zip(lines[1].split("\t"), lines[2].split("\t")))
+        empty_stage = {"jobs": 0, "total_wall_s": 0.0, "max_wall_s": 0.0, "max_rss_mb": 0.0}
+        stage = stages.setdefault(log_fn.parent.name, empty_stage)
+        wall_s = float(values["real(s)"])
+        stage["jobs"] += 1
+        stage["total_wall_s"] = round(stage["total_wall_s"] + wall_s, 3)
+        stage["max_wall_s"] = max(stage["max_wall_s"], wall_s)
+        stage["max_rss_mb"] = max(stage["max_rss_mb"], round(int(values["max_RAM(kb)"]) / 1024, 1))
+    return stages
+
+
+def run_point(work_dir, nb_batches, nb_reads, nb_query_files, args):
+    sandbox_dir = work_dir / f"batches_{nb_batches}__reads_{nb_reads}__query_files_{nb_query_files}"
+    error(f"Creating the sandbox {sandbox_dir} ({nb_batches} batches, {nb_reads} reads, {nb_query_files} query files)")
+    create_sandbox(sandbox_dir, nb_batches, nb_reads, nb_query_files, args)
+    return_code, wall_s, max_rss_mb = run_pipeline(sandbox_dir, args)
+    return {
+        "nb_batches": nb_batches,
+        "nb_reads": nb_reads,
+        "nb_query_files": nb_query_files,
+        "success": return_code == 0,
+        "wall_s": round(wall_s, 3),
+        "max_rss_mb": max_rss_mb,
+        "stages": collect_stage_stats(sandbox_dir),
+    }
+
+
+def print_table(results):
+    """Scaling curves: wall time of the run and of every stage, for every point of the sweep."""
+    stats_keys = ["jobs", "total_wall_s", "max_wall_s", "max_rss_mb"]
+    print("nb_batches", "nb_reads", "nb_query_files", "stage", *stats_keys, sep="\t")
+    for result in results:
+        point = (result["nb_batches"], result["nb_reads"], result["nb_query_files"])
+        print(*point, "all", "", result["wall_s"], result["wall_s"], result["max_rss_mb"], sep="\t")
+        for stage, stats in sorted(result["stages"].items()):
+            print(*point, stage, *(stats[key] for key in stats_keys), sep="\t")
+
+
+def parse_int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+def check_requirements():
+    missing = [tool for tool in ["snakemake", "/usr/bin/time", "xzcat"] if shutil.which(tool) is None]
+    if missing:
+        error(f"Missing requirements: {', '.join(missing)}")
+        sys.exit(1)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="End-to-end scale benchmark with stand-in COBS and minimap2")
+
+    parser.add_argument('-o', dest='output_fn', metavar='results.json', default=None, help='output JSON file')
+    parser.add_argument('-d',
+                        dest='work_dir',
+                        metavar='dir',
+                        default="scale_benchmark",
+                        help='directory of the sandboxes (must not exist) [scale_benchmark]')
+    parser.add_argument('--keep', action='store_true', help='keep the sandboxes')
+    parser.add_argument('--batches',
+                        metavar='int,...',
+                        type=parse_int_list,
+                        default=[2, 8],
+                        help='numbers of batches [2,8]')
+    parser.add_argument('--reads',
+                        metavar='int,...',
+                        type=parse_int_list,
+                        default=[1000, 10000],
+                        help='numbers of reads [1000,10000]')
+    parser.add_argument('--genomes-per-batch', metavar='int', type=int, default=20, help='[20]')
+    parser.add_argument('--genome-kb', metavar='int', type=int, default=200, help='genome length in kb [200]')
+    parser.add_argument('--contigs', metavar='int', type=int, default=5, help='contigs per genome [5]')
+    parser.add_argument('--read-len', metavar='int', type=int, default=150, help='[150]')
+    parser.add_argument('--query-files',
+                        metavar='int,...',
+                        type=parse_int_list,
+                        default=[2],
+                        help='numbers of query files [2]')
+    parser.add_argument('--index-mb',
+                        metavar='float',
+                        type=float,
+                        default=10,
+                        help='uncompressed size of the fake COBS indexes in MB [10]')
+    parser.add_argument('--hit-rate',
+                        metavar='float',
+                        type=float,
+                        default=0.01,
+                        help='probability of a spurious COBS match of a read to a genome [0.01]')
+    parser.add_argument('--cobs-query-ms',
+                        metavar='float',
+                        type=float,
+                        default=0,
+                        help='time of the fake COBS per query in ms [0]')
+    parser.add_argument('--minimap2-index-ms-per-mb',
+                        metavar='float',
+                        type=float,
+                        default=0,
+                        help='indexing time of the fake minimap2 per MB of reference in ms [0]')
+    parser.add_argument('--minimap2-query-ms',
+                        metavar='float',
+                        type=float,
+                        default=0,
+                        help='time of the fake minimap2 per query in ms [0]')
+    parser.add_argument('--cores', metavar='int', type=int, default=4, help='[4]')
+    parser.add_argument('--max-ram-gb', metavar='int', type=int, default=8, help='[8]')
+    parser.add_argument('--target', metavar='str', default="map", help='Snakemake target [map]')
+    parser.add_argument('--config',
+                        metavar='KEY=VALUE',
+                        action='append',
+                        default=[],
+                        help='additional Snakemake config value (can be used multiple times)')
+    parser.add_argument('--dry-run', action='store_true', help='only build the DAG (snakemake --dry-run)')
+    parser.add_argument('--repo',
+                        metavar='dir',
+                        type=lambda s: Path(s).resolve(),
+                        default=REPO_DIR,
+                        help='checkout whose Snakefile and scripts are run [this one]')
+    parser.add_argument('--seed', metavar='int', type=int, default=42, help='seed of the synthetic data [42]')
+
+    args = parser.parse_args()
+
+    check_requirements()
+    work_dir = Path(args.work_dir).resolve()
+    assert not work_dir.exists(), f"{work_dir} already exists"
+    results = []
+    try:
+        for nb_batches, nb_reads, nb_query_files in itertools.product(args.batches, args.reads, args.query_files):
+            results.append(run_point(work_dir, nb_batches, nb_reads, nb_query_files, args))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results)
+    if args.output_fn is not None:
+        report = {
+            "commit": get_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "args": {
+                key: str(value) if key == "repo" else value for key, value in vars(args).items() if key != "output_fn"
+            },
+            "results": results,
+        }
+        with open(args.output_fn, "w") as fo:
+            json.dump(report, fo, indent=2)
+    if not all(result["success"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+
+import argparse
+import heapq
+import os
+import sys
+import tempfile
+
+from xopen import xopen
+
+import final_stats
+"""
+Query-major ordering of alignments by a bounded-memory external merge sort.
+
+Alignments are sorted by (query ID, input file, line number), where query IDs
+follow the order of the queries in the merged query file, so all the hits of a
+read are together, ordered like the input queries, and the hits of a read keep
+the original order (by batch, then by reference). Sorted runs of at most
+`memory_mb` are spilled into a temporary directory and merged at the end.
+"""
+
+DEFAULT_MEMORY_MB = 2000
+
+# maximum number of runs merged at once (limits the number of open files)
+MAX_MERGE_FAN_IN = 256
+
+# estimated memory used per buffered line in addition to the line itself (bytes object, key tuple, list slot)
+LINE_OVERHEAD_BYTES = 150
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def iterate_over_keyed_lines(sam_fns, query_ids):
+    """Iterate over ((query ID, file index, line index), line) of alignment files (batch headers are skipped)."""
+    for i, fn in enumerate(sam_fns):
+        with xopen(fn, "rb") as f:
+            for j, line in enumerate(f):
+                if not line.strip() or line.startswith(b"==>"):
+                    continue
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                qname = line.split(b"\t", 1)[0]
+                assert qname in query_ids, f"query {qname.decode()} not in the query file"
+                yield (query_ids[qname], i, j), line
+
+
+def _write_run(keyed_lines, run_dir):
+    with tempfile.NamedTemporaryFile("wb", dir=run_dir, suffix=".run", delete=False) as fo:
+        for (qid, i, j), line in keyed_lines:
+            fo.write(b"%d\t%d\t%d\t" % (qid, i, j))
+            fo.write(line)
+    return fo.name
+
+
+def _spill(run, run_dir):
+    run.sort(key=lambda keyed_line: keyed_line[0])
+    return _write_run(run, run_dir)
+
+
+def _iterate_over_run(run_fn):
+    with open(run_fn, "rb", buffering=2**20) as f:
+        for record in f:
+            qid, i, j, line = record.split(b"\t", 3)
+            yield (int(qid), int(i), int(j)), line
+
+
+def _merge_runs(run_fns):
+    return heapq.merge(*map(_iterate_over_run, run_fns), key=lambda keyed_line: keyed_line[0])
+
+
+def _merge_runs_into_run(run_fns, run_dir):
+    merged_run_fn = _write_run(_merge_runs(run_fns), run_dir)
+    for run_fn in run_fns:
+        os.remove(run_fn)
+    return merged_run_fn
+
+
+def iterate_query_major_lines(sam_fns, query_ids, memory_mb=DEFAULT_MEMORY_MB, tmp_dir=None):
+    """Iterate over the lines (bytes, with newlines) of alignment files in query-major order."""
+    budget = memory_mb * 2**20
+    with tempfile.TemporaryDirectory(prefix="sort_sam_summary_", dir=tmp_dir) as run_dir:
+        run_fns = []
+        run = []
+        run_size = 0
+        for keyed_line in iterate_over_keyed_lines(sam_fns, query_ids):
+            run.append(keyed_line)
+            run_size += len(keyed_line[1]) + LINE_OVERHEAD_BYTES
+            if run_size >= budget:
+                run_fns.append(_spill(run, run_dir))
+                run = []
+                run_size = 0
+
+        if not run_fns:
+            # everything fits in memory
+            run.sort(key=lambda keyed_line: keyed_line[0])
+            for _, line in run:
+                yield line
+            return
+
+        if run:
+            run_fns.append(_spill(run, run_dir))
+            run = []
+        error(f"Merging {len(run_fns)} sorted runs")
+        while len(run_fns) > MAX_MERGE_FAN_IN:
+            run_fns = [
+                _merge_runs_into_run(run_fns[k:k + MAX_MERGE_FAN_IN], run_dir)
+                for k in range(0, len(run_fns), MAX_MERGE_FAN_IN)
+            ]
+        for _, line in _merge_runs(run_fns):
+            yield line
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Sort alignments in query-major order (external merge sort)")
+
+    parser.add_argument(
+        'sam_fns',
+        metavar='alignments.gz',
+        nargs='+',
+        help='batch SAMs or aggregated sam_summary files (possibly gzipped)',
+    )
+
+    parser.add_argument(
+        '-q',
+        dest='queries_fn',
+        metavar='queries.fa',
+        required=True,
+        help='merged queries (defines the order of the queries)',
+    )
+
+    parser.add_argument(
+        '-m',
+        dest='memory_mb',
+        metavar='int',
+        type=int,
+        default=DEFAULT_MEMORY_MB,
+        help=f'memory budget for sorted runs in MB [{DEFAULT_MEMORY_MB}]',
+    )
+
+    parser.add_argument(
+        '-T',
+        dest='tmp_dir',
+        metavar='dir',
+        default=None,
+        help='directory for spilled runs [system temporary directory]',
+    )
+
+    args = parser.parse_args()
+
+    query_ids, _ = final_stats.load_query_ids_and_bps(args.queries_fn)
+    out = sys.stdout.buffer
+    for line in iterate_query_major_lines(args.sam_fns, query_ids, args.memory_mb, args.tmp_dir):
+        out.write(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+import argparse
+import gzip
+import sys
+
+from xopen import xopen
+"""
+Split the alignments of a multi-file pass into per-input-file alignments (incremental_queries).
+
+Every alignment is written into the output of each query file that contains
+its query (identified by the query name).
+"""
+
+
+def error(*msg):
+    print(*msg, file=sys.stderr)
+
+
+def load_query_names(query_fn):
+    with open(query_fn, "rb") as f:
+        return {line[1:].split()[0] for line in f if line[:1] == b">"}
+
+
+def split_sam(sam_fn, query_fns, output_fns):
+    qname_to_outputs = {}
+    outputs = [gzip.open(fn, "wb", compresslevel=1) for fn in output_fns]
+    try:
+        for query_fn, output in zip(query_fns, outputs):
+            for qname in load_query_names(query_fn):
+                qname_to_outputs.setdefault(qname, []).append(output)
+
+        nb_lines = 0
+        with xopen(sam_fn, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                qname = line.split(b"\t", 1)[0]
+                assert qname in qname_to_outputs, f"query {qname.decode()} is not in any query file"
+                for output in qname_to_outputs[qname]:
+                    output.write(line)
+                nb_lines += 1
+    finally:
+        for output in outputs:
+            output.close()
+    error(f"Split {nb_lines} alignments of {sam_fn} into {len(output_fns)} files")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Split the alignments of a pass by input query file")
+
+    parser.add_argument(
+        'sam_fn',
+        metavar='pass.sam.gz',
+        help='alignments of the pass',
+    )
+
+    parser.add_argument(
+        '-q',
+        dest='query_fns',
+        metavar='queries.fa',
+        action='append',
+        required=True,
+        help='preprocessed query file (one per output)',
+    )
+
+    parser.add_argument(
+        '-o',
+        dest='output_fns',
+        metavar='file.sam.gz',
+        action='append',
+        required=True,
+        help='output alignments of the corresponding query file',
+    )
+
+    args = parser.parse_args()
+
+    assert len(args.query_fns) == len(args.output_fns), "the number of -q and -o must be the same"
+    split_sam(args.sam_fn, args.query_fns, args.output_fns)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import random
+import shutil
+import subprocess
+import sys
+
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+import compact_sam
+import exact_match
+
+
+def random_seq(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+@pytest.fixture
+def ref_and_queries():
+    rng = random.Random(42)
+    contigs = {"contig1": random_seq(rng, 5000), "contig2": random_seq(rng, 5000)}
+    # an N in both the reference and the query is a text match, but a mismatch for minimap2
+    contigs["contig1"] = contigs["contig1"][:2075] + "N" + contigs["contig1"][2076:]
+    # two exact copies: minimap2 gives MAPQ 0 and a secondary alignment, so the query is left to it
+    contigs["contig2"] = contigs["contig2"][:4000] + contigs["contig1"][3000:3200] + contigs["contig2"][4200:]
+    substituted = contigs["contig2"][3000:3150]
+    queries = {
+        "forward": contigs["contig1"][100:250],
+        "reverse": compact_sam.reverse_complement(contigs["contig2"][1000:1150]),
+        "with_n": contigs["contig1"][2000:2150],
+        "substituted": substituted[:75] + ("A" if substituted[75] != "A" else "C") + substituted[76:],
+        "short": contigs["contig1"][4000:4020],
+        "repeat": contigs["contig1"][3020:3170],
+    }
+    rfa = "".join(f">{name}\n{seq}\n" for name, seq in contigs.items()).encode()
+    return rfa, queries
+
+
+def test_exact_hits_only(ref_and_queries):
+    rfa, queries = ref_and_queries
+    records, remaining_qnames = exact_match.map_exact_hits(rfa, list(queries), queries, eqx=True)
+    assert sorted(record.split("\t")[0] for record in records) == ["forward", "reverse"]
+    assert sorted(remaining_qnames) == ["repeat", "short", "substituted", "with_n"]
+
+
+@pytest.mark.skipif(shutil.which("minimap2") is None, reason="minimap2 not installed")
+def test_exact_hits_match_minimap2(ref_and_queries, tmp_path):
+    rfa, queries = ref_and_queries
+    ref_fn = tmp_path / "ref.fa"
+    ref_fn.write_bytes(rfa)
+    query_fn = tmp_path / "queries.fa"
+    query_fn.write_text("".join(f">{qname}\n{qseq}\n" for qname, qseq in queries.items()))
+    command = ["minimap2", "-a", "--eqx", "-x", "sr", str(ref_fn), str(query_fn)]
+    mm_output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    mm_primary = {}
+    for line in mm_output.splitlines():
+        p = line.split("\t")
+        if not line.startswith("@") and not int(p[1]) & 0x904:
+            mm_primary[p[0]] = p
+
+    records, _ = exact_match.map_exact_hits(rfa, list(queries), queries, eqx=True)
+    assert records
+    for record in records:
+        p = record.split("\t")
+        mm = mm_primary[p[0]]
+        # QNAME, FLAG, RNAME, POS, MAPQ, CIGAR, SEQ
+        assert [p[i] for i in (0, 1, 2, 3, 4, 5, 9)] == [mm[i] for i in (0, 1, 2, 3, 4, 5, 9)]
+        assert "NM:i:0" in mm[11:]
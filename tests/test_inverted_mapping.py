@@ -0,0 +1,94 @@
+import random
+import shutil
+import subprocess
+import sys
+
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+import compact_sam
+import inverted_mapping
+
+
+def random_seq(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def mutate(rng, seq, nb_substitutions):
+    seq = list(seq)
+    for pos in rng.sample(range(len(seq)), nb_substitutions):
+        seq[pos] = rng.choice([c for c in "ACGT" if c != seq[pos]])
+    return "".join(seq)
+
+
+@pytest.fixture
+def genomes_and_reads():
+    rng = random.Random(42)
+    genomes = {
+        "genome1": {
+            "g1_contig1": random_seq(rng, 10000),
+            "g1_contig2": random_seq(rng, 3000)
+        },
+        "genome2": {
+            "g2_contig1": random_seq(rng, 8000)
+        },
+    }
+    qname_to_qseq = {}
+    for rname, contigs in genomes.items():
+        for contig, seq in contigs.items():
+            # deep coverage of a single region, more reads than the secondary alignments minimap2 reports per query
+            for i in range(20):
+                start = 1000 + rng.randrange(50)
+                read = mutate(rng, seq[start:start + 150], i % 3)
+                qname_to_qseq[f"{contig}_deep{i}"] = compact_sam.reverse_complement(read) if i % 2 else read
+            for i in range(10):
+                start = rng.randrange(len(seq) - 150)
+                qname_to_qseq[f"{contig}_spread{i}"] = mutate(rng, seq[start:start + 150], i % 3)
+    qname_to_qseq["unmapped"] = random_seq(rng, 150)
+    # every read is a candidate of every genome
+    rname_to_qnames = {rname: sorted(qname_to_qseq) for rname in genomes}
+    return genomes, qname_to_qseq, rname_to_qnames
+
+
+def to_fasta(name_to_seq):
+    return "".join(f">{name}\n{seq}\n" for name, seq in name_to_seq.items())
+
+
+def get_primary_alignments(records):
+    """qname -> (strand and unmapped flags, contig, position) of the primary records."""
+    primary = {}
+    for record in records:
+        p = record.split("\t")
+        if not int(p[1]) & 0x900:
+            primary[p[0]] = (int(p[1]) & 0x14, p[2], int(p[3]))
+    return primary
+
+
+@pytest.mark.skipif(shutil.which("minimap2") is None, reason="minimap2 not installed")
+def test_inverted_mapping_matches_normal_mode(genomes_and_reads, tmp_path):
+    genomes, qname_to_qseq, rname_to_qnames = genomes_and_reads
+    reads_fn = tmp_path / "reads.fa"
+    reads_fn.write_text(to_fasta(qname_to_qseq))
+
+    command = inverted_mapping.get_minimap_command("sr", 1, "", str(reads_fn), len(qname_to_qseq))
+    genome_fas = ((rname, to_fasta(contigs).encode()) for rname, contigs in genomes.items())
+    inverted = dict(
+        inverted_mapping.iterate_over_inverted_alignments(command, genome_fas, rname_to_qnames, qname_to_qseq))
+
+    for rname, contigs in genomes.items():
+        genome_fn = tmp_path / f"{rname}.fa"
+        genome_fn.write_text(to_fasta(contigs))
+        command = ["minimap2", "-a", "-x", "sr", str(genome_fn), str(reads_fn)]
+        mm_output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        normal = [line for line in mm_output.splitlines() if not line.startswith("@")]
+        inverted_primary = get_primary_alignments(inverted[rname])
+        normal_primary = get_primary_alignments(normal)
+        assert inverted_primary.keys() == normal_primary.keys()
+        for qname, (flag, contig, pos) in normal_primary.items():
+            # the ends of the reads are not extended with an end bonus, mismatches there can be clipped instead
+            inverted_flag, inverted_contig, inverted_pos = inverted_primary[qname]
+            assert (inverted_flag, inverted_contig) == (flag, contig), qname
+            assert abs(inverted_pos - pos) <= 10, qname